@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+#  Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import json
+import sqlite3
+
+_schema = '''
+    CREATE TABLE IF NOT EXISTS benchmarks (
+        id INTEGER PRIMARY KEY,
+        -- The benchmark description (without the 'env_' keys), as canonical JSON. This identifies the benchmark.
+        description_key TEXT NOT NULL UNIQUE
+    );
+    -- One row for each key in the benchmark description (including the 'env_' keys). Values are stored as JSON.
+    CREATE TABLE IF NOT EXISTS benchmark_params (
+        benchmark_id INTEGER NOT NULL REFERENCES benchmarks(id) ON DELETE CASCADE,
+        name TEXT NOT NULL,
+        value TEXT NOT NULL,
+        PRIMARY KEY (benchmark_id, name)
+    );
+    CREATE INDEX IF NOT EXISTS benchmark_params_by_name_and_value ON benchmark_params (name, value);
+    -- The (rounded) confidence interval for each dimension, as in the JSON-lines format.
+    CREATE TABLE IF NOT EXISTS results (
+        benchmark_id INTEGER NOT NULL REFERENCES benchmarks(id) ON DELETE CASCADE,
+        dimension TEXT NOT NULL,
+        lower_bound REAL NOT NULL,
+        upper_bound REAL NOT NULL,
+        PRIMARY KEY (benchmark_id, dimension)
+    );
+    -- The raw values measured in each run. These are not available for results imported from the JSON-lines format.
+    CREATE TABLE IF NOT EXISTS samples (
+        benchmark_id INTEGER NOT NULL REFERENCES benchmarks(id) ON DELETE CASCADE,
+        dimension TEXT NOT NULL,
+        run_index INTEGER NOT NULL,
+        value REAL NOT NULL,
+        PRIMARY KEY (benchmark_id, dimension, run_index)
+    );
+'''
+
+_sqlite_file_header = b'SQLite format 3\x00'
+
+
+def _to_json(value):
+    return json.dumps(value, sort_keys=True)
+
+
+def benchmark_description_key(benchmark_description):
+    return _to_json({key: value for key, value in benchmark_description.items() if not key.startswith('env_')})
+
+
+class BenchmarkResultsStore:
+    """
+    Benchmark results stored in a SQLite database. Each result has the same structure as a line of the JSON-lines
+    format (i.e. {"benchmark": <benchmark description>, "results": {<dimension>: [<lower bound>, <upper bound>]}}),
+    plus the raw samples.
+
+    A benchmark is identified by its description without the 'env_' keys (see run_benchmarks.py), so adding a result
+    for a benchmark that already has one replaces it.
+    """
+    def __init__(self, file_name):
+        self.connection = sqlite3.connect(file_name)
+        self.connection.execute('PRAGMA foreign_keys = ON')
+        with self.connection:
+            self.connection.executescript(_schema)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def add_result(self, benchmark_description, confidence_interval_by_dimension, samples_by_dimension={}):
+        with self.connection:
+            description_key = benchmark_description_key(benchmark_description)
+            self.connection.execute('DELETE FROM benchmarks WHERE description_key = ?', (description_key,))
+            benchmark_id = self.connection.execute('INSERT INTO benchmarks (description_key) VALUES (?)',
+                                                   (description_key,)).lastrowid
+            self.connection.executemany(
+                'INSERT INTO benchmark_params (benchmark_id, name, value) VALUES (?, ?, ?)',
+                [(benchmark_id, name, _to_json(value)) for name, value in benchmark_description.items()])
+            self.connection.executemany(
+                'INSERT INTO results (benchmark_id, dimension, lower_bound, upper_bound) VALUES (?, ?, ?, ?)',
+                [(benchmark_id, dimension, interval[0], interval[1])
+                 for dimension, interval in confidence_interval_by_dimension.items()])
+            self.connection.executemany(
+                'INSERT INTO samples (benchmark_id, dimension, run_index, value) VALUES (?, ?, ?, ?)',
+                [(benchmark_id, dimension, run_index, value)
+                 for dimension, values in samples_by_dimension.items()
+                 for run_index, value in enumerate(values)])
+
+    def has_result(self, benchmark_description):
+        """Returns True if there's a result for this benchmark (ignoring the 'env_' keys of the description)."""
+        return self.connection.execute('SELECT 1 FROM benchmarks WHERE description_key = ?',
+                                       (benchmark_description_key(benchmark_description),)).fetchone() is not None
+
+    def _find_benchmark_ids(self, fixed_benchmark_params, result_dimension):
+        query = 'SELECT id FROM benchmarks WHERE 1'
+        query_args = []
+        for name, value in sorted(fixed_benchmark_params.items()):
+            if value is None:
+                # As in format_bench_results.extract_results(), None matches the benchmarks without this param.
+                query += ' AND id NOT IN (SELECT benchmark_id FROM benchmark_params WHERE name = ? AND value != ?)'
+                query_args += [name, _to_json(None)]
+                continue
+            query += ' AND id IN (SELECT benchmark_id FROM benchmark_params WHERE name = ? AND value = ?)'
+            # Note that tuples (e.g. from format_bench_results.make_immutable()) are stored as JSON lists.
+            query_args += [name, _to_json(value)]
+        if result_dimension is not None:
+            query += ' AND id IN (SELECT benchmark_id FROM results WHERE dimension = ?)'
+            query_args += [result_dimension]
+        return [benchmark_id for (benchmark_id,) in self.connection.execute(query + ' ORDER BY id', query_args)]
+
+    def get_results(self, fixed_benchmark_params={}, result_dimension=None):
+        """
+        Returns the results (in the JSON-lines format) of the benchmarks whose description has the specified values for
+        the params in fixed_benchmark_params (a None value matches the benchmarks that don't have that param) and (if
+        result_dimension is not None) that have a result for result_dimension.
+        """
+        bench_results = []
+        for benchmark_id in self._find_benchmark_ids(fixed_benchmark_params, result_dimension):
+            benchmark_description = {
+                name: json.loads(value)
+                for name, value in self.connection.execute(
+                    'SELECT name, value FROM benchmark_params WHERE benchmark_id = ?', (benchmark_id,))}
+            results = {
+                dimension: [lower_bound, upper_bound]
+                for dimension, lower_bound, upper_bound in self.connection.execute(
+                    'SELECT dimension, lower_bound, upper_bound FROM results WHERE benchmark_id = ?', (benchmark_id,))}
+            bench_results.append({"benchmark": benchmark_description, "results": results})
+        return bench_results
+
+    def get_samples(self, benchmark_description):
+        """Returns the raw samples of this benchmark, as a dict {<dimension>: [<value>, ...]} (empty if there are none)."""
+        samples_by_dimension = dict()
+        for dimension, value in self.connection.execute(
+                'SELECT samples.dimension, samples.value FROM samples JOIN benchmarks ON samples.benchmark_id = benchmarks.id '
+                + 'WHERE benchmarks.description_key = ? ORDER BY samples.dimension, samples.run_index',
+                (benchmark_description_key(benchmark_description),)):
+            samples_by_dimension.setdefault(dimension, []).append(value)
+        return samples_by_dimension
+
+    def import_jsonl(self, file_name):
+        with open(file_name, 'r') as f:
+            for line in f:
+                if line.strip():
+                    bench_result = json.loads(line)
+                    self.add_result(bench_result['benchmark'], bench_result['results'])
+
+    def export_jsonl(self, file_name):
+        with open(file_name, 'w') as f:
+            for bench_result in self.get_results():
+                json.dump(bench_result, f)
+                print(file=f)
+
+
+def is_benchmark_results_store(file_name):
+    with open(file_name, 'rb') as f:
+        return f.read(len(_sqlite_file_header)) == _sqlite_file_header
+
+
+def load_benchmark_results(file_name):
+    """
+    Loads the results in file_name, either a BenchmarkResultsStore or a file in the JSON-lines format, into an
+    in-memory BenchmarkResultsStore.
+    """
+    store = BenchmarkResultsStore(':memory:')
+    if is_benchmark_results_store(file_name):
+        with BenchmarkResultsStore(file_name) as file_store:
+            file_store.connection.backup(store.connection)
+    else:
+        store.import_jsonl(file_name)
+    return store
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Converts benchmark results between the SQLite format (used by run_benchmarks.py) and the JSON-lines format (1 result per line, in JSON format).')
+    parser.add_argument('command', choices=['import-jsonl', 'export-jsonl'],
+                        help='import-jsonl adds the results in --jsonl to --db (replacing existing results for the same benchmarks), export-jsonl writes all results in --db to --jsonl.')
+    parser.add_argument('--db', help='The SQLite benchmark results file.')
+    parser.add_argument('--jsonl', help='The JSON-lines benchmark results file.')
+    args = parser.parse_args()
+
+    if args.db is None or args.jsonl is None:
+        raise Exception('You must specify both --db and --jsonl.')
+
+    with BenchmarkResultsStore(args.db) as store:
+        if args.command == 'import-jsonl':
+            store.import_jsonl(args.jsonl)
+        else:
+            store.export_jsonl(args.jsonl)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+#  Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import math
+import sys
+import numpy
+import yaml
+from scipy.stats import mannwhitneyu
+from benchmark_results_store import load_benchmark_results, benchmark_description_key
+
+
+# These keys identify the code under test and the compiler version, so they're expected to differ between the baseline
+# and the current results (e.g. when comparing two commits) and they're ignored when pairing benchmarks.
+_run_identity_keys = {'di_library_git_commit_hash', 'di_library_version_name', 'compiler_name'}
+
+
+def benchmark_pairing_key(benchmark_description):
+    """Returns the key used to pair benchmarks, i.e. the description without the 'env_' keys and _run_identity_keys."""
+    return benchmark_description_key({key: value for key, value in benchmark_description.items()
+                                      if key not in _run_identity_keys})
+
+
+def get_min_p_value(num_baseline_samples, num_current_samples):
+    """Returns the lowest p-value that a two-sided Mann-Whitney U test can give with these numbers of samples."""
+    return min(1.0, 2 / math.comb(num_baseline_samples + num_current_samples, num_baseline_samples))
+
+
+def get_min_num_samples(significance_level):
+    """
+    Returns the minimum number of samples (on each side) needed for the Mann-Whitney U test to detect a change at the
+    given significance level, e.g. 4 for 0.05.
+    """
+    num_samples = 1
+    while get_min_p_value(num_samples, num_samples) >= significance_level:
+        num_samples += 1
+    return num_samples
+
+
+class MetricComparison:
+    """The comparison of a result dimension (aka metric) of a benchmark between the baseline and the current results."""
+    def __init__(self, benchmark_description, dimension, baseline_value, current_value, relative_change, p_value,
+                 effect_size, is_regression, is_improvement, has_insufficient_samples=False):
+        self.benchmark_description = benchmark_description
+        self.dimension = dimension
+        self.baseline_value = baseline_value
+        self.current_value = current_value
+        self.relative_change = relative_change
+        self.p_value = p_value
+        self.effect_size = effect_size
+        self.is_regression = is_regression
+        self.is_improvement = is_improvement
+        # True if there are too few samples to detect a change (so the comparison can't tell if there's a regression).
+        self.has_insufficient_samples = has_insufficient_samples
+
+
+def cliffs_delta(baseline_samples, current_samples):
+    """
+    Returns Cliff's delta for the two sets of samples, i.e. P(current > baseline) - P(current < baseline). This is
+    between -1 and 1, and it's positive when the current values tend to be higher.
+    """
+    greater = sum(1 for current in current_samples for baseline in baseline_samples if current > baseline)
+    smaller = sum(1 for current in current_samples for baseline in baseline_samples if current < baseline)
+    return (greater - smaller) / (len(current_samples) * len(baseline_samples))
+
+
+def compare_samples(baseline_samples, current_samples):
+    """
+    Returns a tuple (relative_change, p_value, effect_size) comparing the medians of the samples, using a two-sided
+    Mann-Whitney U test and Cliff's delta as the effect size.
+    """
+    baseline_median = numpy.median(baseline_samples)
+    current_median = numpy.median(current_samples)
+    relative_change = (current_median - baseline_median) / baseline_median if baseline_median != 0 else 0.0
+    if len(set(baseline_samples)) == 1 and len(set(current_samples)) == 1:
+        # E.g. the executable size, that's the same in every run. The Mann-Whitney U test can't detect a difference with
+        # few samples, but here we know that there's a difference iff the values differ.
+        p_value = 0.0 if baseline_samples[0] != current_samples[0] else 1.0
+    else:
+        p_value = mannwhitneyu(current_samples, baseline_samples, alternative='two-sided').pvalue
+    return relative_change, p_value, cliffs_delta(baseline_samples, current_samples)
+
+
+def compare_confidence_intervals(baseline_interval, current_interval):
+    """
+    Like compare_samples(), for results without raw samples (e.g. imported from the JSON-lines format). Here the
+    difference is considered significant iff the confidence intervals don't overlap.
+    """
+    baseline_midpoint = (baseline_interval[0] + baseline_interval[1]) / 2
+    current_midpoint = (current_interval[0] + current_interval[1]) / 2
+    relative_change = (current_midpoint - baseline_midpoint) / baseline_midpoint if baseline_midpoint != 0 else 0.0
+    if current_interval[0] > baseline_interval[1]:
+        return relative_change, 0.0, 1.0
+    if current_interval[1] < baseline_interval[0]:
+        return relative_change, 0.0, -1.0
+    return relative_change, 1.0, 0.0
+
+
+def get_bench_result_by_pairing_key(results_store, store_name, errors):
+    bench_result_by_key = dict()
+    for bench_result in results_store.get_results():
+        key = benchmark_pairing_key(bench_result['benchmark'])
+        if key in bench_result_by_key:
+            errors.append('The %s results contain multiple results for the benchmark %s (e.g. for different commits), '
+                          'so they can\'t be paired.' % (store_name, key))
+        bench_result_by_key[key] = bench_result
+    return bench_result_by_key
+
+
+def compare_results(baseline_results_store, current_results_store, thresholds_definition):
+    """
+    Pairs the benchmarks in the two stores by their description (ignoring the 'env_' keys and the keys that identify
+    the code under test and the compiler version, see benchmark_pairing_key()) and compares the dimensions that have a
+    threshold in thresholds_definition.
+
+    :returns: A pair (comparisons, errors), where comparisons is a list of MetricComparison and errors is a list of
+              messages about the benchmarks and metrics that couldn't be compared (e.g. because they're only in one of
+              the stores).
+    """
+    significance_level = thresholds_definition.get('significance_level', 0.05)
+    thresholds_by_dimension = thresholds_definition['metrics']
+    errors = []
+    baseline_bench_result_by_key = get_bench_result_by_pairing_key(baseline_results_store, 'baseline', errors)
+    current_bench_result_by_key = get_bench_result_by_pairing_key(current_results_store, 'current', errors)
+    for key in sorted(baseline_bench_result_by_key.keys() - current_bench_result_by_key.keys()):
+        errors.append('The benchmark %s is only in the baseline results.' % key)
+    for key in sorted(current_bench_result_by_key.keys() - baseline_bench_result_by_key.keys()):
+        errors.append('The benchmark %s is only in the current results.' % key)
+
+    comparisons = []
+    for key, current_bench_result in sorted(current_bench_result_by_key.items()):
+        benchmark_description = current_bench_result['benchmark']
+        baseline_bench_result = baseline_bench_result_by_key.get(key)
+        if baseline_bench_result is None:
+            continue
+        baseline_samples_by_dimension = baseline_results_store.get_samples(baseline_bench_result['benchmark'])
+        current_samples_by_dimension = current_results_store.get_samples(benchmark_description)
+        for dimension, thresholds in thresholds_by_dimension.items():
+            in_current_results = dimension in current_bench_result['results']
+            in_baseline_results = dimension in baseline_bench_result['results']
+            if not in_current_results and not in_baseline_results:
+                # This metric is not measured by this benchmark.
+                continue
+            if not in_current_results or not in_baseline_results:
+                errors.append('The metric %s of the benchmark %s is only in the %s results.' % (
+                    dimension, key, 'current' if in_current_results else 'baseline'))
+                continue
+            baseline_samples = baseline_samples_by_dimension.get(dimension)
+            current_samples = current_samples_by_dimension.get(dimension)
+            has_insufficient_samples = False
+            if baseline_samples and current_samples:
+                baseline_value = numpy.median(baseline_samples)
+                current_value = numpy.median(current_samples)
+                relative_change, p_value, effect_size = compare_samples(baseline_samples, current_samples)
+                if len(set(baseline_samples)) > 1 or len(set(current_samples)) > 1:
+                    # The Mann-Whitney U test is used, and with few samples it can't reach a low p-value.
+                    has_insufficient_samples = (
+                        get_min_p_value(len(baseline_samples), len(current_samples)) >= significance_level)
+            else:
+                baseline_interval = baseline_bench_result['results'][dimension]
+                current_interval = current_bench_result['results'][dimension]
+                baseline_value = (baseline_interval[0] + baseline_interval[1]) / 2
+                current_value = (current_interval[0] + current_interval[1]) / 2
+                relative_change, p_value, effect_size = compare_confidence_intervals(baseline_interval, current_interval)
+            is_significant = (p_value < significance_level
+                              and abs(effect_size) >= thresholds.get('min_effect_size', 0)
+                              and abs(relative_change) > thresholds.get('max_relative_change', 0))
+            comparisons.append(MetricComparison(
+                benchmark_description=benchmark_description,
+                dimension=dimension,
+                baseline_value=baseline_value,
+                current_value=current_value,
+                relative_change=relative_change,
+                p_value=p_value,
+                effect_size=effect_size,
+                # For all these metrics (times, sizes), higher values are worse.
+                is_regression=is_significant and relative_change > 0,
+                is_improvement=is_significant and relative_change < 0,
+                has_insufficient_samples=has_insufficient_samples))
+    return comparisons, errors
+
+
+def print_comparisons(comparisons):
+    for comparison in comparisons:
+        if comparison.has_insufficient_samples:
+            status = 'INSUFFICIENT SAMPLES'
+        elif comparison.is_regression:
+            status = 'REGRESSION'
+        elif comparison.is_improvement:
+            status = 'improvement'
+        else:
+            status = 'no significant change'
+        print('%s: %s: %.3g -> %.3g (%+.1f%%, p=%.3g, effect size=%+.2f): %s' % (
+            comparison.benchmark_description, comparison.dimension, comparison.baseline_value, comparison.current_value,
+            comparison.relative_change * 100, comparison.p_value, comparison.effect_size, status))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compares two sets of benchmark results, and exits with a non-zero exit code if there are significant regressions.')
+    parser.add_argument('--benchmark-results',
+                        help='The file with the current benchmark results, either a SQLite database generated by run_benchmarks.py or a file with 1 result per line, in JSON format.')
+    parser.add_argument('--baseline-benchmark-results',
+                        help='The file with the baseline benchmark results (considered the "before" state), in the same format as --benchmark-results.')
+    parser.add_argument('--thresholds-definition', help='The YAML file that defines the thresholds for each metric (e.g. fruit_bench_regression_thresholds.yml).')
+    args = parser.parse_args()
+
+    if args.benchmark_results is None:
+        raise Exception("You must specify a benchmark results file using --benchmark-results.")
+
+    if args.baseline_benchmark_results is None:
+        raise Exception("You must specify a baseline benchmark results file using --baseline-benchmark-results.")
+
+    if args.thresholds_definition is None:
+        raise Exception("You must specify a thresholds definition file using --thresholds-definition.")
+
+    with open(args.thresholds_definition, 'r') as f:
+        thresholds_definition = yaml.safe_load(f)
+
+    comparisons, errors = compare_results(load_benchmark_results(args.baseline_benchmark_results),
+                                          load_benchmark_results(args.benchmark_results),
+                                          thresholds_definition)
+    print_comparisons(comparisons)
+    for error in errors:
+        print('ERROR: %s' % error)
+
+    num_regressions = len([comparison for comparison in comparisons if comparison.is_regression])
+    num_insufficient_samples = len([comparison for comparison in comparisons if comparison.has_insufficient_samples])
+    print()
+    print('Compared %s metrics, found %s significant regressions.' % (len(comparisons), num_regressions))
+    if num_insufficient_samples > 0:
+        print('%s metrics had too few samples to detect a change: with a significance level of %s, the benchmarks must be run at least %s times (see the --min-runs flag of run_benchmarks.py).' % (
+            num_insufficient_samples, thresholds_definition.get('significance_level', 0.05),
+            get_min_num_samples(thresholds_definition.get('significance_level', 0.05))))
+    if errors:
+        print('%s benchmarks or metrics could not be compared, see the errors above.' % len(errors))
+    if num_regressions > 0 or num_insufficient_samples > 0 or errors:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+#  Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Parsers for the compile time profiles generated by Clang (-ftime-trace) and GCC (-ftime-report), used by the
+# fruit_compile_profile benchmark in run_benchmarks.py.
+
+import json
+import re
+from collections import defaultdict
+
+# E.g. " phase parsing                      :   0.63 ( 51%)   0.27 ( 49%)   0.93 ( 51%)    67M ( 56%)"
+# (the columns are usr, sys, wall and GGC memory).
+_gcc_time_report_line_regex = re.compile(r'^\s*(?P<name>[^:]+?)\s*:\s*[0-9.]+\s*\(\s*[0-9]+%\)\s*[0-9.]+\s*\(\s*[0-9]+%\)\s*(?P<wall>[0-9.]+)\s*\(')
+
+_gcc_frontend_phases = {'phase setup', 'phase parsing', 'phase lang. deferred'}
+_gcc_backend_phases = {'phase opt and generate', 'phase last asm', 'phase finalize'}
+
+_fruit_meta_namespace = 'fruit::impl::meta::'
+
+
+class TranslationUnitProfile:
+    """The compile time profile of a translation unit. All times are in seconds."""
+    def __init__(self, frontend_time, backend_time, template_instantiation_time, instantiations):
+        self.frontend_time = frontend_time
+        self.backend_time = backend_time
+        self.template_instantiation_time = template_instantiation_time
+        # A list of (name, time) pairs. This is only available with Clang, with GCC it's empty.
+        self.instantiations = instantiations
+
+
+def parse_gcc_time_report(time_report):
+    """Parses the output of GCC's -ftime-report (that GCC prints to stderr) into a TranslationUnitProfile."""
+    wall_time_by_timevar = dict()
+    for line in time_report.splitlines():
+        match = _gcc_time_report_line_regex.match(line)
+        if match:
+            wall_time_by_timevar[match.group('name')] = float(match.group('wall'))
+    return TranslationUnitProfile(
+        frontend_time=sum(wall_time_by_timevar.get(phase, 0.0) for phase in _gcc_frontend_phases),
+        backend_time=sum(wall_time_by_timevar.get(phase, 0.0) for phase in _gcc_backend_phases),
+        template_instantiation_time=wall_time_by_timevar.get('template instantiation', 0.0),
+        instantiations=[])
+
+
+def parse_clang_time_trace(time_trace):
+    """Parses the JSON file generated by Clang's -ftime-trace (as a string) into a TranslationUnitProfile."""
+    frontend_time = 0.0
+    backend_time = 0.0
+    template_instantiation_time = 0.0
+    instantiations = []
+    for event in json.loads(time_trace)['traceEvents']:
+        if event.get('ph') != 'X':
+            continue
+        # Durations are in microseconds.
+        duration = event['dur'] / 1000000
+        name = event['name']
+        if name == 'Frontend':
+            frontend_time += duration
+        elif name == 'Backend':
+            backend_time += duration
+        elif name in ('Total InstantiateClass', 'Total InstantiateFunction'):
+            template_instantiation_time += duration
+        elif name in ('InstantiateClass', 'InstantiateFunction'):
+            instantiations.append((event['args']['detail'], duration))
+    return TranslationUnitProfile(
+        frontend_time=frontend_time,
+        backend_time=backend_time,
+        template_instantiation_time=template_instantiation_time,
+        instantiations=instantiations)
+
+
+def get_meta_function(instantiation_name):
+    """
+    Returns the fruit::impl::meta function that an instantiation belongs to, e.g. 'fruit::impl::meta::GetResult' for
+    'fruit::impl::meta::GetResult::apply<...>', or None if the instantiation isn't in fruit::impl::meta.
+    """
+    if not instantiation_name.startswith(_fruit_meta_namespace):
+        return None
+    # Meta functions are structs with a nested `apply` template, and we don't care about the template arguments.
+    meta_function = instantiation_name.split('<', 1)[0]
+    if meta_function.endswith('::apply'):
+        meta_function = meta_function[:-len('::apply')]
+    return meta_function
+
+
+def get_instantiation_time_by_meta_function(translation_unit_profiles):
+    """
+    Returns a dict {<meta function>: <time>} with the total time spent instantiating each fruit::impl::meta function in
+    the given profiles. Note that Clang reports nested instantiations separately, so these times are inclusive (the time
+    of an instantiation is also counted in the instantiations that triggered it).
+    """
+    time_by_meta_function = defaultdict(float)
+    for profile in translation_unit_profiles:
+        for name, time in profile.instantiations:
+            meta_function = get_meta_function(name)
+            if meta_function is not None:
+                time_by_meta_function[meta_function] += time
+    return time_by_meta_function
+
+
+def get_top_instantiations(profile_by_translation_unit, n):
+    """Returns the n most expensive instantiations in the given profiles, as dicts sorted by decreasing time."""
+    instantiations = [{'translation_unit': translation_unit, 'name': name, 'time': time}
+                      for translation_unit, profile in profile_by_translation_unit.items()
+                      for name, time in profile.instantiations]
+    return sorted(instantiations, key=lambda instantiation: instantiation['time'], reverse=True)[:n]
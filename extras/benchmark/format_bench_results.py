@@ -14,8 +14,8 @@
 # limitations under the License.
 
 import argparse
-import json
 import yaml
+from benchmark_results_store import load_benchmark_results
 from collections import defaultdict
 
 def extract_results(bench_results, fixed_benchmark_params, column_dimension, row_dimension, result_dimension):
@@ -27,13 +27,14 @@ def extract_results(bench_results, fixed_benchmark_params, column_dimension, row
                       for dimension_name, dimension_value in bench_result['benchmark'].items()}
             results = bench_result['results']
             for param_name, param_value in fixed_benchmark_params.items():
+                # A None (null) value in fixed_benchmark_params matches the results that don't have that param.
                 if params.get(param_name) != param_value:
                     # fixed_benchmark_params not satisfied by this result, skip
                     break
                 if result_dimension not in results:
                     # result_dimension not found in this result, skip
                     break
-                params.pop(param_name)
+                params.pop(param_name, None)
             else:
                 # fixed_benchmark_params were satisfied by these params (and were removed)
                 assert row_dimension in params.keys(), '%s not in %s' % (row_dimension, params.keys())
@@ -235,6 +236,17 @@ def file_size_interval_pretty_printer(file_size_interval, min_in_table, max_in_t
     return interval_pretty_printer(file_size_interval, unit=unit_name, multiplier=1 / unit)
 
 
+def count_interval_pretty_printer(count_interval, min_in_table, max_in_table, count_name='events'):
+    units = [1, 1000, 1000 * 1000, 1000 * 1000 * 1000]
+    unit_name_by_unit = {unit: prefix + count_name
+                         for unit, prefix in ((1, ''), (1000, 'K '), (1000 * 1000, 'M '), (1000 * 1000 * 1000, 'G '))}
+
+    unit = find_best_unit(units, min_in_table, max_in_table)
+    unit_name = unit_name_by_unit[unit]
+
+    return interval_pretty_printer(count_interval, unit=unit_name, multiplier=1 / unit)
+
+
 def make_immutable(x):
     if isinstance(x, list):
         return tuple(make_immutable(elem) for elem in x)
@@ -272,13 +284,18 @@ def determine_value_pretty_printer(unit):
         return time_interval_pretty_printer
     if unit == "bytes":
         return file_size_interval_pretty_printer
+    if unit == "events":
+        return count_interval_pretty_printer
+    if unit == "allocations":
+        return lambda count_interval, min_in_table, max_in_table: count_interval_pretty_printer(
+            count_interval, min_in_table, max_in_table, count_name='allocations')
     raise Exception("Unrecognized unit: %s" % unit)
 
 
 def main():
     parser = argparse.ArgumentParser(description='Runs all the benchmarks whose results are on the Fruit website.')
     parser.add_argument('--benchmark-results',
-                        help='The input file where benchmark results will be read from (1 per line, with each line in JSON format). You can use the run_benchmarks.py to run a benchmark and generate results in this format.')
+                        help='The input file where benchmark results will be read from, either a SQLite database generated by run_benchmarks.py or a file with 1 result per line, in JSON format (see benchmark_results_store.py).')
     parser.add_argument('--baseline-benchmark-results',
                         help='Optional. If specified, compares this file (considered the "before" state) with the one specified in --benchmark-results.')
     parser.add_argument('--benchmark-tables-definition', help='The YAML file that defines the benchmark tables (e.g. fruit_wiki_bench_tables.yaml).')
@@ -290,32 +307,33 @@ def main():
     if args.benchmark_tables_definition is None:
         raise Exception("You must specify a benchmark tables definition file using --benchmark-tables-definition.")
 
-    with open(args.benchmark_results, 'r') as f:
-        bench_results = [json.loads(line) for line in f.readlines()]
+    bench_results_store = load_benchmark_results(args.benchmark_results)
 
     if args.baseline_benchmark_results:
-        with open(args.baseline_benchmark_results, 'r') as f:
-            baseline_bench_results = [json.loads(line) for line in f.readlines()]
+        baseline_bench_results_store = load_benchmark_results(args.baseline_benchmark_results)
     else:
-        baseline_bench_results = None
+        baseline_bench_results_store = None
 
 
     with open(args.benchmark_tables_definition, 'r') as f:
         for table_definition in yaml.load(f)["tables"]:
             fixed_benchmark_params = {dimension_name: make_immutable(dimension_value) for dimension_name, dimension_value in table_definition['benchmark_filter'].items()}
+            result_dimension = table_definition['results']['dimension']
+            # The store only returns the results that match the table's filter, so extract_results() doesn't need to
+            # scan all results for each table.
             table_data = extract_results(
-                bench_results,
+                bench_results_store.get_results(fixed_benchmark_params, result_dimension),
                 fixed_benchmark_params=fixed_benchmark_params,
                 column_dimension=table_definition['columns']['dimension'],
                 row_dimension=table_definition['rows']['dimension'],
-                result_dimension=table_definition['results']['dimension'])
-            if baseline_bench_results:
+                result_dimension=result_dimension)
+            if baseline_bench_results_store is not None:
                 baseline_table_data = extract_results(
-                    baseline_bench_results,
+                    baseline_bench_results_store.get_results(fixed_benchmark_params, result_dimension),
                     fixed_benchmark_params=fixed_benchmark_params,
                     column_dimension=table_definition['columns']['dimension'],
                     row_dimension=table_definition['rows']['dimension'],
-                    result_dimension=table_definition['results']['dimension'])
+                    result_dimension=result_dimension)
             else:
                 baseline_table_data = None
             rows_pretty_printer_definition = table_definition['rows']['pretty_printer']
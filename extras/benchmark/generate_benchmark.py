@@ -19,6 +19,7 @@ import os
 from fruit_source_generator import FruitSourceGenerator
 from boost_di_source_generator import BoostDiSourceGenerator
 from makefile_generator import generate_makefile
+from ninja_generator import generate_ninja_build_file
 import argparse
 
 
@@ -39,10 +40,16 @@ def generate_benchmark(
         num_components_with_no_deps,
         num_components_with_deps,
         num_deps,
-        boost_di_sources_dir=None):
+        boost_di_sources_dir=None,
+        generator='make',
+        generate_dep_files=False):
     """Generates a sample codebase using the specified DI library, meant for benchmarking.
 
     :param boost_di_sources_dir: this is only used if di_library=='boost_di', it can be None otherwise.
+    :param generator: the build system to generate build files for, either 'make' (a Makefile) or 'ninja' (a
+           build.ninja file).
+    :param generate_dep_files: whether the build files track the headers included by each source, see
+           generate_makefile() and generate_ninja_build_file().
     """
 
     if num_components_with_no_deps < num_deps:
@@ -67,6 +74,9 @@ def generate_benchmark(
     else:
         raise Exception('Unrecognized di_library: %s' % di_library)
 
+    if generator not in ('make', 'ninja'):
+        raise Exception('Unrecognized generator: %s' % generator)
+
     os.makedirs(output_dir, exist_ok=True)
 
     num_used_ids = 0
@@ -132,8 +142,14 @@ def generate_benchmark(
     sources = ['component%s' % i for i in range(0, num_used_ids)]
     sources += ['main']
 
-    with open("%s/Makefile" % output_dir, 'w') as makefile:
-        makefile.write(generate_makefile(sources, 'main', compile_command, link_command, link_command_suffix))
+    if generator == 'ninja':
+        with open("%s/build.ninja" % output_dir, 'w') as ninja_build_file:
+            ninja_build_file.write(generate_ninja_build_file(sources, 'main', compile_command, link_command, link_command_suffix,
+                                                             generate_dep_files=generate_dep_files))
+    else:
+        with open("%s/Makefile" % output_dir, 'w') as makefile:
+            makefile.write(generate_makefile(sources, 'main', compile_command, link_command, link_command_suffix,
+                                             generate_dep_files=generate_dep_files))
 
 
 def main():
@@ -149,6 +165,8 @@ def main():
     parser.add_argument('--output-dir', help='Output directory for generated files')
     parser.add_argument('--cxx-std', default='c++11',
                         help='Version of the C++ standard to use. Typically one of \'c++11\' and \'c++14\'. (default: \'c++11\')')
+    parser.add_argument('--generator', default='make',
+                        help='The build system to generate build files for. One of {make, ninja}. (default: make)')
 
     args = parser.parse_args()
 
@@ -183,7 +201,8 @@ def main():
         num_components_with_deps=num_components_with_deps,
         num_components_with_no_deps=num_components_with_no_deps,
         fruit_build_dir=args.fruit_build_dir,
-        num_deps=num_deps)
+        num_deps=num_deps,
+        generator=args.generator)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,119 @@
+/*
+ * Copyright 2014 Google Inc. All rights reserved.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+// A shared library that counts the memory allocations of a process, meant to be loaded with LD_PRELOAD (see
+// run_benchmarks.py). It wraps malloc(), calloc(), realloc(), free() and the aligned allocation functions (operator new
+// and delete use these, e.g. aligned_alloc() for types with an extended alignment) and, when the process exits, it
+// writes "<number of allocations> <number of bytes allocated> <number of frees>" to the file specified in the
+// FRUIT_BENCHMARK_MALLOC_STATS_FILE environment variable.
+//
+// This uses the __libc_* functions, so it only works with glibc.
+
+#include <errno.h>
+#include <stddef.h>
+#include <stdio.h>
+#include <stdlib.h>
+
+extern void* __libc_malloc(size_t size);
+extern void* __libc_calloc(size_t num, size_t size);
+extern void* __libc_realloc(void* ptr, size_t size);
+extern void __libc_free(void* ptr);
+// glibc has no __libc_aligned_alloc() nor __libc_posix_memalign(), we implement those using __libc_memalign().
+extern void* __libc_memalign(size_t alignment, size_t size);
+extern void* __libc_valloc(size_t size);
+extern void* __libc_pvalloc(size_t size);
+
+static unsigned long long num_allocations = 0;
+static unsigned long long num_allocated_bytes = 0;
+static unsigned long long num_frees = 0;
+
+static void count_allocation(size_t size) {
+  __atomic_add_fetch(&num_allocations, 1, __ATOMIC_RELAXED);
+  __atomic_add_fetch(&num_allocated_bytes, size, __ATOMIC_RELAXED);
+}
+
+void* malloc(size_t size) {
+  count_allocation(size);
+  return __libc_malloc(size);
+}
+
+void* calloc(size_t num, size_t size) {
+  count_allocation(num * size);
+  return __libc_calloc(num, size);
+}
+
+void* realloc(void* ptr, size_t size) {
+  count_allocation(size);
+  return __libc_realloc(ptr, size);
+}
+
+void* memalign(size_t alignment, size_t size) {
+  count_allocation(size);
+  return __libc_memalign(alignment, size);
+}
+
+void* aligned_alloc(size_t alignment, size_t size) {
+  count_allocation(size);
+  return __libc_memalign(alignment, size);
+}
+
+int posix_memalign(void** ptr, size_t alignment, size_t size) {
+  if (alignment % sizeof(void*) != 0 || (alignment & (alignment - 1)) != 0 || alignment == 0) {
+    return EINVAL;
+  }
+  count_allocation(size);
+  void* result = __libc_memalign(alignment, size);
+  if (result == NULL) {
+    return ENOMEM;
+  }
+  *ptr = result;
+  return 0;
+}
+
+void* valloc(size_t size) {
+  count_allocation(size);
+  return __libc_valloc(size);
+}
+
+void* pvalloc(size_t size) {
+  count_allocation(size);
+  return __libc_pvalloc(size);
+}
+
+void free(void* ptr) {
+  if (ptr != NULL) {
+    __atomic_add_fetch(&num_frees, 1, __ATOMIC_RELAXED);
+  }
+  __libc_free(ptr);
+}
+
+__attribute__((destructor)) static void write_malloc_stats(void) {
+  // We read the counters before calling fopen(), that allocates.
+  unsigned long long allocations = __atomic_load_n(&num_allocations, __ATOMIC_RELAXED);
+  unsigned long long allocated_bytes = __atomic_load_n(&num_allocated_bytes, __ATOMIC_RELAXED);
+  unsigned long long frees = __atomic_load_n(&num_frees, __ATOMIC_RELAXED);
+  const char* file_name = getenv("FRUIT_BENCHMARK_MALLOC_STATS_FILE");
+  if (file_name == NULL) {
+    return;
+  }
+  FILE* file = fopen(file_name, "w");
+  if (file == NULL) {
+    perror(file_name);
+    return;
+  }
+  fprintf(file, "%llu %llu %llu\n", allocations, allocated_bytes, frees);
+  fclose(file);
+}
@@ -0,0 +1,68 @@
+#  Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+def generate_ninja_build_file(sources, executable_name, compile_command, link_command, link_command_suffix,
+                              generate_dep_files=False):
+    """
+    :param generate_dep_files: if True, the compiler also generates a .d file with the headers included by each source
+           (-MMD), so that incremental builds also rebuild the objects that include a modified header. As in
+           generate_makefile(), this is off by default, so that it doesn't change the work done in the compile time
+           benchmarks.
+    """
+    compile_rule_template = """
+rule cxx
+  command = {compile_command} {dep_file_flags}-c $in -o $out
+"""
+
+    dep_file_settings = """\
+  depfile = $out.d
+  deps = gcc
+"""
+
+    link_rule_template = """
+rule link
+  command = {link_command} $in -o $out {link_command_suffix}
+"""
+
+    rules = compile_rule_template.format(
+        compile_command=compile_command,
+        dep_file_flags='-MMD -MF $out.d ' if generate_dep_files else '')
+    if generate_dep_files:
+        rules += dep_file_settings
+    rules += link_rule_template.format(
+        link_command=link_command,
+        link_command_suffix=link_command_suffix)
+
+    compile_build_template = """
+build {name}.o: cxx {name}.cpp
+"""
+
+    link_build_template = """
+build {executable_name}: link {object_files}
+
+default {executable_name}
+"""
+
+    compile_builds = []
+    object_files = []
+    for source in sources:
+        compile_builds += [compile_build_template.format(name=source)]
+        object_files += ['%s.o' % source]
+
+    link_build = link_build_template.format(
+        object_files=' '.join(object_files),
+        executable_name=executable_name)
+
+    # Cleaning is done with `ninja -t clean`, so there's no need for a "clean" target.
+    return rules + ''.join(compile_builds) + link_build
@@ -28,10 +28,19 @@ import yaml
 from numpy import floor, log10
 import scipy
 import multiprocessing
+import platform
+import sys
+import random
+import time
+import hashlib
+import concurrent.futures
 import sh
 import json
+import shlex
 import statsmodels.stats.api as stats
 from generate_benchmark import generate_benchmark
+from benchmark_results_store import BenchmarkResultsStore, is_benchmark_results_store
+from compile_profile import parse_clang_time_trace, parse_gcc_time_report, get_instantiation_time_by_meta_function, get_top_instantiations
 import git
 from functools import lru_cache as memoize
 
@@ -68,7 +77,140 @@ def run_command(executable, args=[], cwd=None, env=None):
 
 compile_flags = ['-O2', '-DNDEBUG']
 
-make_args = ['-j', multiprocessing.cpu_count() + 1]
+def get_available_cpus():
+    """Returns the CPUs that this process (and the commands that it runs) can run on."""
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(multiprocessing.cpu_count()))
+
+def get_make_args():
+    if '--jobserver-auth=' in os.environ.get('MAKEFLAGS', ''):
+        # We're running under a jobserver (e.g. `make -jN`), make will use it to share job slots with other processes.
+        return []
+    return ['-j', len(get_available_cpus()) + 1]
+
+def get_ninja_args():
+    # Unlike make, ninja doesn't use the jobserver of a parent make.
+    return ['-j', len(get_available_cpus()) + 1]
+
+def read_ninja_log(build_dir, executable_name):
+    """
+    Returns the 'link_time' and 'max_tu_compile_time' dimensions for the last build in build_dir, using the .ninja_log
+    file written by ninja.
+    """
+    # Each line (after the header) is "<start ms>\t<end ms>\t<mtime>\t<output>\t<command hash>". When an output is
+    # rebuilt a new line is appended, so later lines take precedence.
+    duration_by_output = dict()
+    with open(build_dir + '/.ninja_log', 'r') as f:
+        for line in f:
+            if line.startswith('#'):
+                continue
+            start, end, _, output, _ = line.rstrip('\n').split('\t')
+            duration_by_output[output] = (int(end) - int(start)) / 1000
+    return {
+        'link_time': duration_by_output[executable_name],
+        'max_tu_compile_time': max(duration for output, duration in duration_by_output.items() if output.endswith('.o')),
+    }
+
+def get_benchmark_work_dir(benchmark_definition):
+    """
+    Returns the work directory of a benchmark. This only depends on the (expanded) benchmark definition, so different
+    benchmarks can be prepared at the same time without interfering with each other.
+    """
+    key = hashlib.sha256(json.dumps(benchmark_definition, sort_keys=True).encode('utf-8')).hexdigest()
+    return os.path.join(tempfile.gettempdir(), 'fruit-benchmark-dirs', key[:16])
+
+# The hardware/software events counted with --perf-stat, and the name of the corresponding result dimension.
+perf_stat_dimension_by_event = {
+    'instructions': 'Instructions per request',
+    'cycles': 'Cycles per request',
+    'L1-dcache-load-misses': 'L1 misses per request',
+    'LLC-load-misses': 'LLC misses per request',
+    'branch-misses': 'Branch misses per request',
+    'page-faults': 'Page faults per request',
+}
+
+def parse_perf_stat_counters(perf_stat_output, num_requests):
+    """
+    Parses the output of `perf stat -x ,` (in the format "<value>,<unit>,<event>,...") into a dict with the dimensions in
+    perf_stat_dimension_by_event. The counts are for the whole process (so they include the amortized setup cost, e.g.
+    the creation of the component) and are divided by num_requests. Events that can't be counted on this machine are
+    omitted.
+    """
+    counters = dict()
+    for line in perf_stat_output.splitlines():
+        fields = line.split(',')
+        if len(fields) < 3:
+            continue
+        event = re.sub(r':u$', '', fields[2])
+        if event in perf_stat_dimension_by_event:
+            try:
+                value = float(fields[0])
+            except ValueError:
+                # E.g. "<not supported>" or "<not counted>".
+                continue
+            counters[perf_stat_dimension_by_event[event]] = value / num_requests
+    return counters
+
+def build_runtime_benchmark_helpers(compiler_executable_name, work_dir):
+    """
+    Builds the helpers used to measure the memory usage of run-time benchmarks in the work dir: run_with_peak_rss.c and
+    (on Linux, where it can be loaded with LD_PRELOAD) malloc_counter.c.
+    """
+    benchmark_sources_dir = os.path.dirname(os.path.abspath(__file__))
+    run_command(compiler_executable_name,
+                args=['-x', 'c', '-O2', benchmark_sources_dir + '/run_with_peak_rss.c', '-o', work_dir + '/run_with_peak_rss'])
+    if sys.platform.startswith('linux'):
+        run_command(compiler_executable_name,
+                    args=['-x', 'c', '-O2', '-shared', '-fPIC', benchmark_sources_dir + '/malloc_counter.c',
+                          '-o', work_dir + '/libmalloc_counter.so'])
+
+def measure_allocations(executable, num_requests, work_dir):
+    """
+    Runs the executable of a run-time benchmark once with the malloc_counter.c library preloaded, and saves the number
+    of allocations (and allocated bytes) in the work dir, see read_allocation_results().
+
+    This is done once when preparing the benchmark (the number of allocations doesn't change between runs) instead of
+    in each run, so that counting the allocations doesn't affect the measured times.
+    """
+    malloc_counter_library = work_dir + '/libmalloc_counter.so'
+    if not os.path.exists(malloc_counter_library):
+        return
+    modified_env = os.environ.copy()
+    modified_env['LD_PRELOAD'] = malloc_counter_library
+    modified_env['FRUIT_BENCHMARK_MALLOC_STATS_FILE'] = work_dir + '/malloc_stats.txt'
+    run_command(executable, args=[num_requests], env=modified_env)
+
+def run_runtime_benchmark_executable(executable, num_requests, use_perf_stat, work_dir):
+    """
+    Runs the executable of a run-time benchmark (passing num_requests as argument) and returns its results, adding the
+    'peak_rss' dimension (in bytes) and, if use_perf_stat is True, the dimensions in perf_stat_dimension_by_event.
+    """
+    peak_rss_file = work_dir + '/peak_rss.txt'
+    args = [work_dir + '/run_with_peak_rss', peak_rss_file, executable, num_requests]
+    if use_perf_stat:
+        # perf stat writes the counters to stderr.
+        args = ['perf', 'stat', '-x', ',', '-e', ','.join(sorted(perf_stat_dimension_by_event.keys())), '--'] + args
+    stdout, stderr = run_command(args[0], args=args[1:])
+    results = parse_results(stdout.splitlines())
+    if use_perf_stat:
+        results.update(parse_perf_stat_counters(stderr, num_requests))
+    with open(peak_rss_file, 'r') as f:
+        results['peak_rss'] = float(f.read())
+    return results
+
+def read_allocation_results(work_dir, num_requests):
+    """Returns the 'allocs_per_request' and 'bytes_per_request' dimensions saved by measure_allocations(), if any."""
+    try:
+        with open(work_dir + '/malloc_stats.txt', 'r') as f:
+            num_allocations, num_allocated_bytes, _ = [float(value) for value in f.read().split()]
+    except OSError:
+        return dict()
+    # As with perf stat, these include the amortized setup cost.
+    return {
+        'allocs_per_request': num_allocations / num_requests,
+        'bytes_per_request': num_allocated_bytes / num_requests,
+    }
 
 def parse_results(result_lines):
     """
@@ -125,6 +267,65 @@ def git_repo_info(repo_path):
     return (repo.head.commit.hexsha, head_tag)
 
 
+# The files and directories of the Fruit repo that the Fruit library is built from. Changes elsewhere (e.g. in the tests
+# or in the benchmarks themselves) don't affect the build.
+fruit_build_input_paths = ['CMakeLists.txt', 'configuration', 'include', 'src']
+
+
+def git_dirty_tree_hash(repo_path, paths):
+    """
+    Returns a hash of the uncommitted changes (including untracked files) under the given paths (relative to the root
+    of the given git repo), or None if there are no uncommitted changes there.
+    """
+    repo = git.Repo(repo_path)
+    diff = repo.git.diff('HEAD', '--binary', '--', *paths)
+    untracked_files = sorted(repo.git.ls_files('--others', '--exclude-standard', '--', *paths).splitlines())
+    if not diff and not untracked_files:
+        return None
+    h = hashlib.sha256()
+    h.update(diff.encode('utf-8'))
+    for file_name in untracked_files:
+        h.update(file_name.encode('utf-8'))
+        with open(os.path.join(repo.working_tree_dir, file_name), 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def build_fruit(fruit_sources_dir, compiler_executable_name, additional_cmake_args, fruit_build_cache_dir):
+    """
+    Builds Fruit with the given compiler and additional CMake args, and returns the build directory.
+
+    Builds are cached in fruit_build_cache_dir, keyed by the compiler (as returned by determine_compiler_name), the CMake
+    args and the state of the Fruit sources (the git commit and any uncommitted changes in fruit_build_input_paths), so
+    a build is reused by later benchmarks and later runs (e.g. with --continue-benchmark) until one of these changes.
+    """
+    sha256_hash, _ = git_repo_info(fruit_sources_dir)
+    key = json.dumps([determine_compiler_name(compiler_executable_name), list(additional_cmake_args),
+                      sha256_hash, git_dirty_tree_hash(fruit_sources_dir, fruit_build_input_paths)])
+    build_dir = os.path.join(fruit_build_cache_dir, hashlib.sha256(key.encode('utf-8')).hexdigest()[:16])
+    # This file is written only once the build completes successfully, so an interrupted build is never reused.
+    build_completed_file = os.path.join(build_dir, 'fruit-benchmark-build-key.json')
+    if os.path.exists(build_completed_file):
+        print('Reusing the Fruit build in %s' % build_dir)
+        return build_dir
+
+    ensure_empty_dir(build_dir)
+    modified_env = os.environ.copy()
+    modified_env['CXX'] = compiler_executable_name
+    run_command('cmake',
+                args=[
+                    fruit_sources_dir,
+                    '-DCMAKE_BUILD_TYPE=Release',
+                    *additional_cmake_args,
+                ],
+                cwd=build_dir,
+                env=modified_env)
+    run_command('make', args=get_make_args(), cwd=build_dir)
+    with open(build_completed_file, 'w') as f:
+        f.write(key)
+    return build_dir
+
+
 # Some benchmark parameters, e.g. 'compiler_name' are synthesized automatically from other dimensions (e.g. 'compiler' dimension) or from the environment.
 # We put the compiler name/version in the results because the same 'compiler' value might refer to different compiler versions
 # (e.g. if GCC 6.0.0 is installed when benchmarks are run, then it's updated to GCC 6.0.1 and finally the results are formatted, we
@@ -141,16 +342,17 @@ def add_synthetic_benchmark_parameters(original_benchmark_parameters, path_to_co
 
 
 class NewDeleteRunTimeBenchmark:
-    def __init__(self, benchmark_definition, fruit_benchmark_sources_dir):
+    def __init__(self, benchmark_definition, fruit_benchmark_sources_dir, use_perf_stat=False):
         self.benchmark_definition = add_synthetic_benchmark_parameters(benchmark_definition, path_to_code_under_test=None)
         self.fruit_benchmark_sources_dir = fruit_benchmark_sources_dir
+        self.use_perf_stat = use_perf_stat
+        self.tmpdir = get_benchmark_work_dir(self.benchmark_definition)
 
     def prepare(self):
         cxx_std = self.benchmark_definition['cxx_std']
         num_classes = self.benchmark_definition['num_classes']
         compiler_executable_name = self.benchmark_definition['compiler']
 
-        self.tmpdir = tempfile.gettempdir() + '/fruit-benchmark-dir'
         ensure_empty_dir(self.tmpdir)
         run_command(compiler_executable_name,
                     args=compile_flags + [
@@ -160,11 +362,19 @@ class NewDeleteRunTimeBenchmark:
                         '-o',
                         self.tmpdir + '/main',
                     ])
+        build_runtime_benchmark_helpers(compiler_executable_name, self.tmpdir)
+        measure_allocations(self.tmpdir + '/main', self.get_num_loops(), self.tmpdir)
+
+    def get_num_loops(self):
+        # Here each loop (allocating and deallocating all classes) is considered a "request".
+        return int(5000000 * self.benchmark_definition['loop_factor'])
 
     def run(self):
-        loop_factor = self.benchmark_definition['loop_factor']
-        stdout, _ = run_command(self.tmpdir + '/main', args = [int(5000000 * loop_factor)])
-        return parse_results(stdout.splitlines())
+        num_loops = self.get_num_loops()
+        results = run_runtime_benchmark_executable(self.tmpdir + '/main', num_requests=num_loops, use_perf_stat=self.use_perf_stat,
+                                                   work_dir=self.tmpdir)
+        results.update(read_allocation_results(self.tmpdir, num_requests=num_loops))
+        return results
 
     def describe(self):
         return self.benchmark_definition
@@ -178,18 +388,40 @@ class FruitSingleFileCompileTimeBenchmark:
         self.fruit_benchmark_sources_dir = fruit_benchmark_sources_dir
         num_bindings = self.benchmark_definition['num_bindings']
         assert (num_bindings % 5) == 0, num_bindings
+        if self.use_clang_modules():
+            assert 'Clang' in self.benchmark_definition['compiler_name'], 'Clang modules are only supported with Clang, not %s' % self.benchmark_definition['compiler_name']
+        self.module_cache_dir = get_benchmark_work_dir(self.benchmark_definition) + '/clang-modules-cache'
+
+    def use_clang_modules(self):
+        # When this is true, the Fruit headers are imported as a Clang module (see include/fruit/module.modulemap).
+        # This key is omitted when it's false, so that the description of the other benchmarks doesn't change.
+        return self.benchmark_definition.get('use_clang_modules', False)
 
     def prepare(self):
-        pass
+        if self.use_clang_modules():
+            # Build the Fruit module in advance, so that we only measure the compilation of the source that imports it
+            # (as in an incremental build, where the module cache is already populated).
+            ensure_empty_dir(self.module_cache_dir)
+            self.compile()
 
     def run(self):
         start = timer()
+        self.compile()
+        end = timer()
+        return {"compile_time": end - start}
+
+    def compile(self):
         cxx_std = self.benchmark_definition['cxx_std']
         num_bindings = self.benchmark_definition['num_bindings']
         compiler_executable_name = self.benchmark_definition['compiler']
 
+        if self.use_clang_modules():
+            modules_flags = ['-fmodules', '-fmodules-cache-path=' + self.module_cache_dir]
+        else:
+            modules_flags = []
+
         run_command(compiler_executable_name,
-                    args = compile_flags + [
+                    args = compile_flags + modules_flags + [
                         '-std=%s' % cxx_std,
                         '-DMULTIPLIER=%s' % (num_bindings // 5),
                         '-I', self.fruit_sources_dir + '/include',
@@ -200,8 +432,6 @@ class FruitSingleFileCompileTimeBenchmark:
                         '-o',
                         '/dev/null',
                     ])
-        end = timer()
-        return {"compile_time": end - start}
 
     def describe(self):
         return self.benchmark_definition
@@ -216,21 +446,22 @@ def ensure_empty_dir(dirname):
 
 
 class GenericGeneratedSourcesBenchmark:
-    def __init__(self, di_library, benchmark_definition, fruit_sources_dir, fruit_build_tmpdir, path_to_code_under_test, **other_args):
+    def __init__(self, di_library, benchmark_definition, fruit_sources_dir, fruit_build_tmpdir, path_to_code_under_test, use_perf_stat=False, **other_args):
         self.di_library = di_library
+        self.use_perf_stat = use_perf_stat
         self.benchmark_definition = add_synthetic_benchmark_parameters(benchmark_definition, path_to_code_under_test=path_to_code_under_test)
         self.fruit_sources_dir = fruit_sources_dir
         self.fruit_build_tmpdir = fruit_build_tmpdir
         self.other_args = other_args
+        self.tmpdir = get_benchmark_work_dir(self.benchmark_definition)
 
     def prepare_compile_benchmark(self):
         num_classes = self.benchmark_definition['num_classes']
         cxx_std = self.benchmark_definition['cxx_std']
         compiler_executable_name = self.benchmark_definition['compiler']
 
-        self.tmpdir = tempfile.gettempdir() + '/fruit-benchmark-dir'
         ensure_empty_dir(self.tmpdir)
-        num_classes_with_no_deps = int(num_classes * 0.1)
+        num_classes_with_no_deps = self.get_num_classes_with_no_deps()
         generate_benchmark(
             compiler=compiler_executable_name,
             fruit_sources_dir=self.fruit_sources_dir,
@@ -241,38 +472,118 @@ class GenericGeneratedSourcesBenchmark:
             output_dir=self.tmpdir,
             cxx_std=cxx_std,
             di_library=self.di_library,
+            generator=self.get_generator(),
             **self.other_args)
 
-    def prepare_runtime_benchmark(self):
+    def get_num_classes_with_no_deps(self):
+        return int(self.benchmark_definition['num_classes'] * 0.1)
+
+    def get_generator(self):
+        # Either 'make' or 'ninja', see generate_benchmark().
+        return self.benchmark_definition.get('generator', 'make')
+
+    def build(self):
+        if self.get_generator() == 'ninja':
+            run_command('ninja', args=get_ninja_args(), cwd=self.tmpdir)
+        else:
+            run_command('make', args=get_make_args(), cwd=self.tmpdir)
+
+    def clean(self):
+        if self.get_generator() == 'ninja':
+            run_command('ninja', args=['-t', 'clean'], cwd=self.tmpdir)
+        else:
+            run_command('make', args=get_make_args() + ['clean'], cwd=self.tmpdir)
+
+    def build_executable(self):
         self.prepare_compile_benchmark()
-        run_command('make', args=make_args, cwd=self.tmpdir)
+        self.build()
+
+    def prepare_runtime_benchmark(self):
+        self.build_executable()
+        build_runtime_benchmark_helpers(self.benchmark_definition['compiler'], self.tmpdir)
+        measure_allocations(self.tmpdir + '/main', self.get_num_loops(), self.tmpdir)
 
     def prepare_executable_size_benchmark(self):
-        self.prepare_runtime_benchmark()
+        self.build_executable()
         run_command('strip', args=[self.tmpdir + '/main'])
 
     def run_compile_benchmark(self):
-        run_command('make',
-                    args=make_args + ['clean'],
-                    cwd=self.tmpdir)
+        self.clean()
         start = timer()
-        run_command('make',
-                    args=make_args,
-                    cwd=self.tmpdir)
+        self.build()
         end = timer()
         result = {'compile_time': end - start}
+        if self.get_generator() == 'ninja':
+            result.update(read_ninja_log(self.tmpdir, executable_name='main'))
         return result
 
-    def run_runtime_benchmark(self):
+    def get_num_loops(self):
         num_classes = self.benchmark_definition['num_classes']
         loop_factor = self.benchmark_definition['loop_factor']
+        # 10M loops with 100 classes, 1M with 1000
+        return int(1000 * 1000 * 1000 * loop_factor / num_classes)
 
-        results, _ = run_command(self.tmpdir + '/main',
-                                 args = [
-                                     # 10M loops with 100 classes, 1M with 1000
-                                     int(1000 * 1000 * 1000 * loop_factor / num_classes),
-                                 ])
-        return parse_results(results.splitlines())
+    def run_runtime_benchmark(self):
+        num_loops = self.get_num_loops()
+        results = run_runtime_benchmark_executable(self.tmpdir + '/main', num_requests=num_loops, use_perf_stat=self.use_perf_stat,
+                                                   work_dir=self.tmpdir)
+        results.update(read_allocation_results(self.tmpdir, num_requests=num_loops))
+        return results
+
+    def get_changed_component_index(self):
+        num_classes = self.benchmark_definition['num_classes']
+        num_classes_with_no_deps = self.get_num_classes_with_no_deps()
+        changed_component = self.benchmark_definition['changed_component']
+        # See generate_benchmark(): the components with no deps come first, then each component with deps depends on
+        # some of the previous ones, and the last one is the toplevel component (only included by main.cpp).
+        if changed_component == 'leaf':
+            return 0
+        elif changed_component == 'mid':
+            return num_classes_with_no_deps + (num_classes - num_classes_with_no_deps) // 2
+        elif changed_component == 'toplevel':
+            return num_classes - 1
+        else:
+            raise Exception('Unrecognized changed_component: %s' % changed_component)
+
+    def prepare_incremental_build_benchmark(self):
+        self.build_executable()
+
+    def run_incremental_build_benchmark(self, num_previous_runs):
+        component_index = self.get_changed_component_index()
+        change_kind = self.benchmark_definition['change_kind']
+        header = '%s/component%s.h' % (self.tmpdir, component_index)
+        source = '%s/component%s.cpp' % (self.tmpdir, component_index)
+        if change_kind == 'touch_header':
+            # This rebuilds all sources that (directly or transitively) include the header.
+            os.utime(header)
+        else:
+            # We remove the edit made in the previous run (if any) and make a different one, so that the source
+            # always changes. Each edit marker is on its own line.
+            with open(source, 'r') as f:
+                original_source = ''.join(line for line in f.readlines() if 'IncrementalBuildBenchmarkEdit' not in line)
+            if change_kind == 'body':
+                # This only changes the code of the component, not its bindings.
+                edited_source = original_source + 'int incrementalBuildBenchmarkEdit%s() { return %s; } // IncrementalBuildBenchmarkEdit\n' % (
+                    component_index, num_previous_runs)
+            elif change_kind == 'binding':
+                # This adds a binding to the component, so Fruit has to re-check the bindings of the component.
+                bind_expression = '        .bind<Interface%s, X%s>();\n' % (component_index, component_index)
+                getter_declaration = 'const fruit::Component<Interface%s>& getComponent%s() {\n' % (component_index, component_index)
+                assert bind_expression in original_source and getter_declaration in original_source
+                edit_type = 'IncrementalBuildBenchmarkEdit%s' % num_previous_runs
+                edited_source = original_source.replace(
+                    getter_declaration,
+                    'struct %s {};\n' % edit_type + getter_declaration).replace(
+                    bind_expression,
+                    '        .registerProvider([]() { return %s(); })\n' % edit_type + bind_expression)
+            else:
+                raise Exception('Unrecognized change_kind: %s' % change_kind)
+            with open(source, 'w') as f:
+                f.write(edited_source)
+        start = timer()
+        self.build()
+        end = timer()
+        return {'incremental_build_time': end - start}
 
     def run_executable_size_benchmark(self):
         wc_result, _ = run_command('wc', args=['-c', self.tmpdir + '/main'])
@@ -302,14 +613,44 @@ class FruitCompileTimeBenchmark:
         return self.generic_benchmark.describe()
 
 
-class FruitRunTimeBenchmark:
+class FruitIncrementalBuildTimeBenchmark:
+    """
+    Builds the generated codebase once, then measures the time to rebuild it after changing a single component: a leaf
+    component, a mid-level one or the toplevel one (changed_component) and touching its header, changing the code of
+    the component or changing its bindings (change_kind).
+    """
     def __init__(self, benchmark_definition, fruit_sources_dir, fruit_build_tmpdir):
         self.generic_benchmark = GenericGeneratedSourcesBenchmark(
             di_library='fruit',
             benchmark_definition=benchmark_definition,
             fruit_sources_dir=fruit_sources_dir,
             fruit_build_tmpdir=fruit_build_tmpdir,
-            path_to_code_under_test=fruit_sources_dir)
+            path_to_code_under_test=fruit_sources_dir,
+            # Otherwise touching a header wouldn't rebuild the components that include it.
+            generate_dep_files=True)
+        self.num_runs = 0
+
+    def prepare(self):
+        self.generic_benchmark.prepare_incremental_build_benchmark()
+
+    def run(self):
+        result = self.generic_benchmark.run_incremental_build_benchmark(num_previous_runs=self.num_runs)
+        self.num_runs += 1
+        return result
+
+    def describe(self):
+        return self.generic_benchmark.describe()
+
+
+class FruitRunTimeBenchmark:
+    def __init__(self, benchmark_definition, fruit_sources_dir, fruit_build_tmpdir, use_perf_stat=False):
+        self.generic_benchmark = GenericGeneratedSourcesBenchmark(
+            di_library='fruit',
+            benchmark_definition=benchmark_definition,
+            fruit_sources_dir=fruit_sources_dir,
+            fruit_build_tmpdir=fruit_build_tmpdir,
+            path_to_code_under_test=fruit_sources_dir,
+            use_perf_stat=use_perf_stat)
 
     def prepare(self):
         self.generic_benchmark.prepare_runtime_benchmark()
@@ -321,6 +662,107 @@ class FruitRunTimeBenchmark:
         return self.generic_benchmark.describe()
 
 
+def get_compile_commands(build_dir, generator):
+    """
+    Returns a dict {<source file>: <compile command, as a list of args>} with the commands that the build system
+    (`make` or `ninja`) would use to compile each source in build_dir.
+    """
+    if generator == 'ninja':
+        stdout, _ = run_command('ninja', args=['-t', 'commands'], cwd=build_dir)
+    else:
+        stdout, _ = run_command('make', args=['-n', '-B'], cwd=build_dir)
+    compile_commands = dict()
+    for line in stdout.splitlines():
+        args = shlex.split(line)
+        if '-c' in args:
+            compile_commands[args[args.index('-c') + 1]] = args
+    return compile_commands
+
+
+class FruitCompileProfileBenchmark:
+    """
+    Compiles each component*.cpp file of the generated codebase (one at a time) with Clang's -ftime-trace or GCC's
+    -ftime-report, and reports the average front-end, back-end and template instantiation time per translation unit.
+
+    With Clang, this also reports the time spent instantiating the most expensive fruit::impl::meta functions (as
+    'instantiation_time[<meta function>]' dimensions) and saves the most expensive instantiations to a JSON file in
+    profile_output_dir, so that a regression can be attributed to specific meta functions.
+    """
+    def __init__(self, benchmark_definition, fruit_sources_dir, fruit_build_tmpdir, profile_output_dir):
+        self.generic_benchmark = GenericGeneratedSourcesBenchmark(
+            di_library='fruit',
+            benchmark_definition=benchmark_definition,
+            fruit_sources_dir=fruit_sources_dir,
+            fruit_build_tmpdir=fruit_build_tmpdir,
+            path_to_code_under_test=fruit_sources_dir)
+        self.uses_clang = 'Clang' in self.describe()['compiler_name']
+        self.num_top_instantiations = self.describe().get('num_top_instantiations', 10)
+        self.profile_output_file = '%s/%s.json' % (
+            profile_output_dir, os.path.basename(get_benchmark_work_dir(self.describe())))
+        # The meta functions reported as dimensions. These are determined in the first run, so that all runs report
+        # the same dimensions.
+        self.profiled_meta_functions = None
+
+    def prepare(self):
+        self.generic_benchmark.prepare_compile_benchmark()
+
+    def profile_translation_unit(self, compile_command):
+        tmpdir = self.generic_benchmark.tmpdir
+        if self.uses_clang:
+            run_command(compile_command[0], args=compile_command[1:] + ['-ftime-trace'], cwd=tmpdir)
+            # Clang saves the trace next to the object file.
+            object_file = compile_command[compile_command.index('-o') + 1]
+            with open(tmpdir + '/' + os.path.splitext(object_file)[0] + '.json', 'r') as f:
+                return parse_clang_time_trace(f.read())
+        else:
+            _, stderr = run_command(compile_command[0], args=compile_command[1:] + ['-ftime-report'], cwd=tmpdir)
+            return parse_gcc_time_report(stderr)
+
+    def run(self):
+        profile_by_translation_unit = dict()
+        for source, compile_command in sorted(get_compile_commands(self.generic_benchmark.tmpdir,
+                                                                           self.generic_benchmark.get_generator()).items()):
+            if source.startswith('component'):
+                profile_by_translation_unit[source] = self.profile_translation_unit(compile_command)
+
+        profiles = profile_by_translation_unit.values()
+        num_translation_units = len(profiles)
+        result = {
+            'frontend_time_per_tu': sum(profile.frontend_time for profile in profiles) / num_translation_units,
+            'backend_time_per_tu': sum(profile.backend_time for profile in profiles) / num_translation_units,
+            'template_instantiation_time_per_tu':
+                sum(profile.template_instantiation_time for profile in profiles) / num_translation_units,
+        }
+        time_by_meta_function = get_instantiation_time_by_meta_function(profiles)
+        if self.uses_clang:
+            if self.profiled_meta_functions is None:
+                self.profiled_meta_functions = sorted(time_by_meta_function.keys(),
+                                                      key=lambda meta_function: time_by_meta_function[meta_function],
+                                                      reverse=True)[:self.num_top_instantiations]
+            for meta_function in self.profiled_meta_functions:
+                result['instantiation_time[%s]' % meta_function] = time_by_meta_function.get(meta_function, 0.0)
+
+        # This is overwritten in each run, so it contains the profile of the last run.
+        os.makedirs(os.path.dirname(self.profile_output_file), exist_ok=True)
+        with open(self.profile_output_file, 'w') as f:
+            json.dump({
+                'benchmark': self.describe(),
+                'translation_units': {
+                    source: {
+                        'frontend_time': profile.frontend_time,
+                        'backend_time': profile.backend_time,
+                        'template_instantiation_time': profile.template_instantiation_time,
+                    }
+                    for source, profile in profile_by_translation_unit.items()},
+                'instantiation_time_by_meta_function': time_by_meta_function,
+                'top_instantiations': get_top_instantiations(profile_by_translation_unit, self.num_top_instantiations),
+            }, f, indent=2, sort_keys=True)
+        return result
+
+    def describe(self):
+        return self.generic_benchmark.describe()
+
+
 # This is not really a 'benchmark', but we consider it as such to reuse the benchmark infrastructure.
 class FruitExecutableSizeBenchmark:
     def __init__(self, benchmark_definition, fruit_sources_dir, fruit_build_tmpdir):
@@ -362,14 +804,15 @@ class BoostDiCompileTimeBenchmark:
 
 
 class BoostDiRunTimeBenchmark:
-    def __init__(self, benchmark_definition, boost_di_sources_dir, fruit_sources_dir, fruit_build_tmpdir):
+    def __init__(self, benchmark_definition, boost_di_sources_dir, fruit_sources_dir, fruit_build_tmpdir, use_perf_stat=False):
         self.generic_benchmark = GenericGeneratedSourcesBenchmark(
             di_library='boost_di',
             benchmark_definition=benchmark_definition,
             boost_di_sources_dir=boost_di_sources_dir,
             fruit_sources_dir=fruit_sources_dir,
             fruit_build_tmpdir=fruit_build_tmpdir,
-            path_to_code_under_test=boost_di_sources_dir)
+            path_to_code_under_test=boost_di_sources_dir,
+            use_perf_stat=use_perf_stat)
 
     def prepare(self):
         self.generic_benchmark.prepare_runtime_benchmark()
@@ -410,26 +853,135 @@ def round_to_significant_digits(n, num_significant_digits):
     return round(n, num_significant_digits - int(floor(log10(n))) - 1)
 
 
-def run_benchmark(benchmark, max_runs, output_file, min_runs=3):
-    def run_benchmark_once():
-        print('Running benchmark... ', end='', flush=True)
-        result = benchmark.run()
-        print(result)
-        for dimension, value in result.items():
-            results_by_dimension[dimension] += [value]
-
-    results_by_dimension = defaultdict(lambda: [])
-    print('Preparing for benchmark... ', end='', flush=True)
-    benchmark.prepare()
-    print('Done.')
+def get_environment_info(cpus):
+    """
+    Returns information about the machine that can affect benchmark results. This is added to the 'benchmark' dict of
+    each result, with keys starting with 'env_' (these are ignored when comparing benchmark definitions).
+    """
+    governors = set()
+    for cpu in cpus:
+        try:
+            with open('/sys/devices/system/cpu/cpu%s/cpufreq/scaling_governor' % cpu, 'r') as f:
+                governors.add(f.read().strip())
+        except OSError:
+            pass
+    cpu_model = platform.processor()
+    try:
+        with open('/proc/cpuinfo', 'r') as f:
+            for line in f:
+                if line.startswith('model name'):
+                    cpu_model = line.split(':', 1)[1].strip()
+                    break
+    except OSError:
+        pass
+    return {
+        'env_cpu_governor': ','.join(sorted(governors)) if governors else 'unknown',
+        'env_kernel': '%s %s' % (platform.system(), platform.release()),
+        'env_cpu_model': cpu_model or 'unknown',
+    }
 
-    # Run at least min_runs times
-    for i in range(min_runs):
-        run_benchmark_once()
 
-    # Then consider running a few more times to get the desired precision.
+def get_busy_cpu_time(cpus):
+    """
+    Returns the total time (in seconds) that the given CPUs spent running something (i.e. not idle) since boot, or None
+    if this is not available (/proc/stat only exists on Linux).
+    """
+    try:
+        with open('/proc/stat', 'r') as f:
+            lines = f.readlines()
+    except OSError:
+        return None
+    cpu_names = {'cpu%s' % cpu for cpu in cpus}
+    busy_time = 0
+    for line in lines:
+        fields = line.split()
+        if fields and fields[0] in cpu_names:
+            times = [int(field) for field in fields[1:]]
+            # The 4th and 5th times are the idle and iowait times. Guest times are already included in the user time.
+            busy_time += sum(times[:8]) - times[3] - times[4]
+    return busy_time / os.sysconf('SC_CLK_TCK')
+
+
+def get_own_cpu_time():
+    """Returns the CPU time used so far by this process and by the child processes that it waited for."""
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+class ExternalLoadMeter:
+    """
+    Measures the average load (i.e. number of busy CPUs) caused by other processes on the CPUs that this process can
+    run on, over a time window. The CPU time used by this process and its children (e.g. the compilers run by the
+    benchmark) is subtracted, unlike in the load average reported by the OS.
+    """
+    def __init__(self):
+        self.cpus = get_available_cpus()
+        self.start()
+
+    def start(self):
+        self.start_time = timer()
+        self.start_busy_cpu_time = get_busy_cpu_time(self.cpus)
+        self.start_own_cpu_time = get_own_cpu_time()
+
+    def get_load(self):
+        """Returns the average load of other processes since start(), or None if it's not available."""
+        busy_cpu_time = get_busy_cpu_time(self.cpus)
+        if busy_cpu_time is None or self.start_busy_cpu_time is None:
+            return None
+        elapsed_time = timer() - self.start_time
+        other_cpu_time = (busy_cpu_time - self.start_busy_cpu_time) - (get_own_cpu_time() - self.start_own_cpu_time)
+        return max(other_cpu_time, 0.0) / elapsed_time
+
+
+def wait_for_low_load(max_load):
     while True:
-        for dimension, results in results_by_dimension.items():
+        load_meter = ExternalLoadMeter()
+        time.sleep(1)
+        load = load_meter.get_load()
+        if load is None:
+            # Fall back to the load average, that also includes our own processes (but we're not running any now).
+            load = os.getloadavg()[0]
+        if load <= max_load:
+            return
+        print('Not running the benchmark now, since the load (%.2f) is above the --max-load threshold (%s).' % (
+            load, max_load))
+        time.sleep(10)
+
+
+class BenchmarkSamples:
+    """The samples taken so far for a benchmark, see run_benchmark() and run_benchmarks_interleaved()."""
+    def __init__(self, benchmark):
+        self.benchmark = benchmark
+        self.results_by_dimension = defaultdict(lambda: [])
+        self.max_load_average = 0.0
+
+    def run_once(self, max_load):
+        # We don't keep samples taken while the machine was busy with something else, since they'd be biased.
+        while True:
+            if max_load is not None:
+                wait_for_low_load(max_load)
+            load_meter = ExternalLoadMeter()
+            print('Running benchmark... ', end='', flush=True)
+            result = self.benchmark.run()
+            load = load_meter.get_load()
+            print(result)
+            if load is None or max_load is None or load <= max_load:
+                break
+            # Note that the load is measured over the whole sample, so a short burst of load might not be detected.
+            print('Discarding this sample, since the load of other processes while it ran (%.2f) was above the --max-load threshold (%s).' % (
+                load, max_load))
+        if load is None:
+            load = os.getloadavg()[0]
+        self.max_load_average = max(self.max_load_average, load)
+        for dimension, value in result.items():
+            self.results_by_dimension[dimension] += [value]
+
+    def num_runs(self):
+        return max([len(results) for results in self.results_by_dimension.values()], default=0)
+
+    def needs_more_runs(self, max_runs):
+        """Returns True if more runs are needed to get the desired precision in all dimensions."""
+        for dimension, results in self.results_by_dimension.items():
             if all(result == results[0] for result in results):
                 # If all results are exactly the same the code below misbehaves. We don't need to run again in this case.
                 continue
@@ -440,28 +992,69 @@ def run_benchmark(benchmark, max_runs, output_file, min_runs=3):
                 if len(results) < max_runs:
                     print("Running again to get more precision on the metric %s. Current confidence interval: [%.3g, %.3g]" % (
                     dimension, confidence_interval[0], confidence_interval[1]))
-                    break
+                    return True
                 else:
                     print("Warning: couldn't determine a precise result for the metric %s. Confidence interval: [%.3g, %.3g]" % (
                     dimension, confidence_interval[0], confidence_interval[1]))
-        else:
-            # We've reached sufficient precision in all metrics, or we've reached the max number of runs.
-            break
+        # We've reached sufficient precision in all metrics, or we've reached the max number of runs.
+        return False
+
+    def record_results(self, results_store, environment_info):
+        confidence_interval_by_dimension = {}
+        for dimension, results in self.results_by_dimension.items():
+            confidence_interval = stats.DescrStatsW(results).tconfint_mean(0.05)
+            confidence_interval = (round_to_significant_digits(confidence_interval[0], 2),
+                                   round_to_significant_digits(confidence_interval[1], 2))
+            confidence_interval_by_dimension[dimension] = confidence_interval
+        benchmark_description = dict(self.benchmark.describe(), **environment_info)
+        benchmark_description['env_load_average'] = round(self.max_load_average, 2)
+        results_store.add_result(benchmark_description, confidence_interval_by_dimension,
+                                 samples_by_dimension=self.results_by_dimension)
+        print('Benchmark finished. Result: ', confidence_interval_by_dimension)
+        print()
+
+
+def run_benchmark(benchmark, max_runs, results_store, environment_info, min_runs=3, prepare_future=None, max_load=None):
+    samples = BenchmarkSamples(benchmark)
+    print('Preparing for benchmark... ', end='', flush=True)
+    if prepare_future is None:
+        benchmark.prepare()
+    else:
+        # The benchmark was prepared in the preparation pool, wait until that's done.
+        prepare_future.result()
+    print('Done.')
+
+    # Run at least min_runs times
+    for i in range(min_runs):
+        samples.run_once(max_load)
 
-        run_benchmark_once()
+    # Then consider running a few more times to get the desired precision.
+    while samples.needs_more_runs(max_runs):
+        samples.run_once(max_load)
 
     # We've reached the desired precision in all dimensions or reached the maximum number of runs. Record the results.
-    confidence_interval_by_dimension = {}
-    for dimension, results in results_by_dimension.items():
-        confidence_interval = stats.DescrStatsW(results).tconfint_mean(0.05)
-        confidence_interval = (round_to_significant_digits(confidence_interval[0], 2),
-                               round_to_significant_digits(confidence_interval[1], 2))
-        confidence_interval_by_dimension[dimension] = confidence_interval
-    with open(output_file, 'a') as f:
-        json.dump({"benchmark": benchmark.describe(), "results": confidence_interval_by_dimension}, f)
-        print(file=f)
-    print('Benchmark finished. Result: ', confidence_interval_by_dimension)
-    print()
+    samples.record_results(results_store, environment_info)
+
+
+def run_benchmarks_interleaved(benchmarks, max_runs, results_store, environment_info, min_runs=3, max_load=None):
+    """
+    Like run_benchmark(), but for multiple (already prepared) benchmarks at once. Instead of taking all the samples of
+    a benchmark one after the other, this runs one sample of each benchmark (in a random order) in each round, so that
+    e.g. thermal drift or some background load affect all benchmarks in the same way instead of biasing some of them.
+    """
+    pending_samples = [BenchmarkSamples(benchmark) for benchmark in benchmarks]
+    while pending_samples:
+        for samples in random.sample(pending_samples, len(pending_samples)):
+            print('%s: ' % samples.benchmark.describe(), end='')
+            samples.run_once(max_load)
+        still_pending_samples = []
+        for samples in pending_samples:
+            if samples.num_runs() < min_runs or samples.needs_more_runs(max_runs):
+                still_pending_samples.append(samples)
+            else:
+                samples.record_results(results_store, environment_info)
+                shutil.rmtree(get_benchmark_work_dir(samples.benchmark.describe()), ignore_errors=True)
+        pending_samples = still_pending_samples
 
 
 def expand_benchmark_definition(benchmark_definition):
@@ -498,6 +1091,84 @@ def group_by(l, element_to_key):
         result[element_to_key(elem)].append(elem)
     return result.items()
 
+def create_benchmark(benchmark_definition, args, fruit_build_tmpdir):
+    benchmark_name = benchmark_definition['name']
+
+    if (benchmark_name in {'boost_di_compile_time', 'boost_di_run_time', 'boost_di_executable_size'}
+        and args.boost_di_sources_dir is None):
+        raise Exception('Error: you need to specify the --boost-di-sources-dir flag in order to run Boost.DI benchmarks.')
+
+    if benchmark_name == 'new_delete_run_time':
+        return NewDeleteRunTimeBenchmark(
+            benchmark_definition,
+            fruit_benchmark_sources_dir=args.fruit_benchmark_sources_dir,
+            use_perf_stat=args.perf_stat)
+    elif benchmark_name == 'fruit_single_file_compile_time':
+        return FruitSingleFileCompileTimeBenchmark(
+            benchmark_definition,
+            fruit_sources_dir=args.fruit_sources_dir,
+            fruit_benchmark_sources_dir=args.fruit_benchmark_sources_dir,
+            fruit_build_tmpdir=fruit_build_tmpdir)
+    elif benchmark_name == 'fruit_compile_time':
+        return FruitCompileTimeBenchmark(
+            benchmark_definition,
+            fruit_sources_dir=args.fruit_sources_dir,
+            fruit_build_tmpdir=fruit_build_tmpdir)
+    elif benchmark_name == 'fruit_incremental_build_time':
+        return FruitIncrementalBuildTimeBenchmark(
+            benchmark_definition,
+            fruit_sources_dir=args.fruit_sources_dir,
+            fruit_build_tmpdir=fruit_build_tmpdir)
+    elif benchmark_name == 'fruit_run_time':
+        return FruitRunTimeBenchmark(
+            benchmark_definition,
+            fruit_sources_dir=args.fruit_sources_dir,
+            fruit_build_tmpdir=fruit_build_tmpdir,
+            use_perf_stat=args.perf_stat)
+    elif benchmark_name == 'fruit_compile_profile':
+        return FruitCompileProfileBenchmark(
+            benchmark_definition,
+            fruit_sources_dir=args.fruit_sources_dir,
+            fruit_build_tmpdir=fruit_build_tmpdir,
+            profile_output_dir=args.compile_profile_dir or os.path.splitext(args.output_file)[0] + '-compile-profiles')
+    elif benchmark_name == 'fruit_executable_size':
+        return FruitExecutableSizeBenchmark(
+            benchmark_definition,
+            fruit_sources_dir=args.fruit_sources_dir,
+            fruit_build_tmpdir=fruit_build_tmpdir)
+    elif benchmark_name == 'boost_di_compile_time':
+        return BoostDiCompileTimeBenchmark(
+            benchmark_definition,
+            fruit_sources_dir=args.fruit_sources_dir,
+            fruit_build_tmpdir=fruit_build_tmpdir,
+            boost_di_sources_dir=args.boost_di_sources_dir)
+    elif benchmark_name == 'boost_di_run_time':
+        return BoostDiRunTimeBenchmark(
+            benchmark_definition,
+            fruit_sources_dir=args.fruit_sources_dir,
+            fruit_build_tmpdir=fruit_build_tmpdir,
+            boost_di_sources_dir=args.boost_di_sources_dir,
+            use_perf_stat=args.perf_stat)
+    elif benchmark_name == 'boost_di_executable_size':
+        return BoostDiExecutableSizeBenchmark(
+            benchmark_definition,
+            fruit_sources_dir=args.fruit_sources_dir,
+            fruit_build_tmpdir=fruit_build_tmpdir,
+            boost_di_sources_dir=args.boost_di_sources_dir)
+    else:
+        raise Exception("Unrecognized benchmark: %s" % benchmark_name)
+
+
+def prepare_benchmark(benchmark):
+    # This runs in a process of the preparation pool.
+    benchmark.prepare()
+
+
+def pin_to_cpus(cpus):
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+
+
 def main():
     # This configures numpy/scipy to raise an exception in case of errors, instead of printing a warning and going ahead.
     numpy.seterr(all='raise')
@@ -508,21 +1179,57 @@ def main():
     parser.add_argument('--fruit-sources-dir', help='Path to the fruit sources')
     parser.add_argument('--boost-di-sources-dir', help='Path to the Boost.DI sources')
     parser.add_argument('--output-file',
-                        help='The output file where benchmark results will be stored (1 per line, with each line in JSON format). These can then be formatted by e.g. the format_bench_results script.')
+                        help='The output file where benchmark results will be stored (a SQLite database, see benchmark_results_store.py). These can then be formatted by e.g. the format_bench_results script.')
     parser.add_argument('--benchmark-definition', help='The YAML file that defines the benchmarks (see fruit_wiki_benchs_fruit.yml for an example).')
     parser.add_argument('--continue-benchmark', help='If this is \'true\', continues a previous benchmark run instead of starting from scratch (taking into account the existing benchmark results in the file specified with --output-file).')
+    parser.add_argument('--prepare-jobs', type=int, default=0,
+                        help='The number of processes that prepare the next benchmarks (e.g. generating and building sources) while a benchmark is being measured. By default, each benchmark is prepared just before measuring it.')
+    parser.add_argument('--measurement-cpus',
+                        help='A comma-separated list of CPUs reserved for running benchmark measurements, e.g. "2,3". Benchmarks are prepared on the other CPUs. This defaults to all CPUs except the first N, with --prepare-jobs=N.')
+    parser.add_argument('--fruit-build-cache-dir', default=tempfile.gettempdir() + '/fruit-benchmark-build-cache',
+                        help='The directory where Fruit builds are cached, so that they can be reused by later benchmark runs.')
+    parser.add_argument('--interleave-samples', action='store_true',
+                        help='Prepare all benchmarks first, then measure them in rounds, running one sample of each benchmark (in a random order) in each round, instead of running all samples of a benchmark one after the other.')
+    parser.add_argument('--min-runs', type=int, default=3,
+                        help='The minimum number of samples of each benchmark (more are taken if needed to get the desired precision, up to the max_runs in the benchmark definition). Results compared with compare_bench_results.py need at least 4 samples with the default significance level (0.05).')
+    parser.add_argument('--max-load', type=float,
+                        help='Don\'t take samples while other processes are keeping more than this number of CPUs busy (on average, on the CPUs used for measurements); wait for them to finish instead. Samples during which the load of other processes went above this value are discarded and taken again.')
+    parser.add_argument('--perf-stat', action='store_true',
+                        help='Run the run-time benchmarks under `perf stat`, adding the instructions, cycles, cache misses, branch misses and page faults per request as result dimensions.')
+    parser.add_argument('--compile-profile-dir',
+                        help='The directory where the fruit_compile_profile benchmarks save the details of their profiles (e.g. the most expensive template instantiations) as JSON files. Defaults to a directory next to the --output-file.')
     args = parser.parse_args()
 
     if args.output_file is None:
         raise Exception('You must specify --output_file')
-    if args.continue_benchmark == 'true':
-        with open(args.output_file, 'r') as f:
-            previous_run_completed_benchmarks = [json.loads(line)['benchmark'] for line in f.readlines()]
-    else:
-        previous_run_completed_benchmarks = []
+    if args.continue_benchmark != 'true':
         run_command('rm', args=['-f', args.output_file])
-
-    fruit_build_tmpdir = tempfile.gettempdir() + '/fruit-benchmark-build-dir'
+    elif os.path.exists(args.output_file) and os.path.getsize(args.output_file) > 0 \
+            and not is_benchmark_results_store(args.output_file):
+        # The results of a run of an older version of this script, in the JSON-lines format. We convert them so that
+        # the benchmarks that already have a result are skipped, keeping the original file as a backup.
+        jsonl_backup_file = args.output_file + '.jsonl.bak'
+        os.rename(args.output_file, jsonl_backup_file)
+        with BenchmarkResultsStore(args.output_file) as results_store:
+            results_store.import_jsonl(jsonl_backup_file)
+        print('Converted the JSON-lines results in %s to the SQLite format (the original file was moved to %s).' % (
+            args.output_file, jsonl_backup_file))
+    results_store = BenchmarkResultsStore(args.output_file)
+
+    available_cpus = get_available_cpus()
+    if args.measurement_cpus:
+        measurement_cpus = [int(cpu) for cpu in args.measurement_cpus.split(',')]
+    else:
+        measurement_cpus = available_cpus[args.prepare_jobs:]
+    preparation_cpus = [cpu for cpu in available_cpus if cpu not in measurement_cpus]
+    if args.prepare_jobs > 0 and (not measurement_cpus or not preparation_cpus):
+        raise Exception('With --prepare-jobs, there must be at least one CPU for measurements and one for preparing benchmarks. Measurement CPUs: %s, preparation CPUs: %s' % (
+            measurement_cpus, preparation_cpus))
+    if args.prepare_jobs > 0 or args.measurement_cpus:
+        # Measurements (and everything else that runs in this process, e.g. building Fruit) only run on the measurement
+        # CPUs, so they never share a CPU with the preparation of other benchmarks.
+        pin_to_cpus(measurement_cpus)
+    environment_info = get_environment_info(measurement_cpus)
 
     with open(args.benchmark_definition, 'r') as f:
         yaml_file_content = yaml.load(f)
@@ -530,6 +1237,7 @@ def main():
         benchmark_definitions = expand_benchmark_definitions(yaml_file_content['benchmarks'])
 
     benchmark_index = 0
+    benchmarks_to_interleave = []
 
     for (compiler_executable_name, additional_cmake_args), benchmark_definitions_with_current_config \
             in group_by(benchmark_definitions,
@@ -541,81 +1249,68 @@ def main():
         # value instantly.
         determine_compiler_name(compiler_executable_name)
 
-        # Build Fruit in fruit_build_tmpdir, so that fruit_build_tmpdir points to a built Fruit (useful for e.g. the config header).
-        shutil.rmtree(fruit_build_tmpdir, ignore_errors=True)
-        os.makedirs(fruit_build_tmpdir)
-        modified_env = os.environ.copy()
-        modified_env['CXX'] = compiler_executable_name
-        run_command('cmake',
-                    args=[
-                        args.fruit_sources_dir,
-                        '-DCMAKE_BUILD_TYPE=Release',
-                        *additional_cmake_args,
-                    ],
-                    cwd=fruit_build_tmpdir,
-                    env=modified_env)
-        run_command('make', args=make_args, cwd=fruit_build_tmpdir)
+        # fruit_build_tmpdir points to a built Fruit (useful for e.g. the config header).
+        fruit_build_tmpdir = build_fruit(args.fruit_sources_dir, compiler_executable_name, additional_cmake_args,
+                                         fruit_build_cache_dir=args.fruit_build_cache_dir)
 
+        benchmarks = []
         for benchmark_definition in benchmark_definitions_with_current_config:
             benchmark_index += 1
-            print('%s/%s: %s' % (benchmark_index, len(benchmark_definitions), benchmark_definition))
-            benchmark_name = benchmark_definition['name']
-
-            if (benchmark_name in {'boost_di_compile_time', 'boost_di_run_time', 'boost_di_executable_size'}
-                and args.boost_di_sources_dir is None):
-                raise Exception('Error: you need to specify the --boost-di-sources-dir flag in order to run Boost.DI benchmarks.')
-
-            if benchmark_name == 'new_delete_run_time':
-                benchmark = NewDeleteRunTimeBenchmark(
-                    benchmark_definition,
-                    fruit_benchmark_sources_dir=args.fruit_benchmark_sources_dir)
-            elif benchmark_name == 'fruit_single_file_compile_time':
-                benchmark = FruitSingleFileCompileTimeBenchmark(
-                    benchmark_definition,
-                    fruit_sources_dir=args.fruit_sources_dir,
-                    fruit_benchmark_sources_dir=args.fruit_benchmark_sources_dir,
-                    fruit_build_tmpdir=fruit_build_tmpdir)
-            elif benchmark_name == 'fruit_compile_time':
-                benchmark = FruitCompileTimeBenchmark(
-                    benchmark_definition,
-                    fruit_sources_dir=args.fruit_sources_dir,
-                    fruit_build_tmpdir=fruit_build_tmpdir)
-            elif benchmark_name == 'fruit_run_time':
-                benchmark = FruitRunTimeBenchmark(
-                    benchmark_definition,
-                    fruit_sources_dir=args.fruit_sources_dir,
-                    fruit_build_tmpdir=fruit_build_tmpdir)
-            elif benchmark_name == 'fruit_executable_size':
-                benchmark = FruitExecutableSizeBenchmark(
-                    benchmark_definition,
-                    fruit_sources_dir=args.fruit_sources_dir,
-                    fruit_build_tmpdir=fruit_build_tmpdir)
-            elif benchmark_name == 'boost_di_compile_time':
-                benchmark = BoostDiCompileTimeBenchmark(
-                    benchmark_definition,
-                    fruit_sources_dir=args.fruit_sources_dir,
-                    fruit_build_tmpdir=fruit_build_tmpdir,
-                    boost_di_sources_dir=args.boost_di_sources_dir)
-            elif benchmark_name == 'boost_di_run_time':
-                benchmark = BoostDiRunTimeBenchmark(
-                    benchmark_definition,
-                    fruit_sources_dir=args.fruit_sources_dir,
-                    fruit_build_tmpdir=fruit_build_tmpdir,
-                    boost_di_sources_dir=args.boost_di_sources_dir)
-            elif benchmark_name == 'boost_di_executable_size':
-                benchmark = BoostDiExecutableSizeBenchmark(
-                    benchmark_definition,
-                    fruit_sources_dir=args.fruit_sources_dir,
-                    fruit_build_tmpdir=fruit_build_tmpdir,
-                    boost_di_sources_dir=args.boost_di_sources_dir)
-            else:
-                raise Exception("Unrecognized benchmark: %s" % benchmark_name)
-
-            if benchmark.describe() in previous_run_completed_benchmarks:
+            benchmark = create_benchmark(benchmark_definition, args, fruit_build_tmpdir)
+            if results_store.has_result(benchmark.describe()):
                 print("Skipping benchmark that was already run previously (due to --continue-benchmark):", benchmark.describe())
                 continue
-
-            run_benchmark(benchmark, output_file=args.output_file, max_runs=global_definitions['max_runs'])
+            benchmarks.append((benchmark_index, benchmark))
+
+        if args.interleave_samples:
+            # These are prepared and run below, once the Fruit builds for all compilers are ready.
+            benchmarks_to_interleave += [benchmark for _, benchmark in benchmarks]
+            continue
+
+        # With --prepare-jobs, the next benchmarks are prepared in a process pool (on the preparation CPUs) while the
+        # current one is measured (on the measurement CPUs). Only a few benchmarks are prepared in advance, since each
+        # of them takes space in its work directory until it's measured.
+        if args.prepare_jobs > 0:
+            preparation_pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=args.prepare_jobs, initializer=pin_to_cpus, initargs=(preparation_cpus,))
+        else:
+            preparation_pool = None
+        prepare_futures = dict()
+
+        def submit_preparation(i):
+            if preparation_pool is not None and i < len(benchmarks):
+                prepare_futures[i] = preparation_pool.submit(prepare_benchmark, benchmarks[i][1])
+
+        try:
+            for i in range(args.prepare_jobs):
+                submit_preparation(i)
+            for i, (benchmark_index, benchmark) in enumerate(benchmarks):
+                submit_preparation(i + args.prepare_jobs)
+                print('%s/%s: %s' % (benchmark_index, len(benchmark_definitions), benchmark.describe()))
+                run_benchmark(benchmark, results_store=results_store, max_runs=global_definitions['max_runs'],
+                              environment_info=environment_info, prepare_future=prepare_futures.pop(i, None),
+                              min_runs=args.min_runs, max_load=args.max_load)
+                shutil.rmtree(get_benchmark_work_dir(benchmark.describe()), ignore_errors=True)
+        finally:
+            if preparation_pool is not None:
+                for future in prepare_futures.values():
+                    future.cancel()
+                preparation_pool.shutdown()
+
+    if benchmarks_to_interleave:
+        print('Preparing %s benchmarks... ' % len(benchmarks_to_interleave), end='', flush=True)
+        if args.prepare_jobs > 0:
+            with concurrent.futures.ProcessPoolExecutor(
+                    max_workers=args.prepare_jobs, initializer=pin_to_cpus, initargs=(preparation_cpus,)) as preparation_pool:
+                for future in [preparation_pool.submit(prepare_benchmark, benchmark) for benchmark in benchmarks_to_interleave]:
+                    future.result()
+        else:
+            for benchmark in benchmarks_to_interleave:
+                benchmark.prepare()
+        print('Done.')
+        run_benchmarks_interleaved(benchmarks_to_interleave, results_store=results_store,
+                                   max_runs=global_definitions['max_runs'], environment_info=environment_info,
+                                   min_runs=args.min_runs, max_load=args.max_load)
 
 
 if __name__ == "__main__":
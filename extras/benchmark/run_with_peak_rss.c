@@ -0,0 +1,74 @@
+/*
+ * Copyright 2014 Google Inc. All rights reserved.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+// Usage: run_with_peak_rss <output file> <command> [<args>...]
+//
+// Runs the command and then writes its peak RSS (in bytes) to the output file. This exits with the same exit code as
+// the command.
+//
+// run_benchmarks.py uses this instead of calling os.wait4() on the command directly because the peak RSS of a process
+// also accounts for the process that it was forked from (up to the exec()), so a command forked from the Python
+// process would have a peak RSS at least as large as that of the Python process.
+
+#include <stdio.h>
+#include <sys/resource.h>
+#include <sys/types.h>
+#include <sys/wait.h>
+#include <unistd.h>
+
+int main(int argc, char* argv[]) {
+  if (argc < 3) {
+    fprintf(stderr, "Usage: %s <output file> <command> [<args>...]\n", argv[0]);
+    return 1;
+  }
+
+  pid_t pid = fork();
+  if (pid < 0) {
+    perror("fork");
+    return 1;
+  }
+  if (pid == 0) {
+    execvp(argv[2], argv + 2);
+    perror(argv[2]);
+    _exit(127);
+  }
+
+  int status;
+  struct rusage usage;
+  if (wait4(pid, &status, 0, &usage) < 0) {
+    perror("wait4");
+    return 1;
+  }
+
+  FILE* file = fopen(argv[1], "w");
+  if (file == NULL) {
+    perror(argv[1]);
+    return 1;
+  }
+#ifdef __APPLE__
+  // On macOS ru_maxrss is in bytes.
+  fprintf(file, "%ld\n", (long)usage.ru_maxrss);
+#else
+  // Elsewhere it's in kilobytes.
+  fprintf(file, "%ld\n", (long)usage.ru_maxrss * 1024);
+#endif
+  fclose(file);
+
+  if (WIFSIGNALED(status)) {
+    return 128 + WTERMSIG(status);
+  }
+  return WEXITSTATUS(status);
+}
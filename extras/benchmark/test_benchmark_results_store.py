@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+#  Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+
+from benchmark_results_store import BenchmarkResultsStore, is_benchmark_results_store, load_benchmark_results
+
+SINGLE_FILE_BENCHMARK = {
+    'name': 'fruit_single_file_compile_time',
+    'num_bindings': 20,
+    'compiler': 'g++',
+    'additional_cmake_args': [],
+    'env_load_average': 0.5,
+}
+
+MODULES_BENCHMARK = dict(SINGLE_FILE_BENCHMARK, use_clang_modules=True)
+
+RUN_TIME_BENCHMARK = {
+    'name': 'fruit_run_time',
+    'num_classes': 100,
+    'compiler': 'g++',
+    'additional_cmake_args': ['-DFRUIT_USES_BOOST=False'],
+}
+
+def test_add_result_and_get_results():
+    with BenchmarkResultsStore(':memory:') as store:
+        store.add_result(SINGLE_FILE_BENCHMARK, {'compile_time': [1.5, 1.7]}, {'compile_time': [1.6, 1.5, 1.7]})
+        assert store.get_results() == [
+            {'benchmark': SINGLE_FILE_BENCHMARK, 'results': {'compile_time': [1.5, 1.7]}},
+        ]
+        assert store.get_samples(SINGLE_FILE_BENCHMARK) == {'compile_time': [1.6, 1.5, 1.7]}
+        assert store.has_result(SINGLE_FILE_BENCHMARK)
+        assert not store.has_result(RUN_TIME_BENCHMARK)
+
+def test_add_result_replaces_the_result_of_the_same_benchmark_ignoring_env_keys():
+    with BenchmarkResultsStore(':memory:') as store:
+        store.add_result(SINGLE_FILE_BENCHMARK, {'compile_time': [1.5, 1.7]}, {'compile_time': [1.6, 1.5, 1.7]})
+        new_benchmark_description = dict(SINGLE_FILE_BENCHMARK, env_load_average=0.1)
+        store.add_result(new_benchmark_description, {'compile_time': [2.0, 2.1]}, {'compile_time': [2.0, 2.1]})
+        assert store.get_results() == [
+            {'benchmark': new_benchmark_description, 'results': {'compile_time': [2.0, 2.1]}},
+        ]
+        assert store.get_samples(SINGLE_FILE_BENCHMARK) == {'compile_time': [2.0, 2.1]}
+
+def test_get_results_with_fixed_benchmark_params():
+    with BenchmarkResultsStore(':memory:') as store:
+        store.add_result(SINGLE_FILE_BENCHMARK, {'compile_time': [1.5, 1.7]})
+        store.add_result(MODULES_BENCHMARK, {'compile_time': [0.5, 0.7]})
+        store.add_result(RUN_TIME_BENCHMARK, {'Total per request': [3.0, 3.5]})
+
+        def get_names(fixed_benchmark_params={}, result_dimension=None):
+            return [(bench_result['benchmark']['name'], bench_result['benchmark'].get('use_clang_modules'))
+                    for bench_result in store.get_results(fixed_benchmark_params, result_dimension)]
+
+        assert get_names({'compiler': 'g++'}) == [
+            ('fruit_single_file_compile_time', None),
+            ('fruit_single_file_compile_time', True),
+            ('fruit_run_time', None),
+        ]
+        assert get_names({'name': 'fruit_single_file_compile_time', 'use_clang_modules': True}) == [
+            ('fruit_single_file_compile_time', True),
+        ]
+        # None matches the benchmarks that don't have the param.
+        assert get_names({'name': 'fruit_single_file_compile_time', 'use_clang_modules': None}) == [
+            ('fruit_single_file_compile_time', None),
+        ]
+        # Tuples (as returned by format_bench_results.make_immutable()) match lists.
+        assert get_names({'additional_cmake_args': ('-DFRUIT_USES_BOOST=False',)}) == [('fruit_run_time', None)]
+        assert get_names(result_dimension='Total per request') == [('fruit_run_time', None)]
+        assert get_names({'num_bindings': 20}, result_dimension='Total per request') == []
+
+def test_jsonl_round_trip(tmp_path):
+    bench_results = [
+        {'benchmark': SINGLE_FILE_BENCHMARK, 'results': {'compile_time': [1.5, 1.7]}},
+        {'benchmark': RUN_TIME_BENCHMARK, 'results': {'Total per request': [3.0, 3.5], 'num_bytes': [8000.0, 8000.0]}},
+    ]
+    input_file_name = str(tmp_path / 'input.jsonl')
+    with open(input_file_name, 'w') as f:
+        for bench_result in bench_results:
+            print(json.dumps(bench_result), file=f)
+        # Empty lines are ignored.
+        print(file=f)
+
+    db_file_name = str(tmp_path / 'results.db')
+    with BenchmarkResultsStore(db_file_name) as store:
+        store.import_jsonl(input_file_name)
+    assert is_benchmark_results_store(db_file_name)
+    assert not is_benchmark_results_store(input_file_name)
+
+    output_file_name = str(tmp_path / 'output.jsonl')
+    with BenchmarkResultsStore(db_file_name) as store:
+        # There are no raw samples in the JSON-lines format.
+        assert store.get_samples(SINGLE_FILE_BENCHMARK) == {}
+        store.export_jsonl(output_file_name)
+    with open(output_file_name, 'r') as f:
+        assert [json.loads(line) for line in f] == bench_results
+
+def test_load_benchmark_results(tmp_path):
+    db_file_name = str(tmp_path / 'results.db')
+    with BenchmarkResultsStore(db_file_name) as store:
+        store.add_result(SINGLE_FILE_BENCHMARK, {'compile_time': [1.5, 1.7]}, {'compile_time': [1.6, 1.5, 1.7]})
+    jsonl_file_name = str(tmp_path / 'results.jsonl')
+    with open(jsonl_file_name, 'w') as f:
+        print(json.dumps({'benchmark': RUN_TIME_BENCHMARK, 'results': {'Total per request': [3.0, 3.5]}}), file=f)
+
+    with load_benchmark_results(db_file_name) as store:
+        assert [bench_result['benchmark'] for bench_result in store.get_results()] == [SINGLE_FILE_BENCHMARK]
+        assert store.get_samples(SINGLE_FILE_BENCHMARK) == {'compile_time': [1.6, 1.5, 1.7]}
+    with load_benchmark_results(jsonl_file_name) as store:
+        assert [bench_result['benchmark'] for bench_result in store.get_results()] == [RUN_TIME_BENCHMARK]
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+#  Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+from benchmark_results_store import BenchmarkResultsStore
+from compare_bench_results import compare_results, get_min_num_samples, get_min_p_value
+
+THRESHOLDS_DEFINITION = {
+    'significance_level': 0.05,
+    'metrics': {
+        'compile_time': {
+            'max_relative_change': 0.05,
+            'min_effect_size': 0.5,
+        },
+        'num_bytes': {
+            'max_relative_change': 0.01,
+        },
+    },
+}
+
+def make_benchmark_description(git_commit_hash, **kwargs):
+    return dict({
+        'name': 'fruit_compile_time',
+        'num_classes': 100,
+        'compiler': 'g++',
+        'compiler_name': 'GCC 12.2.0',
+        'di_library_git_commit_hash': git_commit_hash,
+        'env_load_average': 0.5,
+    }, **kwargs)
+
+def make_store(samples_by_dimension, git_commit_hash, **kwargs):
+    store = BenchmarkResultsStore(':memory:')
+    store.add_result(make_benchmark_description(git_commit_hash, **kwargs),
+                     {dimension: [min(samples), max(samples)] for dimension, samples in samples_by_dimension.items()},
+                     samples_by_dimension)
+    return store
+
+def compare_samples_by_dimension(baseline_samples_by_dimension, current_samples_by_dimension):
+    with make_store(baseline_samples_by_dimension, git_commit_hash='aaaa') as baseline_store, \
+            make_store(current_samples_by_dimension, git_commit_hash='bbbb') as current_store:
+        return compare_results(baseline_store, current_store, THRESHOLDS_DEFINITION)
+
+@pytest.mark.parametrize('significance_level,expected_min_num_samples', [
+    (0.1, 4),
+    (0.05, 4),
+    (0.01, 5),
+])
+def test_get_min_num_samples(significance_level, expected_min_num_samples):
+    assert get_min_num_samples(significance_level) == expected_min_num_samples
+
+def test_get_min_p_value():
+    assert get_min_p_value(3, 3) == pytest.approx(0.1)
+    assert get_min_p_value(4, 4) == pytest.approx(2 / 70)
+
+def test_benchmarks_of_different_commits_are_paired():
+    comparisons, errors = compare_samples_by_dimension(
+        {'compile_time': [10.0, 10.1, 9.9, 10.0, 10.05]},
+        {'compile_time': [10.02, 10.08, 9.95, 10.01, 10.03]})
+    assert errors == []
+    [comparison] = comparisons
+    assert comparison.dimension == 'compile_time'
+    assert comparison.benchmark_description['di_library_git_commit_hash'] == 'bbbb'
+    assert not comparison.is_regression
+    assert not comparison.is_improvement
+    assert not comparison.has_insufficient_samples
+
+def test_regression():
+    comparisons, errors = compare_samples_by_dimension(
+        {'compile_time': [10.0, 10.1, 9.9, 10.0, 10.05]},
+        {'compile_time': [12.0, 12.1, 11.9, 12.2, 12.05]})
+    assert errors == []
+    [comparison] = comparisons
+    assert comparison.is_regression
+    assert not comparison.is_improvement
+    assert comparison.relative_change == pytest.approx(0.2, abs=0.01)
+    assert comparison.effect_size == 1.0
+    assert comparison.p_value < 0.05
+
+def test_improvement():
+    comparisons, errors = compare_samples_by_dimension(
+        {'compile_time': [12.0, 12.1, 11.9, 12.2, 12.05]},
+        {'compile_time': [10.0, 10.1, 9.9, 10.0, 10.05]})
+    assert errors == []
+    [comparison] = comparisons
+    assert not comparison.is_regression
+    assert comparison.is_improvement
+
+def test_significant_change_below_max_relative_change_is_not_a_regression():
+    comparisons, errors = compare_samples_by_dimension(
+        {'compile_time': [10.0, 10.01, 10.02, 10.03, 10.04]},
+        {'compile_time': [10.2, 10.21, 10.22, 10.23, 10.24]})
+    assert errors == []
+    [comparison] = comparisons
+    assert comparison.p_value < 0.05
+    assert comparison.relative_change == pytest.approx(0.02, abs=0.001)
+    assert not comparison.is_regression
+
+def test_insufficient_samples():
+    comparisons, errors = compare_samples_by_dimension(
+        {'compile_time': [10.0, 10.1, 9.9]},
+        {'compile_time': [12.0, 12.1, 11.9]})
+    assert errors == []
+    [comparison] = comparisons
+    assert comparison.has_insufficient_samples
+    assert not comparison.is_regression
+
+def test_constant_samples_are_compared_exactly():
+    comparisons, errors = compare_samples_by_dimension(
+        {'num_bytes': [8000.0, 8000.0]},
+        {'num_bytes': [8200.0, 8200.0]})
+    assert errors == []
+    [comparison] = comparisons
+    assert not comparison.has_insufficient_samples
+    assert comparison.p_value == 0.0
+    assert comparison.is_regression
+
+def test_confidence_intervals_are_compared_without_samples():
+    with BenchmarkResultsStore(':memory:') as baseline_store, BenchmarkResultsStore(':memory:') as current_store:
+        baseline_store.add_result(make_benchmark_description('aaaa'), {'compile_time': [10.0, 10.5]})
+        current_store.add_result(make_benchmark_description('bbbb'), {'compile_time': [12.0, 12.5]})
+        comparisons, errors = compare_results(baseline_store, current_store, THRESHOLDS_DEFINITION)
+    assert errors == []
+    [comparison] = comparisons
+    assert comparison.baseline_value == 10.25
+    assert comparison.current_value == 12.25
+    assert comparison.is_regression
+
+def test_unpaired_benchmarks_are_errors():
+    samples_by_dimension = {'compile_time': [10.0, 10.1, 9.9, 10.0]}
+    with make_store(samples_by_dimension, git_commit_hash='aaaa', num_classes=100) as baseline_store, \
+            make_store(samples_by_dimension, git_commit_hash='bbbb', num_classes=250) as current_store:
+        comparisons, errors = compare_results(baseline_store, current_store, THRESHOLDS_DEFINITION)
+    assert comparisons == []
+    assert len(errors) == 2
+    assert 'only in the baseline results' in errors[0]
+    assert '"num_classes": 100' in errors[0]
+    assert 'only in the current results' in errors[1]
+    assert '"num_classes": 250' in errors[1]
+
+def test_unpaired_metrics_are_errors():
+    comparisons, errors = compare_samples_by_dimension(
+        {'compile_time': [10.0, 10.1, 9.9, 10.0]},
+        {'compile_time': [10.0, 10.1, 9.9, 10.0], 'num_bytes': [8000.0, 8000.0, 8000.0, 8000.0]})
+    assert [comparison.dimension for comparison in comparisons] == ['compile_time']
+    [error] = errors
+    assert 'The metric num_bytes' in error
+    assert 'only in the current results' in error
+
+def test_multiple_results_for_the_same_benchmark_are_errors():
+    with make_store({'compile_time': [10.0, 10.1, 9.9, 10.0]}, git_commit_hash='aaaa') as baseline_store, \
+            make_store({'compile_time': [10.0, 10.1, 9.9, 10.0]}, git_commit_hash='bbbb') as current_store:
+        baseline_store.add_result(make_benchmark_description('cccc'), {'compile_time': [10.0, 10.5]})
+        comparisons, errors = compare_results(baseline_store, current_store, THRESHOLDS_DEFINITION)
+    [error] = errors
+    assert 'The baseline results contain multiple results' in error
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+#  Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+
+import pytest
+
+from compile_profile import TranslationUnitProfile, parse_gcc_time_report, parse_clang_time_trace, get_meta_function, \
+    get_instantiation_time_by_meta_function, get_top_instantiations
+
+GCC_TIME_REPORT = '''\
+Time variable                                   usr           sys          wall           GGC
+ phase setup                        :   0.00 (  0%)   0.00 (  0%)   0.01 (  1%)  1576k (  1%)
+ phase parsing                      :   0.63 ( 51%)   0.27 ( 49%)   0.93 ( 51%)    67M ( 56%)
+ phase lang. deferred               :   0.20 ( 16%)   0.05 (  9%)   0.25 ( 14%)    20M ( 17%)
+ phase opt and generate             :   0.40 ( 32%)   0.20 ( 36%)   0.60 ( 33%)    30M ( 25%)
+ phase last asm                     :   0.01 (  1%)   0.01 (  2%)   0.02 (  1%)   500k (  1%)
+ |name lookup                       :   0.05 (  4%)   0.01 (  2%)   0.07 (  4%)  2000k (  2%)
+ template instantiation             :   0.30 ( 24%)   0.10 ( 18%)   0.41 ( 23%)    40M ( 33%)
+ TOTAL                              :   1.24          0.55          1.81          120M
+'''
+
+def test_parse_gcc_time_report():
+    profile = parse_gcc_time_report(GCC_TIME_REPORT)
+    assert profile.frontend_time == pytest.approx(0.01 + 0.93 + 0.25)
+    assert profile.backend_time == pytest.approx(0.60 + 0.02)
+    assert profile.template_instantiation_time == pytest.approx(0.41)
+    # GCC doesn't report individual instantiations.
+    assert profile.instantiations == []
+
+def test_parse_gcc_time_report_without_timevars():
+    profile = parse_gcc_time_report('some unrelated output\n')
+    assert profile.frontend_time == 0.0
+    assert profile.backend_time == 0.0
+    assert profile.template_instantiation_time == 0.0
+
+def make_clang_time_trace(events):
+    return json.dumps({'traceEvents': events, 'beginningOfTime': 0})
+
+def test_parse_clang_time_trace():
+    profile = parse_clang_time_trace(make_clang_time_trace([
+        {'ph': 'X', 'name': 'Frontend', 'ts': 0, 'dur': 900000},
+        {'ph': 'X', 'name': 'InstantiateClass', 'ts': 1000, 'dur': 3000,
+         'args': {'detail': 'fruit::impl::meta::GetResult::apply<int>'}},
+        {'ph': 'X', 'name': 'InstantiateFunction', 'ts': 5000, 'dur': 2000, 'args': {'detail': 'std::move<int &>'}},
+        {'ph': 'X', 'name': 'Backend', 'ts': 900000, 'dur': 250000},
+        {'ph': 'X', 'name': 'Total InstantiateClass', 'ts': 0, 'dur': 300000},
+        {'ph': 'X', 'name': 'Total InstantiateFunction', 'ts': 0, 'dur': 100000},
+        # Events that are not complete events (e.g. metadata) are ignored.
+        {'ph': 'M', 'name': 'process_name', 'ts': 0, 'args': {'name': 'clang'}},
+    ]))
+    assert profile.frontend_time == pytest.approx(0.9)
+    assert profile.backend_time == pytest.approx(0.25)
+    assert profile.template_instantiation_time == pytest.approx(0.4)
+    assert profile.instantiations == [
+        ('fruit::impl::meta::GetResult::apply<int>', pytest.approx(0.003)),
+        ('std::move<int &>', pytest.approx(0.002)),
+    ]
+
+@pytest.mark.parametrize('instantiation_name,expected_meta_function', [
+    ('fruit::impl::meta::GetResult::apply<int>', 'fruit::impl::meta::GetResult'),
+    ('fruit::impl::meta::Vector<int, float>', 'fruit::impl::meta::Vector'),
+    ('fruit::impl::meta::ComponentNormalizer::apply', 'fruit::impl::meta::ComponentNormalizer'),
+    ('fruit::impl::InjectorStorage::get<int>', None),
+    ('std::vector<fruit::impl::meta::Type<int>>', None),
+])
+def test_get_meta_function(instantiation_name, expected_meta_function):
+    assert get_meta_function(instantiation_name) == expected_meta_function
+
+def test_get_instantiation_time_by_meta_function():
+    profiles = [
+        TranslationUnitProfile(frontend_time=1.0, backend_time=0.5, template_instantiation_time=0.5, instantiations=[
+            ('fruit::impl::meta::GetResult::apply<int>', 0.25),
+            ('fruit::impl::meta::GetResult::apply<float>', 0.5),
+            ('std::move<int &>', 1.0),
+        ]),
+        TranslationUnitProfile(frontend_time=1.0, backend_time=0.5, template_instantiation_time=0.5, instantiations=[
+            ('fruit::impl::meta::GetResult::apply<int>', 0.125),
+            ('fruit::impl::meta::Vector<int>', 0.0625),
+        ]),
+    ]
+    assert get_instantiation_time_by_meta_function(profiles) == {
+        'fruit::impl::meta::GetResult': 0.875,
+        'fruit::impl::meta::Vector': 0.0625,
+    }
+
+def test_get_top_instantiations():
+    profile_by_translation_unit = {
+        'component0.cpp': TranslationUnitProfile(
+            frontend_time=1.0, backend_time=0.5, template_instantiation_time=0.5,
+            instantiations=[('A', 0.1), ('B', 0.4)]),
+        'component1.cpp': TranslationUnitProfile(
+            frontend_time=1.0, backend_time=0.5, template_instantiation_time=0.5,
+            instantiations=[('C', 0.3)]),
+    }
+    assert get_top_instantiations(profile_by_translation_unit, 2) == [
+        {'translation_unit': 'component0.cpp', 'name': 'B', 'time': 0.4},
+        {'translation_unit': 'component1.cpp', 'name': 'C', 'time': 0.3},
+    ]
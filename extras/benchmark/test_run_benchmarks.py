@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+#  Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+from run_benchmarks import read_ninja_log
+
+def write_ninja_log(build_dir, entries):
+    with open(str(build_dir / '.ninja_log'), 'w') as f:
+        print('# ninja log v5', file=f)
+        for start, end, output in entries:
+            print('%s\t%s\t0\t%s\t0123456789abcdef' % (start, end, output), file=f)
+
+def test_read_ninja_log(tmp_path):
+    write_ninja_log(tmp_path, [
+        (0, 1500, 'component0.o'),
+        (0, 2500, 'component1.o'),
+        (1500, 1800, 'main.o'),
+        (2500, 2900, 'main'),
+    ])
+    assert read_ninja_log(str(tmp_path), executable_name='main') == {
+        'link_time': pytest.approx(0.4),
+        'max_tu_compile_time': pytest.approx(2.5),
+    }
+
+def test_read_ninja_log_with_duplicate_entries(tmp_path):
+    # After a rebuild ninja appends new lines for the rebuilt outputs, and the last line for each output is the one that
+    # matters.
+    write_ninja_log(tmp_path, [
+        (0, 5000, 'component0.o'),
+        (0, 1000, 'component1.o'),
+        (5000, 6000, 'main'),
+        (0, 2000, 'component0.o'),
+        (2000, 2200, 'main'),
+    ])
+    assert read_ninja_log(str(tmp_path), executable_name='main') == {
+        'link_time': pytest.approx(0.2),
+        'max_tu_compile_time': pytest.approx(2.0),
+    }
@@ -1,2 +1,461 @@
 
+import collections
+import inspect
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import tempfile
+
+import pytest
+
+import fruit_test_common
+
 pytest_plugins = 'xdist'
+
+def pytest_addoption(parser):
+    group = parser.getgroup('fruit', 'Fruit test harness')
+    group.addoption(
+        '--batch-success-tests',
+        action='store_true',
+        default=False,
+        help='Compile the tests in each module that are expected to compile and run successfully into a single executable, '
+             'instead of compiling each of them separately. Each test still runs in its own process. '
+             'This works best with --dist=loadfile, so that each module is built by a single worker.')
+    group.addoption(
+        '--batch-compile-error-tests',
+        action='store_true',
+        default=False,
+        help='Compile the tests in each module that are expected to fail to compile as a single translation unit, and '
+             'check each test against the diagnostics attributed to it. Tests whose diagnostics are missing or '
+             'affected by other tests are recompiled on their own.')
+    group.addoption(
+        '--batch-parametrized-tests',
+        action='store_true',
+        default=False,
+        help='Compile all the parametrized variants of each test that\'s expected to compile and run successfully into '
+             'a single executable, instead of compiling each of them separately. Each variant is still reported as '
+             'a separate test, and it still runs in its own process.')
+    group.addoption(
+        '--keep-failed-artifacts',
+        action='store_true',
+        default=False,
+        help='Keep the sources and executables of the tests that failed (in the harness\'s temporary directory, '
+             'mentioned in the commands shown for the failures), instead of removing them at the end of the run.')
+    group.addoption(
+        '--jobserver-jobs',
+        type=int,
+        default=None,
+        help='The number of tokens in the jobserver shared by all pytest-xdist workers; at most this many compilers, '
+             'valgrind instances and tests run at the same time. Defaults to the number of CPUs, further limited by '
+             '--jobserver-memory-per-job. Set this to 0 to disable the jobserver.')
+    group.addoption(
+        '--jobserver-memory-per-job',
+        type=int,
+        default=1024,
+        help='The amount of memory (in MiB) to reserve for each job when computing the default for --jobserver-jobs.')
+    group.addoption(
+        '--phase-report',
+        default=None,
+        metavar='PATH',
+        help='Write a JSON report with the wall-clock time and peak RSS of the compile, link, run and valgrind phases of '
+             'each test to this file.')
+    group.addoption(
+        '--slowest-phases',
+        type=int,
+        default=10,
+        metavar='N',
+        help='Show the N slowest test phases at the end of the run (0 to disable).')
+    group.addoption(
+        '--changed-since',
+        default=None,
+        metavar='GIT_REV',
+        help='Only run the tests affected by the files that changed since this git revision (including uncommitted '
+             'changes), based on the files that each test included in previous runs with this flag. Tests that never '
+             'ran with this flag before are always run. The dependencies are stored in the pytest cache, so with '
+             '-p no:cacheprovider all tests are run.')
+    group.addoption(
+        '--shard',
+        default=None,
+        metavar='I/N',
+        help='Split the tests into N shards with a similar expected duration (based on the durations of previous runs) '
+             'and only run the I-th one (1 <= I <= N).')
+    group.addoption(
+        '--test-durations',
+        default=None,
+        metavar='PATH',
+        help='A JSON file where the durations of tests are read from and saved to, to order the tests (longest first) '
+             'and to balance shards. Sharing this file between machines makes --shard consistent between them. '
+             'By default the durations are stored in the pytest cache.')
+
+def _get_available_memory():
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+def _get_default_num_jobserver_jobs(config):
+    num_jobs = multiprocessing.cpu_count()
+    available_memory = _get_available_memory()
+    if available_memory is not None:
+        num_jobs = min(num_jobs, available_memory // (config.getoption('jobserver_memory_per_job') * 1024 * 1024))
+    return max(num_jobs, 1)
+
+def _parse_shard(shard):
+    try:
+        shard_index, num_shards = [int(value) for value in shard.split('/')]
+    except ValueError:
+        raise pytest.UsageError('Invalid value for --shard: %s (expected e.g. --shard=1/4)' % shard)
+    if not 1 <= shard_index <= num_shards:
+        raise pytest.UsageError('Invalid value for --shard: %s (the shard index must be between 1 and %s)' % (shard, num_shards))
+    return shard_index, num_shards
+
+def _get_cached_value(config, key):
+    # config.cache is only available when the cacheprovider plugin is enabled (i.e. not with -p no:cacheprovider).
+    cache = getattr(config, 'cache', None)
+    if cache is None:
+        return {}
+    return cache.get(key, {})
+
+def _set_cached_value(config, key, value):
+    cache = getattr(config, 'cache', None)
+    if cache is not None:
+        cache.set(key, value)
+
+def _load_test_durations(config):
+    path = config.getoption('test_durations')
+    if path is None:
+        return _get_cached_value(config, 'fruit/test_durations')
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def _save_test_durations(config, durations):
+    path = config.getoption('test_durations')
+    if path is None:
+        _set_cached_value(config, 'fruit/test_durations', durations)
+    else:
+        with open(path, 'w') as f:
+            json.dump(durations, f, indent=2, sort_keys=True)
+
+def _get_expected_durations(items, test_durations):
+    """Returns a dict mapping each item to its expected duration, based on the durations of previous runs."""
+    known_durations = sorted(test_durations[item.nodeid] for item in items if item.nodeid in test_durations)
+    # Tests that never ran before are assumed to take as long as the median known test.
+    default_duration = known_durations[len(known_durations) // 2] if known_durations else 1.0
+    return {item: test_durations.get(item.nodeid, default_duration) for item in items}
+
+def _get_module_nodeid(item):
+    return item.nodeid.split('::')[0]
+
+def _get_changed_files(config, rev):
+    """Returns the set of (absolute) paths of the files that changed since the given git revision (including untracked files)."""
+    tests_dir = str(config.rootdir)
+    try:
+        repo_dir = subprocess.check_output(['git', 'rev-parse', '--show-toplevel'], cwd=tests_dir, universal_newlines=True).strip()
+        changed_files = subprocess.check_output(['git', 'diff', '--name-only', rev, '--'], cwd=repo_dir, universal_newlines=True).splitlines()
+        changed_files += subprocess.check_output(['git', 'ls-files', '--others', '--exclude-standard'], cwd=repo_dir, universal_newlines=True).splitlines()
+    except (OSError, subprocess.CalledProcessError) as e:
+        raise pytest.UsageError('Unable to determine the files changed since %s: %s' % (rev, e))
+    return {os.path.realpath(os.path.join(repo_dir, file_name)) for file_name in changed_files}
+
+def _is_harness_file(file_name):
+    # A change to these files (e.g. fruit_test_common.py, conftest.py or pytest.ini) can affect all tests.
+    return (os.path.dirname(file_name) == os.path.realpath(os.path.dirname(__file__))
+            and not os.path.basename(file_name).startswith('test_')
+            and os.path.splitext(file_name)[1] in ('.py', '.ini'))
+
+def _select_changed_tests(config, items):
+    """
+    Deselects the tests that are not affected by the files changed since the --changed-since revision, based on the
+    files that each test included the last time that it ran (and, for tests that link to Fruit, on the files that the
+    Fruit library is built from).
+    """
+    changed_files = _get_changed_files(config, config.getoption('changed_since'))
+    if any(_is_harness_file(file_name) for file_name in changed_files):
+        return
+
+    test_dependencies = _get_cached_value(config, 'fruit/test_dependencies')
+    library_files = None
+    selected_items = []
+    deselected_items = []
+    for item in items:
+        dependencies = test_dependencies.get(item.nodeid)
+        if (os.path.realpath(str(item.fspath)) in changed_files
+                or dependencies is None
+                or not dependencies['complete']
+                or not dependencies['files']
+                or not changed_files.isdisjoint(dependencies['files'])):
+            selected_items.append(item)
+            continue
+        if dependencies['links_fruit']:
+            if library_files is None:
+                library_files = fruit_test_common.get_fruit_library_dependencies()
+            if library_files is None or not changed_files.isdisjoint(library_files):
+                selected_items.append(item)
+                continue
+        deselected_items.append(item)
+
+    if deselected_items:
+        config.hook.pytest_deselected(items=deselected_items)
+        items[:] = selected_items
+
+@pytest.hookimpl(trylast=True)
+def pytest_collection_modifyitems(session, config, items):
+    if config.getoption('changed_since') is not None:
+        _select_changed_tests(config, items)
+
+    # This runs in the pytest-xdist workers too. Each of them gets the same list of tests (the durations are only saved
+    # at the end of the run) so they all compute the same order and the same shards, as pytest-xdist requires.
+    expected_durations = _get_expected_durations(items, _load_test_durations(config))
+
+    if config.getoption('batch_success_tests') or config.getoption('batch_compile_error_tests'):
+        # Keep the tests of each module together, so that each module's batch is only built once.
+        module_durations = collections.Counter()
+        for item in items:
+            module_durations[_get_module_nodeid(item)] += expected_durations[item]
+        sort_key = lambda item: (-module_durations[_get_module_nodeid(item)], _get_module_nodeid(item),
+                                 -expected_durations[item], item.nodeid)
+    else:
+        sort_key = lambda item: (-expected_durations[item], item.nodeid)
+    # Running the longest tests first avoids having a few slow tests running at the end, when most workers are idle.
+    items.sort(key=sort_key)
+
+    shard = config.getoption('shard')
+    if shard is not None:
+        shard_index, num_shards = _parse_shard(shard)
+        # Assign each test (longest first) to the shard with the lowest total expected duration so far.
+        shard_durations = [0.0] * num_shards
+        selected_items = []
+        deselected_items = []
+        for item in sorted(items, key=lambda item: (-expected_durations[item], item.nodeid)):
+            target_shard = min(range(num_shards), key=lambda i: (shard_durations[i], i))
+            shard_durations[target_shard] += expected_durations[item]
+            if target_shard == shard_index - 1:
+                selected_items.append(item)
+            else:
+                deselected_items.append(item)
+        if deselected_items:
+            config.hook.pytest_deselected(items=deselected_items)
+        selected_items = set(selected_items)
+        items[:] = [item for item in items if item in selected_items]
+
+def pytest_configure(config):
+    if config.getoption('shard') is not None:
+        _parse_shard(config.getoption('shard'))
+    fruit_test_common.keep_failed_artifacts = config.getoption('keep_failed_artifacts')
+    # The index of the files included by each test is only needed (and updated) when selecting tests with --changed-since.
+    fruit_test_common.record_dependencies = config.getoption('changed_since') is not None
+    config._fruit_jobserver = None
+    config._fruit_jobserver_stats = (0, 0.0)
+    config._fruit_old_linker_setting = None
+    if not hasattr(config, 'workerinput') and fruit_test_common.get_linker_setting() == 'auto':
+        # The linkers are measured only once per session, pytest-xdist workers get the result from FRUIT_TESTS_LINKER.
+        config._fruit_old_linker_setting = (os.environ.get('FRUIT_TESTS_LINKER'),)
+        os.environ['FRUIT_TESTS_LINKER'] = fruit_test_common.select_fastest_linker()
+    if hasattr(config, 'workerinput') or not hasattr(os, 'mkfifo'):
+        # pytest-xdist workers use the jobserver created by the controller, they get it from MAKEFLAGS.
+        return
+    if fruit_test_common.get_jobserver_fifo_path() is not None:
+        # We're running under `make -jN` (GNU make 4.4+), use its jobserver.
+        return
+    num_jobs = config.getoption('jobserver_jobs')
+    if num_jobs is None:
+        num_jobs = _get_default_num_jobserver_jobs(config)
+    if num_jobs <= 0:
+        return
+
+    jobserver_dir = tempfile.mkdtemp(prefix='fruit-tests-jobserver-')
+    fifo_path = os.path.join(jobserver_dir, 'fifo')
+    os.mkfifo(fifo_path)
+    # This stays open until the end of the session, so that the tokens in the pipe are not lost when no other process
+    # has it open.
+    fd = os.open(fifo_path, os.O_RDWR)
+    os.write(fd, b'+' * num_jobs)
+    config._fruit_jobserver = (jobserver_dir, fd, num_jobs, os.environ.get('MAKEFLAGS'))
+    os.environ['MAKEFLAGS'] = ('%s -j%s --jobserver-auth=fifo:%s' % (os.environ.get('MAKEFLAGS', ''), num_jobs, fifo_path)).strip()
+
+def pytest_unconfigure(config):
+    if getattr(config, '_fruit_old_linker_setting', None) is not None:
+        old_linker_setting, = config._fruit_old_linker_setting
+        if old_linker_setting is None:
+            del os.environ['FRUIT_TESTS_LINKER']
+        else:
+            os.environ['FRUIT_TESTS_LINKER'] = old_linker_setting
+        config._fruit_old_linker_setting = None
+    if getattr(config, '_fruit_jobserver', None) is None:
+        return
+    jobserver_dir, fd, _, old_makeflags = config._fruit_jobserver
+    if old_makeflags is None:
+        del os.environ['MAKEFLAGS']
+    else:
+        os.environ['MAKEFLAGS'] = old_makeflags
+    os.close(fd)
+    shutil.rmtree(jobserver_dir, ignore_errors=True)
+    config._fruit_jobserver = None
+
+def _add_jobserver_stats(config, stats):
+    num_jobs, wait_time = config._fruit_jobserver_stats
+    config._fruit_jobserver_stats = (num_jobs + stats[0], wait_time + stats[1])
+
+def pytest_sessionfinish(session):
+    stats = fruit_test_common.get_jobserver_stats()
+    if hasattr(session.config, 'workeroutput'):
+        session.config.workeroutput['fruit_jobserver_stats'] = stats
+    else:
+        _add_jobserver_stats(session.config, stats)
+        if _test_phases:
+            test_durations = _load_test_durations(session.config)
+            test_durations.update((nodeid, test_phases['duration']) for nodeid, test_phases in _test_phases.items())
+            _save_test_durations(session.config, test_durations)
+        if _test_dependencies:
+            test_dependencies = _get_cached_value(session.config, 'fruit/test_dependencies')
+            test_dependencies.update(_test_dependencies)
+            _set_cached_value(session.config, 'fruit/test_dependencies', test_dependencies)
+
+@pytest.hookimpl(optionalhook=True)
+def pytest_testnodedown(node, error):
+    stats = getattr(node, 'workeroutput', {}).get('fruit_jobserver_stats')
+    if stats is not None:
+        _add_jobserver_stats(node.config, stats)
+
+# Maps the nodeid of each test to a dict with its total duration and the list of its phases (see
+# fruit_test_common.recording_phases()).
+_test_phases = dict()
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_setup(item):
+    # This includes the phases of module-level batches, that are built during the setup of their first test.
+    with fruit_test_common.recording_phases() as phases:
+        yield
+    item.user_properties.append(('fruit_phases', phases))
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_call(item):
+    with fruit_test_common.recording_phases() as phases, fruit_test_common.recording_dependencies() as dependencies:
+        yield
+    item.user_properties.append(('fruit_phases', phases))
+    if fruit_test_common.record_dependencies:
+        item.user_properties.append(('fruit_dependencies', dependencies.to_json()))
+
+# Maps the nodeid of each test that ran to the JSON representation of its fruit_test_common._Dependencies.
+_test_dependencies = dict()
+
+def pytest_runtest_logreport(report):
+    # With pytest-xdist this runs in the controller, and the user_properties are sent to it as part of the report.
+    test_phases = _test_phases.setdefault(report.nodeid, {'duration': 0.0, 'phases': []})
+    test_phases['duration'] += report.duration
+    if report.when == 'teardown':
+        test_phases['phases'] = [
+            phase
+            for name, phases in report.user_properties
+            if name == 'fruit_phases'
+            for phase in phases
+        ]
+        for name, dependencies in report.user_properties:
+            if name == 'fruit_dependencies':
+                _test_dependencies[report.nodeid] = dependencies
+
+def _write_phase_report(config):
+    with open(config.getoption('phase_report'), 'w') as f:
+        json.dump({'tests': _test_phases}, f, indent=2, sort_keys=True)
+
+def _print_slowest_phases(terminalreporter, config):
+    num_phases = config.getoption('slowest_phases')
+    phases = [
+        (phase, nodeid)
+        for nodeid, test_phases in _test_phases.items()
+        for phase in test_phases['phases']
+    ]
+    if num_phases <= 0 or not phases:
+        return
+    phases.sort(key=lambda phase_and_nodeid: phase_and_nodeid[0]['wall_time'], reverse=True)
+    terminalreporter.write_sep('=', 'slowest %s test phases' % num_phases)
+    for phase, nodeid in phases[:num_phases]:
+        if phase['peak_rss'] is None:
+            peak_rss = 'n/a'
+        else:
+            peak_rss = '%.0fMiB' % (phase['peak_rss'] / (1024 * 1024))
+        terminalreporter.write_line('%8.2fs %9s %-18s %s' % (phase['wall_time'], peak_rss, phase['phase'], nodeid))
+
+def _print_phase_totals(terminalreporter):
+    # The link phase is reported on its own, so that e.g. the effect of FRUIT_TESTS_LINKER and FRUIT_TESTS_LINK_MODE can
+    # be measured.
+    totals = collections.defaultdict(float)
+    for test_phases in _test_phases.values():
+        for phase in test_phases['phases']:
+            totals[phase['phase']] += phase['wall_time']
+    if totals:
+        terminalreporter.write_line('phase totals: ' + ', '.join(
+            '%s %.1fs' % (phase, wall_time) for phase, wall_time in sorted(totals.items())))
+
+def pytest_terminal_summary(terminalreporter, config):
+    if _test_phases:
+        if config.getoption('phase_report'):
+            _write_phase_report(config)
+        _print_slowest_phases(terminalreporter, config)
+        _print_phase_totals(terminalreporter)
+
+    num_jobs, wait_time = config._fruit_jobserver_stats
+    if num_jobs == 0:
+        return
+    message = 'jobserver: %s commands waited %.1fs in total for a token (%.3fs on average)' % (
+        num_jobs, wait_time, wait_time / num_jobs)
+    if config._fruit_jobserver is not None:
+        message += ', with %s tokens' % config._fruit_jobserver[2]
+    terminalreporter.write_line(message)
+
+def _record_test_calls(request, item_filter):
+    """
+    Runs the tests for which item_filter returns True in recording mode (see fruit_test_common.recording_test_calls).
+    The test functions are called directly (outside of pytest), so they must not have side effects other than the calls
+    to the expect_* functions. Tests that take fixtures (other than parametrize arguments) are skipped, since they can't
+    be called without them.
+    """
+    with fruit_test_common.recording_test_calls() as recorded_calls:
+        for item in request.session.items:
+            if not item_filter(item):
+                continue
+            params = item.callspec.params if hasattr(item, 'callspec') else {}
+            if any(name not in params for name in inspect.signature(item.obj).parameters):
+                continue
+            try:
+                item.obj(**params)
+            except Exception:
+                # This test will fail when it's actually run, there's no need to report the error here.
+                pass
+    return recorded_calls
+
+@pytest.fixture(scope='module', autouse=True)
+def _fruit_test_batches(request):
+    batch_success_tests = request.config.getoption('batch_success_tests')
+    batch_compile_error_tests = request.config.getoption('batch_compile_error_tests')
+    if batch_success_tests or batch_compile_error_tests:
+        recorded_calls = _record_test_calls(request, lambda item: getattr(item, 'module', None) is request.module)
+        if batch_success_tests:
+            fruit_test_common.prepare_success_batch(recorded_calls)
+        if batch_compile_error_tests:
+            fruit_test_common.prepare_compile_error_batch(recorded_calls)
+
+# The test functions whose parametrized variants were already batched, see --batch-parametrized-tests.
+_batched_parametrized_functions = set()
+
+@pytest.fixture(autouse=True)
+def _fruit_test_params_batches(request):
+    if (not request.config.getoption('batch_parametrized_tests')
+            or not hasattr(request.node, 'callspec')
+            or request.function in _batched_parametrized_functions):
+        return
+    _batched_parametrized_functions.add(request.function)
+    recorded_calls = _record_test_calls(request, lambda item: getattr(item, 'function', None) is request.function)
+    fruit_test_common.prepare_success_batch(recorded_calls)
@@ -0,0 +1,108 @@
+/*
+ * Copyright 2014 Google Inc. All rights reserved.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+// The host process of the "dlopen" execution backend of the test harness (see fruit_test_common.py).
+//
+// It reads requests from stdin, one per line, in the format:
+//   <shared object>\t<stdout file>\t<stderr file>
+// For each request, it forks a child process that redirects its stdout/stderr to the given files, loads the shared
+// object, calls its fruit_test_entry_point() function, unloads it and exits with the value returned by that function.
+// This way each test still runs in its own process (and its exit status and output are the same as when running it
+// as an executable), but it doesn't pay for exec() and for loading libfruit (that this process is already linked with).
+//
+// Once the child terminates, this writes a line with its exit code (or minus the signal number, if it was killed by a
+// signal) and its peak RSS (in KB, or bytes on macOS) to stdout.
+
+#include <dlfcn.h>
+#include <fcntl.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <sys/resource.h>
+#include <sys/types.h>
+#include <sys/wait.h>
+#include <unistd.h>
+
+#include <iostream>
+#include <string>
+
+namespace {
+
+void redirect(const std::string& fileName, int fd) {
+  int newFd = open(fileName.c_str(), O_WRONLY | O_CREAT | O_TRUNC, 0600);
+  if (newFd < 0 || dup2(newFd, fd) < 0) {
+    perror(fileName.c_str());
+    _exit(127);
+  }
+  close(newFd);
+}
+
+void runTest(const std::string& sharedObject, const std::string& stdoutFile, const std::string& stderrFile) {
+  int stdinFd = open("/dev/null", O_RDONLY);
+  if (stdinFd >= 0) {
+    dup2(stdinFd, 0);
+    close(stdinFd);
+  }
+  redirect(stdoutFile, 1);
+  redirect(stderrFile, 2);
+
+  void* handle = dlopen(sharedObject.c_str(), RTLD_NOW | RTLD_LOCAL);
+  if (handle == nullptr) {
+    fprintf(stderr, "dlopen failed: %s\n", dlerror());
+    exit(127);
+  }
+  using EntryPoint = int();
+  EntryPoint* entryPoint = reinterpret_cast<EntryPoint*>(dlsym(handle, "fruit_test_entry_point"));
+  if (entryPoint == nullptr) {
+    fprintf(stderr, "dlsym failed: %s\n", dlerror());
+    exit(127);
+  }
+  int result = entryPoint();
+  dlclose(handle);
+  exit(result);
+}
+
+} // namespace
+
+int main() {
+  std::string line;
+  while (std::getline(std::cin, line)) {
+    std::string::size_type firstTab = line.find('\t');
+    std::string::size_type secondTab = line.find('\t', firstTab + 1);
+    if (firstTab == std::string::npos || secondTab == std::string::npos) {
+      std::cerr << "Invalid request: " << line << std::endl;
+      return 1;
+    }
+
+    pid_t pid = fork();
+    if (pid < 0) {
+      perror("fork");
+      return 1;
+    }
+    if (pid == 0) {
+      runTest(line.substr(0, firstTab), line.substr(firstTab + 1, secondTab - firstTab - 1), line.substr(secondTab + 1));
+    }
+
+    int status;
+    struct rusage usage;
+    if (wait4(pid, &status, 0, &usage) < 0) {
+      perror("wait4");
+      return 1;
+    }
+    int exitCode = WIFSIGNALED(status) ? -WTERMSIG(status) : WEXITSTATUS(status);
+    std::cout << exitCode << " " << usage.ru_maxrss << std::endl;
+  }
+  return 0;
+}
@@ -19,15 +19,43 @@ import unittest
 import textwrap
 import re
 import sys
+import glob
+import json
+import shutil
+import hashlib
+import warnings
+import contextlib
+import atexit
+import collections
+import threading
+import time
 
 import itertools
 
 import subprocess
 
+from functools import lru_cache as memoize
+
+try:
+    import fcntl
+    import resource
+except ImportError:
+    # Not available on Windows.
+    fcntl = None
+    resource = None
+
 import pytest
 
 from fruit_test_config import *
 
+def _get_config_value(name, default):
+    # Optional settings can be defined in fruit_test_config.py, and they can also be overridden using an environment
+    # variable with the same name.
+    return os.environ.get(name, globals().get(name, default))
+
+def _is_enabled(config_value):
+    return config_value.lower() not in ('false', 'off', 'no', '0', '')
+
 class CommandFailedException(Exception):
     def __init__(self, command, stdout, stderr, error_code):
         self.command = command
@@ -46,13 +74,172 @@ class CommandFailedException(Exception):
         {stderr}
         ''').format(command=self.command, error_code=self.error_code, stdout=self.stdout, stderr=self.stderr)
 
-def run_command(executable, args=[]):
+def _wait(p):
+    """
+    Waits for the given process to terminate and sets its returncode.
+
+    :returns: The resource usage of the process, or None if it's not available on this platform.
+    """
+    if not hasattr(os, 'wait4'):
+        p.wait()
+        return None
+    _, status, rusage = os.wait4(p.pid, 0)
+    if os.WIFSIGNALED(status):
+        p.returncode = -os.WTERMSIG(status)
+    else:
+        p.returncode = os.WEXITSTATUS(status)
+    return rusage
+
+def _write_input(p, input):
+    try:
+        p.stdin.write(input)
+        p.stdin.close()
+    except OSError:
+        # The process terminated (or was killed) before reading all the input.
+        pass
+
+def _communicate(p, stop_on_stderr_line=None, input=None):
+    """
+    Like p.communicate(), but it reads stderr incrementally (see run_command) and it also returns the resource usage
+    of the process (or None if not available).
+    """
+    if input is not None:
+        input_writer = threading.Thread(target=_write_input, args=(p, input))
+        input_writer.start()
+    stdout_chunks = []
+    stdout_reader = threading.Thread(target=lambda: stdout_chunks.append(p.stdout.read()))
+    stdout_reader.start()
+    stderr_lines = []
+    for line in p.stderr:
+        stderr_lines.append(line)
+        if stop_on_stderr_line and stop_on_stderr_line(line):
+            p.kill()
+            break
+    p.stderr.close()
+    stdout_reader.join()
+    p.stdout.close()
+    if input is not None:
+        input_writer.join()
+    rusage = _wait(p)
+    return ''.join(stdout_chunks), ''.join(stderr_lines), rusage
+
+# When this is not None, run_command appends a dict with the wall-clock time and peak RSS of each command that has a
+# phase (e.g. 'compile') to this list.
+_phase_records = None
+
+@contextlib.contextmanager
+def recording_phases():
+    """
+    While this context manager is active, the harness records the phase (compile, link, run or valgrind), wall-clock
+    time (in seconds) and peak RSS (in bytes, if available) of each command that it runs.
+
+    :returns: The list of records (dicts), filled in as commands run.
+    """
+    global _phase_records
+    previous_phase_records = _phase_records
+    _phase_records = []
+    try:
+        yield _phase_records
+    finally:
+        _phase_records = previous_phase_records
+
+def _get_peak_rss(rusage):
+    """
+    Returns the peak RSS (in bytes) of a command that terminated, given its resource usage, or None if it's not known.
+    """
+    if rusage is None:
+        return None
+    # The peak RSS of a process also accounts for the process that it was forked from (up to the exec()), so for a
+    # command run by the harness it's at least the peak RSS of this Python process. When it's not higher than that, we
+    # can't tell how much memory the command itself used.
+    if rusage.ru_maxrss <= resource.getrusage(resource.RUSAGE_SELF).ru_maxrss:
+        return None
+    return _max_rss_to_bytes(rusage.ru_maxrss)
+
+def _max_rss_to_bytes(max_rss):
+    if sys.platform == 'darwin':
+        # On macOS ru_maxrss is in bytes, elsewhere it's in KB.
+        return max_rss
+    return max_rss * 1024
+
+def _record_phase(phase, wall_time, peak_rss):
+    if phase and _phase_records is not None:
+        _phase_records.append({
+            'phase': phase,
+            'wall_time': wall_time,
+            'peak_rss': peak_rss,
+        })
+
+class _JobserverClient:
+    """
+    A client for a GNU make jobserver that uses a named pipe. Each token in the pipe allows running one command; tokens
+    are read from the pipe before starting a command and written back when it terminates.
+    """
+    def __init__(self, fifo_path):
+        self.fd = os.open(fifo_path, os.O_RDWR)
+        self.num_jobs = 0
+        self.wait_time = 0.0
+
+    @contextlib.contextmanager
+    def job_token(self):
+        start_time = time.perf_counter()
+        token = os.read(self.fd, 1)
+        self.wait_time += time.perf_counter() - start_time
+        self.num_jobs += 1
+        try:
+            yield
+        finally:
+            os.write(self.fd, token)
+
+def get_jobserver_fifo_path():
+    """
+    Returns the path of the named pipe of the jobserver advertised in MAKEFLAGS (as done by GNU make 4.4+ and by the
+    tests' conftest.py), or None if there's none.
+    """
+    match = re.search(r'--jobserver-auth=fifo:(\S+)', os.environ.get('MAKEFLAGS', ''))
+    return match.group(1) if match else None
+
+@memoize(None)
+def _get_jobserver_client():
+    fifo_path = get_jobserver_fifo_path()
+    if fifo_path is None:
+        return None
+    return _JobserverClient(fifo_path)
+
+def get_jobserver_stats():
+    """
+    Returns a pair (num_jobs, wait_time) with the number of commands that this process ran through the jobserver and
+    the total time (in seconds) that they waited for a token.
+    """
+    client = _get_jobserver_client()
+    if client is None:
+        return (0, 0.0)
+    return (client.num_jobs, client.wait_time)
+
+def run_command(executable, args=[], stop_on_stderr_line=None, phase=None, input=None):
+    """
+    Runs the given command, raising a CommandFailedException if it fails.
+
+    If a jobserver is available (see get_jobserver_fifo_path()), the command only starts once a token is available.
+
+    :param stop_on_stderr_line: Optional. If specified, stderr is read incrementally and this function is called on each
+           line as soon as it's available. If it returns True, the command is killed and the rest of its output is
+           discarded (in that case the command is considered failed).
+    :param phase: Optional. The test phase that this command belongs to (e.g. 'compile'), see recording_phases().
+    :param input: Optional. A string that will be passed to the command through stdin.
+    """
     command = [executable] + args
+    jobserver_client = _get_jobserver_client()
     try:
-        p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-        (stdout, stderr) = p.communicate()
+        with jobserver_client.job_token() if jobserver_client else contextlib.suppress():
+            start_time = time.perf_counter()
+            p = subprocess.Popen(command, stdin=subprocess.PIPE if input is not None else None,
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+            (stdout, stderr, rusage) = _communicate(p, stop_on_stderr_line, input)
+            wall_time = time.perf_counter() - start_time
     except Exception as e:
         raise Exception("While executing: %s" % command)
+    _record_phase(phase, wall_time, _get_peak_rss(rusage))
     if p.returncode != 0:
         raise CommandFailedException(command, stdout, stderr, p.returncode)
     return (stdout, stderr)
@@ -70,46 +257,152 @@ class CompilationFailedException(Exception):
         ''').format(command=self.command, error_message=self.error_message)
 
 class PosixCompiler:
+    # Sources can be passed through stdin, see _StdinSource.
+    supports_stdin_sources = True
+
     def __init__(self):
         self.executable = CXX
         self.name = CXX_COMPILER_NAME
 
-    def compile_discarding_output(self, source, include_dirs, args=[]):
+    def compile_discarding_output(self, source, include_dirs, args=[], stop_on_error_line=None, max_errors=None):
+        """
+        :param source: The name of the source file, or a _StdinSource.
+        :param max_errors: Optional. If specified, the compiler only checks the source (without generating code) and
+               stops after this many errors (0 means no limit). This defaults to 1 when using stop_on_error_line.
+        """
+        if stop_on_error_line and max_errors is None:
+            max_errors = 1
         try:
-            args = args + ['-c', source, '-o', os.path.devnull]
-            self._compile(include_dirs, args=args)
+            if max_errors is not None:
+                # Only the diagnostics matter here, so there's no need to run codegen.
+                args = args + ['-fsyntax-only', self._get_max_errors_flag(max_errors)]
+            else:
+                args = args + ['-c', '-o', os.path.devnull]
+            self._compile(include_dirs, args=args, source=source, stop_on_stderr_line=stop_on_error_line)
         except CommandFailedException as e:
             raise CompilationFailedException(e.command, e.stderr)
 
-    def compile_and_link(self, source, include_dirs, output_file_name, args=[]):
-        self._compile(
-            include_dirs,
-            args = (
-                [source]
-                + ADDITIONAL_LINKER_FLAGS.split()
-                + args
-                + ['-o', output_file_name]
-            ))
+    def _get_max_errors_flag(self, max_errors):
+        if self.name == 'GNU':
+            return '-fmax-errors=%s' % max_errors
+        else:
+            return '-ferror-limit=%s' % max_errors
 
-    def _compile(self, include_dirs, args):
+    def compile_and_link(self, source, include_dirs, output_file_name, args=[], linker_args=[], position_independent=False):
+        # Compiling and linking are done as separate commands, so that the time spent in each can be measured.
+        object_file_name = output_file_name + '.o'
+        try:
+            self._compile(include_dirs, args=args + ['-c', '-o', object_file_name], source=source, position_independent=position_independent)
+            run_command(
+                self.executable,
+                _get_base_compile_flags(position_independent)
+                + ['-g0', object_file_name]
+                + ADDITIONAL_LINKER_FLAGS.split()
+                + linker_args
+                + ['-o', output_file_name],
+                phase='link')
+        finally:
+            try_remove_temporary_file(object_file_name)
+
+    def _get_source_args(self, source):
+        """Returns a pair (args, input) with the arguments and the stdin input needed to compile the given source."""
+        if isinstance(source, _StdinSource):
+            return ['-x', 'c++', '-'], source.source_code
+        return [source], None
+
+    def _compile(self, include_dirs, args, source, stop_on_stderr_line=None, position_independent=False):
         include_flags = ['-I%s' % include_dir for include_dir in include_dirs]
+        depfile_args = []
+        if record_dependencies:
+            # The compiler also writes the list of files included by the source in this depfile, see
+            # recording_dependencies().
+            depfile_name = _create_temporary_file('', file_name_suffix='.d')
+            os.remove(depfile_name)
+            depfile_args = ['-MD', '-MF', depfile_name]
+        source_args, input = self._get_source_args(source)
         args = (
-            FRUIT_COMPILE_FLAGS.split()
+            _get_base_compile_flags(position_independent)
+            + _get_precompiled_header_flags(position_independent)
             + include_flags
             + ['-g0']
+            + depfile_args
             + args
+            + source_args
         )
-        run_command(self.executable, args)
+        try:
+            run_command(self.executable, args, stop_on_stderr_line=stop_on_stderr_line, phase='compile', input=input)
+        finally:
+            if record_dependencies:
+                self._add_dependencies(source, include_dirs, depfile_name)
+            else:
+                _add_dependencies(_Dependencies(complete=False))
+
+    def _add_dependencies(self, source, include_dirs, depfile_name):
+        try:
+            if os.path.exists(depfile_name):
+                files = _parse_depfile(depfile_name)
+                try_remove_temporary_file(depfile_name)
+            else:
+                # The compiler was stopped before writing the depfile. Only preprocessing the source is much cheaper
+                # than compiling it again.
+                files = self.get_dependencies(source, include_dirs)
+        except CommandFailedException:
+            _add_dependencies(_Dependencies(complete=False))
+            return
+        if not isinstance(source, _StdinSource):
+            # The (temporary) source file itself is not interesting.
+            files.discard(os.path.realpath(source))
+        _add_dependencies(_Dependencies(files=files | _get_precompiled_header_dependencies()))
+
+    def get_dependencies(self, source, include_dirs, args=[]):
+        """Returns the set of files included by the given source file (or header), without compiling it."""
+        include_flags = ['-I%s' % include_dir for include_dir in include_dirs]
+        depfile_name = _create_temporary_file('', file_name_suffix='.d')
+        source_args, input = self._get_source_args(source)
+        try:
+            # Precompiled headers are not used here, otherwise the files that they include would not be listed.
+            run_command(
+                self.executable,
+                _remove_include_flags(FRUIT_COMPILE_FLAGS.split()) + include_flags + args + ['-M', '-MF', depfile_name] + source_args,
+                input=input)
+            return _parse_depfile(depfile_name)
+        finally:
+            try_remove_temporary_file(depfile_name)
+
+    def build_precompiled_header(self, header, include_dirs, output_dir, compile_flags):
+        """Precompiles the given header in output_dir, and returns the flags that should be used to include it."""
+        include_flags = ['-I%s' % include_dir for include_dir in include_dirs]
+        if self.name == 'GNU':
+            # Note that the "precompiled.h" header doesn't exist, but it's ok because GCC looks for precompiled.h.gch
+            # first. This way if GCC can't use the precompiled header it reports an error instead of silently falling
+            # back to the (slower) non-precompiled header.
+            output_file_name = os.path.join(output_dir, 'precompiled.h.gch')
+            flags = ['-include' + os.path.join(output_dir, 'precompiled.h')]
+        else:
+            output_file_name = os.path.join(output_dir, 'precompiled.pch')
+            flags = ['-include-pch', output_file_name]
+        run_command(
+            self.executable,
+            compile_flags + include_flags + ['-g0', '-x', 'c++-header', header, '-o', output_file_name],
+            phase='precompiled_header')
+        return flags
 
     def get_disable_deprecation_warning_flags(self):
         return ['-Wno-deprecated-declarations']
 
+    def get_version(self):
+        return subprocess.run([self.executable, '--version'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True).stdout
+
 class MsvcCompiler:
+    supports_stdin_sources = False
+
     def __init__(self):
         self.executable = CXX
         self.name = CXX_COMPILER_NAME
 
-    def compile_discarding_output(self, source, include_dirs, args=[]):
+    def compile_discarding_output(self, source, include_dirs, args=[], stop_on_error_line=None, max_errors=None):
+        # MSVC reports errors on stdout, so stop_on_error_line is ignored and we always wait for the compilation to
+        # complete. max_errors is also ignored, MSVC doesn't have a way to limit the number of errors.
         try:
             args = args + ['/c', source]
             self._compile(include_dirs, args = args)
@@ -117,13 +410,16 @@ class MsvcCompiler:
             # Note that we use stdout here, unlike above. MSVC reports compilation warnings and errors on stdout.
             raise CompilationFailedException(e.command, e.stdout)
 
-    def compile_and_link(self, source, include_dirs, output_file_name, args=[]):
+    def compile_and_link(self, source, include_dirs, output_file_name, args=[], linker_args=[], position_independent=False):
+        # Here compiling and linking are done in a single command, so the time is all reported in the 'compile' phase.
+        # position_independent is ignored, there's no such distinction with MSVC.
         self._compile(
             include_dirs,
             args = (
                 [source]
                 + ADDITIONAL_LINKER_FLAGS.split()
                 + args
+                + linker_args
                 + ['/Fe' + output_file_name]
             ))
 
@@ -134,11 +430,21 @@ class MsvcCompiler:
             + include_flags
             + args
         )
-        run_command(self.executable, args)
+        # We don't collect the included files with MSVC, so tests always count as depending on all files.
+        _add_dependencies(_Dependencies(complete=False))
+        run_command(self.executable, args, phase='compile')
+
+    def get_dependencies(self, source, include_dirs, args=[]):
+        return None
 
     def get_disable_deprecation_warning_flags(self):
         return ['/wd4996']
 
+    def get_version(self):
+        # MSVC doesn't have a --version flag, but it prints its version (followed by a usage message) when it's run
+        # with no arguments.
+        return subprocess.run([self.executable], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True).stdout
+
 if CXX_COMPILER_NAME == 'MSVC':
     compiler = MsvcCompiler()
     if PATH_TO_COMPILED_FRUIT_LIB.endswith('.dll'):
@@ -162,10 +468,383 @@ fruit_tests_include_dirs=[
     PATH_TO_FRUIT_GENERATED_HEADERS,
 ]
 
+executable_suffix = {'posix': '', 'nt': '.exe'}[os.name]
+
 _assert_helper = unittest.TestCase()
 
+def _hash_files(h, file_names):
+    for file_name in file_names:
+        h.update(file_name.encode('utf-8'))
+        with open(file_name, 'rb') as file:
+            h.update(file.read())
+
+@memoize(maxsize=None)
+def _get_compiler_fingerprint():
+    h = hashlib.sha256()
+    h.update(repr((CXX, CXX_COMPILER_NAME, compiler.get_version(), FRUIT_COMPILE_FLAGS, ADDITIONAL_LINKER_FLAGS,
+                    _uses_clang_modules())).encode('utf-8'))
+    return h.hexdigest()
+
+@memoize(maxsize=None)
+def _get_headers_fingerprint():
+    h = hashlib.sha256()
+    for include_dir in fruit_tests_include_dirs:
+        header_file_names = []
+        for dir_path, dir_names, file_names in os.walk(include_dir):
+            dir_names.sort()
+            header_file_names += [os.path.join(dir_path, file_name) for file_name in sorted(file_names) if file_name.endswith('.h')]
+        _hash_files(h, header_file_names)
+    return h.hexdigest()
+
+@memoize(maxsize=None)
+def _get_library_fingerprint():
+    h = hashlib.sha256()
+    for pattern in ('libfruit.*', 'fruit.dll', 'fruit.lib'):
+        _hash_files(h, sorted(glob.glob(os.path.join(PATH_TO_COMPILED_FRUIT, pattern))))
+    return h.hexdigest()
+
+def _get_toolchain_fingerprint():
+    """Returns a hash of everything (other than the test's source code and flags) that can affect compilation results."""
+    return _get_compiler_fingerprint() + _get_headers_fingerprint() + _get_library_fingerprint()
+
+def _compute_cache_key(kind, source_code, args):
+    h = hashlib.sha256()
+    # The dependencies stored with an entry are only known if they were recorded when it was created.
+    h.update(repr((_get_toolchain_fingerprint(), kind, source_code, args, record_dependencies)).encode('utf-8'))
+    return h.hexdigest()
+
+class CompilationCache:
+    """
+    A persistent on-disk cache for the results of compiling test sources, shared between test runs and between
+    pytest-xdist workers.
+
+    Entries are keyed using _compute_cache_key(), so any change to the source code, the compiler, the flags, the Fruit
+    headers or the Fruit library results in a cache miss.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def _get_entry_path(self, key, suffix):
+        return os.path.join(self.cache_dir, key[:2], key + suffix)
+
+    def _store(self, key, suffix, write_fun):
+        entry_path = self._get_entry_path(key, suffix)
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+        file_descriptor, tmp_file_name = tempfile.mkstemp(dir=os.path.dirname(entry_path), suffix=suffix)
+        os.close(file_descriptor)
+        try:
+            write_fun(tmp_file_name)
+            # This is atomic, so other workers will never see a partially-written entry.
+            os.replace(tmp_file_name, entry_path)
+        except:
+            try_remove_temporary_file(tmp_file_name)
+            raise
+        return entry_path
+
+    def get_executable(self, key, suffix=executable_suffix):
+        entry_path = self._get_entry_path(key, suffix)
+        if os.path.exists(entry_path):
+            return entry_path
+        return None
+
+    def put_executable(self, key, executable, suffix=executable_suffix):
+        return self._store(key, suffix, lambda file_name: shutil.copy2(executable, file_name))
+
+    def get_compilation_error(self, key):
+        entry_path = self._get_entry_path(key, '.json')
+        try:
+            with open(entry_path, 'r') as file:
+                entry = json.load(file)
+        except (OSError, ValueError):
+            return None
+        return CompilationFailedException(entry['command'], entry['error_message'])
+
+    def put_compilation_error(self, key, e):
+        def write(file_name):
+            with open(file_name, 'w') as file:
+                json.dump({'command': e.command, 'error_message': e.error_message}, file)
+        self._store(key, '.json', write)
+
+    def get_dependencies(self, key):
+        """Returns the _Dependencies of the entry with the given key (unknown if they weren't stored)."""
+        entry_path = self._get_entry_path(key, '.deps.json')
+        try:
+            with open(entry_path, 'r') as file:
+                return _Dependencies.from_json(json.load(file))
+        except (OSError, ValueError, KeyError):
+            return _Dependencies(complete=False)
+
+    def put_dependencies(self, key, dependencies):
+        def write(file_name):
+            with open(file_name, 'w') as file:
+                json.dump(dependencies.to_json(), file)
+        self._store(key, '.deps.json', write)
+
+    def has_valgrind_success(self, key):
+        return os.path.exists(self._get_entry_path(key, '.valgrind'))
+
+    def put_valgrind_success(self, key):
+        self._store(key, '.valgrind', lambda file_name: None)
+
+_compilation_cache_dir = _get_config_value('FRUIT_TESTS_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'fruit-tests-cache'))
+if _compilation_cache_dir:
+    compilation_cache = CompilationCache(_compilation_cache_dir)
+else:
+    compilation_cache = None
+
+@contextlib.contextmanager
+def _file_lock(lock_file_name):
+    with open(lock_file_name, 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def _uses_clang_modules():
+    return (_is_enabled(_get_config_value('FRUIT_TESTS_USE_CLANG_MODULES', 'false'))
+            and CXX_COMPILER_NAME in ('Clang', 'AppleClang'))
+
+def _get_clang_modules_flags():
+    """
+    Returns the flags needed to import the Fruit headers as a Clang module (using include/fruit/module.modulemap), or an
+    empty list if Clang modules are disabled.
+
+    The module cache is shared between test runs and between pytest-xdist workers; Clang keys the cached modules by
+    compiler and flags, and rebuilds them when any of the headers changes.
+    """
+    if not _uses_clang_modules():
+        return []
+    cache_dir = os.path.join(_compilation_cache_dir or get_temporary_dir(), 'clang-modules')
+    return ['-fmodules', '-fmodules-cache-path=' + cache_dir]
+
+def _uses_precompiled_headers_from_config():
+    flags = FRUIT_COMPILE_FLAGS.split()
+    return not _uses_clang_modules() and any(flag.startswith('-include') for flag in flags)
+
+def _get_base_compile_flags(position_independent=False):
+    if _uses_clang_modules():
+        # The precompiled header in FRUIT_COMPILE_FLAGS (if any) was built without -fmodules, so it can't be used.
+        flags = _remove_include_flags(FRUIT_COMPILE_FLAGS.split()) + _get_clang_modules_flags()
+    elif position_independent:
+        # The precompiled header in FRUIT_COMPILE_FLAGS (if any) can't be used when compiling position-independent code.
+        flags = _remove_include_flags(FRUIT_COMPILE_FLAGS.split())
+    else:
+        flags = FRUIT_COMPILE_FLAGS.split()
+    if position_independent:
+        flags = flags + ['-fPIC']
+    return flags
+
+@memoize(maxsize=None)
+def _get_precompiled_header_flags(position_independent=False):
+    """
+    Returns the flags needed to use a precompiled version of test_common.h, building it first if necessary.
+
+    The precompiled header is shared between test runs and between pytest-xdist workers. It's keyed by the compiler,
+    the flags and the content of the headers, so it's rebuilt when any of them changes.
+    This returns an empty list (so tests are compiled without a precompiled header) if precompiled headers are disabled,
+    if the build already provides one through FRUIT_COMPILE_FLAGS (e.g. the CMake build) or if the precompiled header
+    can't be built or used. Precompiled headers are also not used with Clang modules, that already avoid re-parsing the
+    Fruit headers in each test.
+
+    :param position_independent: Whether the precompiled header will be used to compile position-independent code.
+    """
+    if (not _is_enabled(_get_config_value('FRUIT_TESTS_USE_PRECOMPILED_HEADERS', 'true'))
+            or CXX_COMPILER_NAME not in ('GNU', 'Clang', 'AppleClang')
+            or _uses_clang_modules()
+            or fcntl is None
+            or (_uses_precompiled_headers_from_config() and not position_independent)):
+        return []
+
+    compile_flags = _get_base_compile_flags(position_independent)
+    key = hashlib.sha256((_get_compiler_fingerprint() + _get_headers_fingerprint() + str(position_independent)).encode('utf-8')).hexdigest()
+    output_dir = os.path.join(_compilation_cache_dir or tempfile.gettempdir(), 'pch-' + key)
+    flags_file_name = os.path.join(output_dir, 'flags.json')
+    try:
+        os.makedirs(output_dir, exist_ok=True)
+        with _file_lock(output_dir + '.lock'):
+            if os.path.exists(flags_file_name):
+                with open(flags_file_name, 'r') as file:
+                    flags = json.load(file)
+            else:
+                flags = compiler.build_precompiled_header(
+                    header=os.path.join(PATH_TO_FRUIT_TEST_HEADERS, 'test_common.h'),
+                    include_dirs=fruit_tests_include_dirs,
+                    output_dir=output_dir,
+                    compile_flags=compile_flags)
+                with open(flags_file_name, 'w') as file:
+                    json.dump(flags, file)
+
+        # Check that the compiler can actually use the precompiled header before using it in tests, otherwise all tests
+        # would fail.
+        validation_source_file_name = _create_temporary_file('#include "test_common.h"\nint main() {}\n', file_name_suffix='.cpp')
+        include_flags = ['-I%s' % include_dir for include_dir in fruit_tests_include_dirs]
+        run_command(CXX, compile_flags + flags + include_flags + ['-g0', '-Winvalid-pch', '-fsyntax-only', validation_source_file_name])
+        try_remove_temporary_file(validation_source_file_name)
+    except CommandFailedException as e:
+        warnings.warn('Unable to use a precompiled header in tests, compiling tests without it.\n%s' % e)
+        return []
+    return flags
+
+def _parse_depfile(depfile_name):
+    """Returns the set of (absolute) paths of the dependencies listed in a Makefile-style depfile."""
+    with open(depfile_name, 'r') as file:
+        content = file.read().replace('\\\n', ' ')
+    files = set()
+    for rule in content.splitlines():
+        if ':' not in rule:
+            continue
+        _, dependencies = rule.split(':', 1)
+        for dependency in re.split(r'(?<!\\)\s+', dependencies.strip()):
+            if dependency:
+                files.add(os.path.realpath(dependency.replace('\\ ', ' ')))
+    return files
+
+def _remove_include_flags(flags):
+    result = []
+    skip_next_flag = False
+    for flag in flags:
+        if skip_next_flag:
+            skip_next_flag = False
+        elif flag in ('-include', '-include-pch'):
+            skip_next_flag = True
+        elif not flag.startswith('-include'):
+            result.append(flag)
+    return result
+
+@memoize(maxsize=None)
+def _get_precompiled_header_dependencies():
+    """
+    Returns the files included by test_common.h if it's precompiled, otherwise an empty set.
+
+    When using a precompiled header, the compiler doesn't list the headers included by it in the depfile of a test.
+    """
+    if not (_uses_precompiled_headers_from_config() or _get_precompiled_header_flags()):
+        return frozenset()
+    return frozenset(compiler.get_dependencies(
+        os.path.join(PATH_TO_FRUIT_TEST_HEADERS, 'test_common.h'),
+        include_dirs=fruit_tests_include_dirs,
+        args=['-x', 'c++-header']))
+
+def get_fruit_library_dependencies():
+    """
+    Returns the set of files (the sources and the headers that they include) that the Fruit library is built from, or
+    None if that can't be determined with this compiler.
+    """
+    source_dir = os.path.realpath(os.path.join(PATH_TO_FRUIT_STATIC_HEADERS, '..', 'src'))
+    files = set()
+    for source in sorted(glob.glob(os.path.join(source_dir, '*.cpp'))):
+        source_dependencies = compiler.get_dependencies(source, include_dirs=fruit_tests_include_dirs)
+        if source_dependencies is None:
+            return None
+        files |= source_dependencies
+    return files
+
+class _Dependencies:
+    """
+    The files that one or more compiled test sources depend on (see recording_dependencies()).
+
+    :ivar complete: False if some of the dependencies are unknown (e.g. because the compiler was stopped before writing
+          the depfile), in which case the test should be considered as depending on all files.
+    :ivar links_fruit: True if the test is linked with the Fruit library (so it depends on its sources too).
+    """
+    def __init__(self, files=(), complete=True, links_fruit=False):
+        self.files = set(files)
+        self.complete = complete
+        self.links_fruit = links_fruit
+
+    def update(self, other):
+        self.files |= other.files
+        self.complete = self.complete and other.complete
+        self.links_fruit = self.links_fruit or other.links_fruit
+
+    def to_json(self):
+        return {'files': sorted(self.files), 'complete': self.complete, 'links_fruit': self.links_fruit}
+
+    @staticmethod
+    def from_json(value):
+        return _Dependencies(files=value['files'], complete=value['complete'], links_fruit=value['links_fruit'])
+
+# The _Dependencies objects that are currently being filled in, see recording_dependencies().
+_dependency_recorders = []
+
+@contextlib.contextmanager
+def recording_dependencies():
+    """
+    While this context manager is active, the harness records the files that the compiled test sources depend on (as
+    reported by the compiler), including the ones of sources whose compilation results were found in the compilation
+    cache or in a batch.
+
+    :returns: A _Dependencies object, filled in as tests are compiled.
+    """
+    dependencies = _Dependencies()
+    _dependency_recorders.append(dependencies)
+    try:
+        yield dependencies
+    finally:
+        _dependency_recorders.remove(dependencies)
+
+def _add_dependencies(dependencies):
+    for recorder in _dependency_recorders:
+        recorder.update(dependencies)
+
+# Set by conftest.py (see --changed-since). When this is False, the compiler is not asked to write depfiles, so the
+# _Dependencies recorded by recording_dependencies() are always incomplete.
+record_dependencies = False
+
+# Set by conftest.py (see --keep-failed-artifacts). When this is True, the temporary directory is not removed at exit, so
+# that the sources and executables of the tests that failed can be inspected. This also disables passing sources to the
+# compiler through stdin, so that the sources are available too.
+keep_failed_artifacts = False
+
+def _is_usable_temporary_dir(dir_name):
+    # Executables are built in the temporary directory, so we can't use it if it's on a filesystem mounted with noexec.
+    try:
+        file_descriptor, file_name = tempfile.mkstemp(dir=dir_name)
+    except OSError:
+        return False
+    try:
+        os.close(file_descriptor)
+        os.chmod(file_name, 0o700)
+        return os.access(file_name, os.X_OK)
+    finally:
+        os.remove(file_name)
+
+@memoize(maxsize=None)
+def get_temporary_dir():
+    """
+    Returns the directory (private to this process, so to each pytest-xdist worker) where the harness creates its
+    temporary files. This is on tmpfs (/dev/shm) when available, unless FRUIT_TESTS_TEMP_DIR specifies a different
+    parent directory. The directory is removed at exit, unless keep_failed_artifacts is True.
+    """
+    parent_dir = _get_config_value('FRUIT_TESTS_TEMP_DIR', '')
+    if not parent_dir:
+        parent_dir = '/dev/shm' if os.path.isdir('/dev/shm') and _is_usable_temporary_dir('/dev/shm') else tempfile.gettempdir()
+    temporary_dir = tempfile.mkdtemp(prefix='fruit-tests-%s-' % os.environ.get('PYTEST_XDIST_WORKER', 'main'), dir=parent_dir)
+    atexit.register(_remove_temporary_dir, temporary_dir)
+    return temporary_dir
+
+def _remove_temporary_dir(temporary_dir):
+    if not keep_failed_artifacts:
+        shutil.rmtree(temporary_dir, ignore_errors=True)
+
+class _StdinSource:
+    """A source that's passed to the compiler through stdin, instead of being written to a file."""
+    def __init__(self, source_code):
+        self.source_code = source_code
+
+def _create_source(source_code):
+    """
+    :returns: A pair (source, temporary_files), where source can be passed to the methods of the compiler and
+              temporary_files is the list of files that should be removed once the test completes successfully.
+    """
+    if compiler.supports_stdin_sources and not keep_failed_artifacts:
+        return _StdinSource(source_code), []
+    source_file_name = _create_temporary_file(source_code, file_name_suffix='.cpp')
+    return source_file_name, [source_file_name]
+
 def _create_temporary_file(file_content, file_name_suffix=''):
-    file_descriptor, file_name = tempfile.mkstemp(text=True, suffix=file_name_suffix)
+    file_descriptor, file_name = tempfile.mkstemp(text=True, suffix=file_name_suffix, dir=get_temporary_dir())
     file = os.fdopen(file_descriptor, mode='w')
     file.write(file_content)
     file.close()
@@ -198,39 +877,818 @@ def try_remove_temporary_file(filename):
         # This shouldn't cause the tests to fail, so we ignore the exception and go ahead.
         pass
 
-def expect_compile_error_helper(
-        check_error_fun,
-        setup_source_code,
-        source_code,
-        test_params={},
-        ignore_deprecation_warnings=False):
-    source_code = _construct_final_source_code(setup_source_code, source_code, test_params)
+_link_mode = _get_config_value('FRUIT_TESTS_LINK_MODE', 'shared')
+if _link_mode not in ('shared', 'static'):
+    raise Exception('Unknown FRUIT_TESTS_LINK_MODE: %s (expected "shared" or "static")' % _link_mode)
 
-    source_file_name = _create_temporary_file(source_code, file_name_suffix='.cpp')
+# The linkers (besides the compiler's default one) that are measured when FRUIT_TESTS_LINKER is "auto".
+_auto_linker_candidates = ('mold', 'lld', 'gold')
+
+@memoize(maxsize=None)
+def _get_static_fruit_library():
+    """
+    Returns the path of a static Fruit library. If the build only provides a shared one, this builds a static one from
+    the sources in src/ (with the same flags used for the tests), and stores it in the cache directory.
+    """
+    if PATH_TO_COMPILED_FRUIT_LIB.endswith('.a'):
+        return PATH_TO_COMPILED_FRUIT_LIB
+    if fcntl is None:
+        raise Exception('FRUIT_TESTS_LINK_MODE=static is not supported on this platform unless Fruit is built as a static library.')
+
+    source_dir = os.path.realpath(os.path.join(PATH_TO_FRUIT_STATIC_HEADERS, '..', 'src'))
+    sources = sorted(glob.glob(os.path.join(source_dir, '*.cpp')))
+    h = hashlib.sha256((_get_compiler_fingerprint() + _get_headers_fingerprint()).encode('utf-8'))
+    _hash_files(h, sources)
+    output_dir = os.path.join(_compilation_cache_dir or get_temporary_dir(), 'libfruit-' + h.hexdigest())
+    library = os.path.join(output_dir, 'libfruit.a')
+    os.makedirs(output_dir, exist_ok=True)
+    with _file_lock(output_dir + '.lock'):
+        if not os.path.exists(library):
+            compile_flags = (
+                _remove_include_flags(FRUIT_COMPILE_FLAGS.split())
+                + ['-I' + PATH_TO_FRUIT_STATIC_HEADERS, '-I' + PATH_TO_FRUIT_GENERATED_HEADERS])
+            object_files = []
+            for source in sources:
+                object_file = os.path.join(output_dir, os.path.basename(source) + '.o')
+                run_command(CXX, compile_flags + ['-c', source, '-o', object_file], phase='static_library')
+                object_files.append(object_file)
+            run_command('ar', ['rcs', library + '.tmp'] + object_files, phase='static_library')
+            os.replace(library + '.tmp', library)
+            for object_file in object_files:
+                try_remove_temporary_file(object_file)
+    return library
+
+def _get_linker_flags(linker):
+    return [] if linker == 'default' else ['-fuse-ld=' + linker]
+
+def _measure_link_time(linker, source_file_name, output_file_name, num_runs=3):
+    """
+    Returns the shortest time (over num_runs links) to link a trivial program with Fruit using the given linker, or None
+    if the linker can't link it.
+    """
+    # This doesn't use run_command(), so that the measurement doesn't include the time spent waiting for the jobserver.
+    command = ([CXX, '-g0', source_file_name] + ADDITIONAL_LINKER_FLAGS.split() + _get_linker_flags(linker)
+               + _get_fruit_library_flags() + ['-o', output_file_name])
+    link_times = []
+    for _ in range(num_runs):
+        start_time = time.perf_counter()
+        try:
+            result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except OSError:
+            return None
+        if result.returncode != 0:
+            return None
+        link_times.append(time.perf_counter() - start_time)
+    return min(link_times)
+
+@memoize(maxsize=None)
+def select_fastest_linker():
+    """
+    Returns the linker (either "default" or one of _auto_linker_candidates) that links a trivial program with Fruit in
+    the shortest time, measuring each one that's available.
+
+    This is used for FRUIT_TESTS_LINKER=auto. conftest.py calls this once per session (in the pytest-xdist controller,
+    if any) and passes the result to the workers by setting FRUIT_TESTS_LINKER.
+    """
+    if CXX_COMPILER_NAME == 'MSVC' or not sys.platform.startswith('linux'):
+        return 'default'
+    source_file_name = _create_temporary_file('int main() {}\n', file_name_suffix='.cpp')
+    output_file_name = _create_temporary_file('', executable_suffix)
+    try:
+        link_time_by_linker = {}
+        for linker in ('default',) + _auto_linker_candidates:
+            link_time = _measure_link_time(linker, source_file_name, output_file_name)
+            if link_time is not None:
+                link_time_by_linker[linker] = link_time
+    finally:
+        try_remove_temporary_file(source_file_name)
+        try_remove_temporary_file(output_file_name)
+    if not link_time_by_linker:
+        return 'default'
+    return min(link_time_by_linker, key=link_time_by_linker.get)
+
+def get_linker_setting():
+    return _get_config_value('FRUIT_TESTS_LINKER', 'default')
+
+@memoize(maxsize=None)
+def _get_linker_selection_flags():
+    """
+    Returns the flags that select the linker used to link tests, according to FRUIT_TESTS_LINKER.
+
+    This can be "default" (the default, use the compiler's default linker), the name of a linker to pass to -fuse-ld=
+    (e.g. "lld" or "gold") or "auto", that selects the linker that links a trivial program with Fruit the fastest (see
+    select_fastest_linker()).
+    """
+    if CXX_COMPILER_NAME == 'MSVC':
+        return []
+    linker = get_linker_setting()
+    if linker == 'auto':
+        linker = select_fastest_linker()
+    return _get_linker_flags(linker)
+
+def _get_fruit_library_flags():
+    if _link_mode == 'static' and CXX_COMPILER_NAME != 'MSVC':
+        return [_get_static_fruit_library()]
+    return fruit_tests_linker_flags
+
+def _get_fruit_tests_linker_flags():
+    """Returns the flags used to link tests with Fruit, see FRUIT_TESTS_LINK_MODE and FRUIT_TESTS_LINKER."""
+    return _get_linker_selection_flags() + _get_fruit_library_flags()
+
+def _compile_and_link(source_code, ignore_deprecation_warnings, shared_object=False, extra_linker_args=[]):
+    """
+    Compiles and links the given source code, reusing a previously-built executable from the compilation cache (if any).
+
+    :param shared_object: If True, this builds a shared object (to be loaded by the dlopen test host) instead of an
+           executable.
+    :returns: A pair (executable, temporary_files), where temporary_files is the list of files that should be removed
+              once the test completes successfully.
+    """
+    args = []
+    if ignore_deprecation_warnings:
+        args += compiler.get_disable_deprecation_warning_flags()
+    linker_args = extra_linker_args + _get_fruit_tests_linker_flags()
+    if shared_object:
+        linker_args = ['-shared'] + linker_args
+        suffix = '.so'
+    else:
+        suffix = executable_suffix
+
+    _add_dependencies(_Dependencies(links_fruit=True))
+    if compilation_cache:
+        cache_key = _compute_cache_key('shared_object' if shared_object else 'executable', source_code, args + linker_args)
+        executable = compilation_cache.get_executable(cache_key, suffix)
+        if executable:
+            _add_dependencies(compilation_cache.get_dependencies(cache_key))
+            return executable, []
+
+    source, temporary_files = _create_source(source_code)
+    output_file_name = _create_temporary_file('', suffix)
+    with recording_dependencies() as dependencies:
+        compiler.compile_and_link(
+            source=source,
+            include_dirs=fruit_tests_include_dirs,
+            output_file_name=output_file_name,
+            args=args,
+            linker_args=linker_args,
+            position_independent=shared_object)
+
+    if compilation_cache:
+        compilation_cache.put_dependencies(cache_key, dependencies)
+        compilation_cache.put_executable(cache_key, output_file_name, suffix)
+
+    return output_file_name, temporary_files + [output_file_name]
+
+_execution_backend = _get_config_value('FRUIT_TESTS_EXECUTION_BACKEND', 'executable')
+if _execution_backend not in ('executable', 'dlopen'):
+    raise Exception('Unknown FRUIT_TESTS_EXECUTION_BACKEND: %s (expected "executable" or "dlopen")' % _execution_backend)
+
+def _uses_dlopen_backend():
+    # Running a test under valgrind requires a separate executable. The dlopen backend also relies on fork() and
+    # dlopen(), so it's not available with MSVC. The test host shares the Fruit library with the tests, so it's also
+    # not used when linking tests with a static Fruit library.
+    return (_execution_backend == 'dlopen' and CXX_COMPILER_NAME != 'MSVC' and not _is_enabled(RUN_TESTS_UNDER_VALGRIND)
+            and _link_mode == 'shared')
+
+class _DlopenTestHost:
+    """
+    A long-lived process (see dlopen_test_host.cpp) that runs tests built as shared objects, each in a forked child
+    process.
+    """
+    def __init__(self, executable, temporary_files):
+        self.executable = executable
+        self.temporary_files = temporary_files
+        self.process = subprocess.Popen([executable], stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True)
+
+    def run(self, shared_object, args=[], phase=None):
+        """Runs the test in the given shared object. This has the same interface and behavior as run_command()."""
+        if args:
+            raise Exception('The dlopen test host does not support passing arguments to tests')
+        command = [self.executable, shared_object]
+        stdout_file_name = _create_temporary_file('')
+        stderr_file_name = _create_temporary_file('')
+        jobserver_client = _get_jobserver_client()
+        try:
+            with jobserver_client.job_token() if jobserver_client else contextlib.suppress():
+                start_time = time.perf_counter()
+                self.process.stdin.write('%s\t%s\t%s\n' % (shared_object, stdout_file_name, stderr_file_name))
+                self.process.stdin.flush()
+                response = self.process.stdout.readline()
+                wall_time = time.perf_counter() - start_time
+            if not response:
+                raise Exception('The dlopen test host terminated unexpectedly while executing: %s' % command)
+            returncode, max_rss = [int(value) for value in response.split()]
+            with open(stdout_file_name, 'r') as file:
+                stdout = file.read()
+            with open(stderr_file_name, 'r') as file:
+                stderr = file.read()
+        finally:
+            try_remove_temporary_file(stdout_file_name)
+            try_remove_temporary_file(stderr_file_name)
+        _record_phase(phase, wall_time, _max_rss_to_bytes(max_rss))
+        if returncode != 0:
+            raise CommandFailedException(command, stdout, stderr, returncode)
+        return (stdout, stderr)
+
+    def close(self):
+        # The host exits when its stdin is closed.
+        self.process.stdin.close()
+        self.process.wait()
+        for file_name in self.temporary_files:
+            try_remove_temporary_file(file_name)
+
+@memoize(maxsize=None)
+def _get_dlopen_test_host():
+    with open(os.path.join(PATH_TO_FRUIT_TEST_HEADERS, 'dlopen_test_host.cpp'), 'r') as file:
+        source_code = file.read()
+    extra_linker_args = ['-ldl']
+    if sys.platform.startswith('linux'):
+        # The host doesn't use libfruit directly, but it must be linked with it so that the tests don't load it again.
+        extra_linker_args = ['-Wl,--no-as-needed'] + extra_linker_args
+    executable, temporary_files = _compile_and_link(source_code, ignore_deprecation_warnings=False, extra_linker_args=extra_linker_args)
+    host = _DlopenTestHost(executable, temporary_files)
+    atexit.register(host.close)
+    return host
+
+def _construct_shared_object_source_code(source_code):
+    """
+    Turns the source of a test into the source of a shared object for the dlopen test host, that exports a
+    fruit_test_entry_point() function instead of main().
+
+    :returns: The source of the shared object, or None if the test can't be run in the dlopen test host.
+    """
+    source_code = _rename_main(source_code, 'fruit_test_main')
+    if source_code is None:
+        return None
+    return source_code + textwrap.dedent('''
+        extern "C" int fruit_test_entry_point() {
+          return fruit_test_main();
+        }
+        ''')
+
+def _compile_and_link_for_backend(source_code, ignore_deprecation_warnings):
+    """
+    Like _compile_and_link(), but it builds a shared object instead if the test should run in the dlopen test host.
+
+    :returns: A tuple (executable, temporary_files, run_fun) where run_fun is the function that should be used to run
+              the executable (instead of run_command).
+    """
+    if _uses_dlopen_backend():
+        shared_object_source_code = _construct_shared_object_source_code(source_code)
+        if shared_object_source_code is not None:
+            shared_object, temporary_files = _compile_and_link(shared_object_source_code, ignore_deprecation_warnings, shared_object=True)
+            return shared_object, temporary_files, _get_dlopen_test_host().run
+    executable, temporary_files = _compile_and_link(source_code, ignore_deprecation_warnings)
+    return executable, temporary_files, run_command
+
+_valgrind_sampling_rate = float(_get_config_value('FRUIT_TESTS_VALGRIND_SAMPLING_RATE', '1'))
+if not 0 <= _valgrind_sampling_rate <= 1:
+    raise Exception('Invalid FRUIT_TESTS_VALGRIND_SAMPLING_RATE: %s (expected a number between 0 and 1)' % _valgrind_sampling_rate)
+_valgrind_sampling_seed = _get_config_value('FRUIT_TESTS_VALGRIND_SAMPLING_SEED', '')
+
+# Tests in these files, and tests whose source mentions one of these identifiers, exercise Fruit's memory management
+# (allocation and destruction of injected objects), so they always run under valgrind regardless of the sampling rate.
+_valgrind_always_test_files = ('test_class_destruction.py', 'test_fixed_size_allocator.py')
+_valgrind_always_source_identifiers = ('FixedSizeAllocator',)
+
+def _get_current_test_file():
+    # While running a test, pytest sets this to e.g. "tests/test_foo.py::test_bar[param] (call)".
+    current_test = os.environ.get('PYTEST_CURRENT_TEST', '')
+    return os.path.basename(current_test.split('::')[0])
+
+def _should_run_under_valgrind(source_code):
+    """
+    Returns whether a test with the given source should run under valgrind.
+
+    When RUN_TESTS_UNDER_VALGRIND is on, only a deterministic sample of the tests (a fraction
+    FRUIT_TESTS_VALGRIND_SAMPLING_RATE of them, chosen based on the hash of their source and of
+    FRUIT_TESTS_VALGRIND_SAMPLING_SEED) runs under valgrind, plus the tests that exercise memory management.
+    """
+    if not _is_enabled(RUN_TESTS_UNDER_VALGRIND):
+        return False
+    if (_get_current_test_file() in _valgrind_always_test_files
+            or any(identifier in source_code for identifier in _valgrind_always_source_identifiers)):
+        return True
+    h = hashlib.sha256((_valgrind_sampling_seed + source_code).encode('utf-8')).digest()
+    return int.from_bytes(h[:8], 'big') < _valgrind_sampling_rate * 2**64
+
+@memoize(maxsize=None)
+def _get_valgrind_fingerprint():
+    """
+    Returns a hash of the valgrind version, of VALGRIND_FLAGS and of the content of the suppression files passed in
+    VALGRIND_FLAGS. These are read once per pytest-xdist worker.
+    """
+    flags = VALGRIND_FLAGS.split()
+    version, _ = run_command('valgrind', ['--version'])
+    h = hashlib.sha256()
+    h.update(repr((version, flags)).encode('utf-8'))
+    _hash_files(h, [flag[len('--suppressions='):] for flag in flags if flag.startswith('--suppressions=')])
+    return h.hexdigest()
+
+def _run_under_valgrind(executable, executable_args=[]):
+    """
+    Runs the given executable under valgrind, unless the same executable already ran successfully under valgrind with
+    the same arguments, flags and suppressions (in this or in a previous test run).
+    """
+    cache_key = None
+    if compilation_cache is not None:
+        h = hashlib.sha256()
+        h.update(repr((_get_valgrind_fingerprint(), executable_args)).encode('utf-8'))
+        with open(executable, 'rb') as file:
+            h.update(file.read())
+        cache_key = h.hexdigest()
+        if compilation_cache.has_valgrind_success(cache_key):
+            return
+
+    run_command('valgrind', VALGRIND_FLAGS.split() + [executable] + executable_args, phase='valgrind')
+
+    if cache_key is not None:
+        compilation_cache.put_valgrind_success(cache_key)
 
+# When this is not None, the expect_* functions don't run tests; they just record a _RecordedCall in this list.
+_recorded_calls = None
+
+_RecordedCall = collections.namedtuple('_RecordedCall', ['kind', 'source_code', 'ignore_deprecation_warnings'])
+
+@contextlib.contextmanager
+def recording_test_calls():
+    """
+    While this context manager is active, calls to the expect_* functions don't compile or run anything: they only
+    record the (final) source code of the test, so that the harness can later build many tests at once.
+    """
+    global _recorded_calls
+    previous_recorded_calls = _recorded_calls
+    _recorded_calls = []
     try:
+        yield _recorded_calls
+    finally:
+        _recorded_calls = previous_recorded_calls
+
+def _record_call(kind, source_code, ignore_deprecation_warnings):
+    if _recorded_calls is None:
+        return False
+    _recorded_calls.append(_RecordedCall(kind, source_code, ignore_deprecation_warnings))
+    return True
+
+_BATCH_MAIN_REGEX = re.compile(r'\bint\s+main\s*\(\s*\)\s*\{')
+
+def _find_matching_brace(source_code, open_brace_index):
+    depth = 0
+    i = open_brace_index
+    while i < len(source_code):
+        if source_code.startswith('//', i):
+            i = source_code.find('\n', i)
+            if i == -1:
+                return None
+            continue
+        if source_code.startswith('/*', i):
+            i = source_code.find('*/', i)
+            if i == -1:
+                return None
+            i += 2
+            continue
+        c = source_code[i]
+        if c in '"\'':
+            i += 1
+            while i < len(source_code) and source_code[i] != c:
+                if source_code[i] == '\\':
+                    i += 1
+                i += 1
+        elif c == '{':
+            depth += 1
+        elif c == '}':
+            depth -= 1
+            if depth == 0:
+                return i
+        i += 1
+    return None
+
+def _namespace_scope_statements(source_code):
+    """
+    Returns the declarations at namespace scope in source_code (without the trailing ';'), with the content of braces
+    other than namespace bodies replaced by '{}'. Returns None if the braces aren't balanced.
+    """
+    statements = []
+    statement = ''
+    i = 0
+    while i < len(source_code):
+        if source_code.startswith('//', i):
+            i = source_code.find('\n', i)
+            if i == -1:
+                break
+            continue
+        if source_code.startswith('/*', i):
+            i = source_code.find('*/', i)
+            if i == -1:
+                return None
+            i += 2
+            statement += ' '
+            continue
+        c = source_code[i]
+        if c in '"\'':
+            literal_start = i
+            i += 1
+            while i < len(source_code) and source_code[i] != c:
+                if source_code[i] == '\\':
+                    i += 1
+                i += 1
+            statement += source_code[literal_start:i + 1]
+        elif c == '{':
+            if re.search(r'\bnamespace\b[^;{}]*$', statement):
+                # The declarations in the namespace body are at namespace scope too.
+                statement = ''
+            else:
+                closing_brace_index = _find_matching_brace(source_code, i)
+                if closing_brace_index is None:
+                    return None
+                statement += '{}'
+                i = closing_brace_index
+                # Function definitions are not followed by ';', unlike class definitions and braced initializers.
+                if not source_code[i + 1:].lstrip().startswith(';'):
+                    statements.append(statement.strip())
+                    statement = ''
+        elif c == '}' or c == ';':
+            statements.append(statement.strip())
+            statement = ''
+        else:
+            statement += c
+        i += 1
+    statements.append(statement.strip())
+    return [' '.join(statement.split()) for statement in statements if statement.strip()]
+
+_NON_VARIABLE_DECLARATION_REGEX = re.compile(
+    r'(using|typedef|template|struct|class|union|enum|namespace|static_assert|extern|friend)\b|.*\boperator\b')
+_CONSTANT_INITIALIZED_VARIABLE_REGEX = re.compile(
+    r'(static |const )*(bool|char|int|unsigned|long|short|float|double|std::size_t|size_t)\b[\w\s:*&]*'
+    + r'(= *(true|false|nullptr|[-+.\w]+|"[^"]*"|\'[^\']*\'))?$')
+
+def _has_dynamic_initialization(statement):
+    """
+    Returns True if statement (as returned by _namespace_scope_statements()) might define a variable with a non-trivial
+    initialization, i.e. one that runs code at startup. This errs on the side of returning True.
+    """
+    if _NON_VARIABLE_DECLARATION_REGEX.match(statement) or re.search(r'\bconstexpr\b', statement):
+        return False
+    paren_index = statement.find('(')
+    equals_index = statement.find('=')
+    if paren_index != -1 and (equals_index == -1 or paren_index < equals_index):
+        # A function declaration or definition.
+        return False
+    return not _CONSTANT_INITIALIZED_VARIABLE_REGEX.match(statement)
+
+def _split_batchable_source(source_code, requires_main=True):
+    """
+    Prepares a test source to be put in its own namespace in a batch translation unit.
+
+    :returns: None if the source can't be batched, otherwise a pair (include_lines, body) where include_lines are the
+              #include directives (that must be moved at global scope) and body is the rest of the source, with main()
+              renamed to fruit_batch_main(). #include lines are replaced with empty lines in body, so that line numbers
+              in body match the ones in the original source.
+    """
+    include_lines = []
+    body_lines = []
+    for line in source_code.splitlines():
+        stripped_line = line.strip()
+        if stripped_line.startswith('#'):
+            if not re.match(r'#\s*include\b', stripped_line):
+                # Other preprocessor directives (e.g. #define) would leak into the other tests in the batch.
+                return None
+            include_lines.append(stripped_line)
+            body_lines.append('')
+        else:
+            body_lines.append(line)
+    body = '\n'.join(body_lines)
+
+    if re.search(r'\bnamespace\s+std\b', body):
+        # Specializations of std templates must be at global scope.
+        return None
+
+    if requires_main:
+        statements = _namespace_scope_statements(body)
+        if statements is None or any(_has_dynamic_initialization(statement) for statement in statements):
+            # The batch executable runs the static initializers of all the tests in the batch, not just the selected
+            # one.
+            return None
+
+    if not requires_main and not _BATCH_MAIN_REGEX.search(body) and 'main(' not in body:
+        return include_lines, body
+    body = _rename_main(body, 'fruit_batch_main')
+    if body is None:
+        return None
+    return include_lines, body
+
+def _rename_main(source_code, function_name):
+    """
+    Renames the main() function defined in source_code to function_name (making it return 0 at the end, like main()).
+
+    :returns: The modified source code, or None if it doesn't contain exactly one main() function that can be renamed.
+    """
+    main_matches = list(_BATCH_MAIN_REGEX.finditer(source_code))
+    if len(main_matches) != 1:
+        return None
+    [main_match] = main_matches
+    closing_brace_index = _find_matching_brace(source_code, main_match.end() - 1)
+    if closing_brace_index is None:
+        return None
+    # Unlike main(), other functions don't implicitly return 0.
+    return (source_code[:main_match.start()]
+            + 'int %s() {' % function_name
+            + source_code[main_match.end():closing_brace_index]
+            + ' return 0; }'
+            + source_code[closing_brace_index + 1:])
+
+def _construct_batch_source_code(source_codes, with_dispatcher=True):
+    """
+    Constructs a translation unit containing all the given test sources, each in its own namespace, and (if
+    with_dispatcher is True) a main() that runs the fruit_batch_main() of the test whose index is passed as the only
+    argument.
+
+    :returns: A pair (batch_source_code, line_ranges), where line_ranges[i] is the (1-based, inclusive) range of lines of
+              batch_source_code that come from source_codes[i].
+    """
+    include_lines = ['#include <cstdlib>']
+    bodies = []
+    for source_code in source_codes:
+        source_include_lines, body = _split_batchable_source(source_code, requires_main=with_dispatcher)
+        include_lines += [line for line in source_include_lines if line not in include_lines]
+        bodies.append(body)
+
+    lines = include_lines
+    line_ranges = []
+    for index, body in enumerate(bodies):
+        lines.append('namespace fruit_batch_%s {' % index)
+        first_line = len(lines) + 1
+        lines += body.splitlines()
+        line_ranges.append((first_line, len(lines)))
+        lines.append('} // namespace fruit_batch_%s' % index)
+
+    if not with_dispatcher:
+        return '\n'.join(lines) + '\n', line_ranges
+
+    lines.append('int main(int argc, char* argv[]) {')
+    lines.append('  if (argc != 2) {')
+    lines.append('    return 1;')
+    lines.append('  }')
+    lines.append('  switch (std::atoi(argv[1])) {')
+    for index in range(len(bodies)):
+        lines.append('  case %s: return fruit_batch_%s::fruit_batch_main();' % (index, index))
+    lines.append('  default: return 1;')
+    lines.append('  }')
+    lines.append('}')
+    return '\n'.join(lines) + '\n', line_ranges
+
+def _find_sources_with_errors(error_message, line_ranges):
+    """Returns the indexes of the batched sources that are referenced by the error message."""
+    indexes = set()
+    for match in re.finditer(r'(?:\.cpp|<stdin>)[:(](\d+)', error_message):
+        line_number = int(match.group(1))
+        for index, (first_line, last_line) in enumerate(line_ranges):
+            if first_line <= line_number <= last_line:
+                indexes.add(index)
+    return indexes
+
+# Maps (source_code, ignore_deprecation_warnings) to (executable, index, dependencies) for the tests that were built as
+# part of a batch. Such tests are run by passing their index to the batch executable, instead of being compiled
+# separately.
+_batched_executables = dict()
+
+_batch_temporary_files = []
+
+@atexit.register
+def _remove_batch_temporary_files():
+    for file_name in _batch_temporary_files:
+        try_remove_temporary_file(file_name)
+
+# Compiling a batch can fail because of interactions between the batched sources; in that case we retry without the
+# sources mentioned in the error, a limited number of times.
+_MAX_BATCH_COMPILATION_ATTEMPTS = 3
+
+def prepare_success_batch(recorded_calls):
+    """
+    Builds a single executable containing all the tests recorded (using recording_test_calls()) for expect_success()
+    that can be safely batched together, so that subsequent expect_success() calls for those tests only need to run
+    it. Tests that can't be batched (or that break the batch compilation) are compiled separately as usual.
+    """
+    sources_by_flag = collections.defaultdict(list)
+    for call in recorded_calls:
+        if (call.kind == 'expect_success'
+                and (call.source_code, call.ignore_deprecation_warnings) not in _batched_executables
+                and call.source_code not in sources_by_flag[call.ignore_deprecation_warnings]
+                and _split_batchable_source(call.source_code) is not None):
+            sources_by_flag[call.ignore_deprecation_warnings].append(call.source_code)
+
+    for ignore_deprecation_warnings, source_codes in sources_by_flag.items():
+        for attempt in range(_MAX_BATCH_COMPILATION_ATTEMPTS):
+            if len(source_codes) < 2:
+                break
+            batch_source_code, line_ranges = _construct_batch_source_code(source_codes)
+            try:
+                with recording_dependencies() as dependencies:
+                    executable, temporary_files = _compile_and_link(batch_source_code, ignore_deprecation_warnings)
+            except CommandFailedException as e:
+                indexes_with_errors = _find_sources_with_errors(e.stderr + e.stdout, line_ranges)
+                if not indexes_with_errors:
+                    # We can't tell what went wrong, compile all these tests separately.
+                    break
+                source_codes = [source_code
+                                for index, source_code in enumerate(source_codes)
+                                if index not in indexes_with_errors]
+                continue
+            _batch_temporary_files.extend(temporary_files)
+            for index, source_code in enumerate(source_codes):
+                _batched_executables[(source_code, ignore_deprecation_warnings)] = (executable, index, dependencies)
+            break
+
+def _is_diagnostic_context_start(line):
+    # E.g. "In file included from foo.h:12," or "foo.h: In instantiation of 'struct Bar<int>':" (GCC).
+    return re.match(r'In file included from |\S.*: (In |At global scope:)', line) is not None
+
+def _is_include_context_line(line):
+    # E.g. "In file included from foo.h:12," and the "                 from bar.h:3:" lines that follow it (GCC).
+    return re.match(r'(In file included from |\s+from )\S.*:[0-9]+[,:]$', line) is not None
+
+def _is_error_line(line):
+    return re.search(r'\b(error|fatal error)( C[0-9]+)?:', line) is not None
+
+def _split_diagnostics(error_message):
+    """
+    Splits the compiler diagnostics into a list of blocks (lists of lines). Each block contains a single error, with the
+    context lines that the compiler emits before it (e.g. the template instantiation stack in GCC) and the notes that
+    the compiler emits after it (e.g. the template instantiation stack in Clang).
+    """
+    blocks = []
+    current_block = []
+    current_block_has_error = False
+    for line in error_message.splitlines():
+        if current_block_has_error and (_is_diagnostic_context_start(line) or _is_error_line(line)):
+            blocks.append(current_block)
+            current_block = []
+            current_block_has_error = False
+        current_block.append(line)
+        if _is_error_line(line):
+            current_block_has_error = True
+    if current_block:
+        blocks.append(current_block)
+    return blocks
+
+# Maps (source_code, ignore_deprecation_warnings) to a pair (e, dependencies) where e is a CompilationFailedException with
+# the diagnostics that were attributed to that source when compiling it as part of a batch.
+_batched_compilation_errors = dict()
+
+def prepare_compile_error_batch(recorded_calls):
+    """
+    Compiles all the tests recorded (using recording_test_calls()) for expect_compile_error() and
+    expect_generic_compile_error() as a single translation unit (each test in its own namespace), and attributes each
+    error to the test it comes from, based on the line numbers mentioned in the diagnostics.
+
+    When one of those tests then runs, its checks are performed on the diagnostics attributed to it. If there are none,
+    or if the checks fail (e.g. because the diagnostics were affected by other tests in the batch), the test is
+    compiled again on its own and checked as usual.
+
+    The diagnostics attributed to a test differ from those of a standalone compilation in the line numbers and in the
+    "In file included from" context, that the compiler only emits for the first error in each header (so in a batch
+    only the first test with an error in that header gets it). The checks don't depend on the former, and
+    _check_compilation_error() removes the latter (in both cases), so e.g. the position of the Fruit error checked by
+    expect_compile_error() is the same in a batch and on its own.
+    """
+    sources_by_flag = collections.defaultdict(list)
+    for call in recorded_calls:
+        if (call.kind == 'expect_compile_error'
+                and (call.source_code, call.ignore_deprecation_warnings) not in _batched_compilation_errors
+                and call.source_code not in sources_by_flag[call.ignore_deprecation_warnings]
+                and _split_batchable_source(call.source_code, requires_main=False) is not None):
+            sources_by_flag[call.ignore_deprecation_warnings].append(call.source_code)
+
+    for ignore_deprecation_warnings, source_codes in sources_by_flag.items():
+        if len(source_codes) < 2:
+            continue
+        batch_source_code, line_ranges = _construct_batch_source_code(source_codes, with_dispatcher=False)
         args = []
         if ignore_deprecation_warnings:
             args += compiler.get_disable_deprecation_warning_flags()
-        compiler.compile_discarding_output(
-            source=source_file_name,
-            include_dirs=fruit_tests_include_dirs,
-            args=args)
-        raise Exception('The test should have failed to compile, but it compiled successfully')
-    except CompilationFailedException as e1:
-        e = e1
 
-    error_message = e.error_message
-    error_message_lines = error_message.splitlines()
+        e = None
+        if compilation_cache:
+            cache_key = _compute_cache_key('compilation_error_batch', batch_source_code, args)
+            e = compilation_cache.get_compilation_error(cache_key)
+            dependencies = compilation_cache.get_dependencies(cache_key)
+        if e is None:
+            source, temporary_files = _create_source(batch_source_code)
+            try:
+                with recording_dependencies() as dependencies:
+                    compiler.compile_discarding_output(
+                        source=source,
+                        include_dirs=fruit_tests_include_dirs,
+                        args=args,
+                        max_errors=0)
+                # None of these tests failed to compile. They'll fail when they run.
+                continue
+            except CompilationFailedException as e1:
+                e = e1
+            finally:
+                for file_name in temporary_files:
+                    try_remove_temporary_file(file_name)
+            if compilation_cache:
+                compilation_cache.put_dependencies(cache_key, dependencies)
+                compilation_cache.put_compilation_error(cache_key, e)
+
+        blocks_by_index = collections.defaultdict(list)
+        interfering_indexes = set()
+        for block in _split_diagnostics(e.error_message):
+            indexes = _find_sources_with_errors('\n'.join(block), line_ranges)
+            if len(indexes) == 1:
+                [index] = indexes
+                blocks_by_index[index].append(block)
+            else:
+                # This error mentions lines from multiple tests, so we can't reliably attribute it to any of them.
+                interfering_indexes |= indexes
+
+        for index, blocks in blocks_by_index.items():
+            if index in interfering_indexes:
+                continue
+            error_message = '\n'.join(line for block in blocks for line in block)
+            # Remove the namespace, so that type names in the diagnostics are the same as when compiling the test on its
+            # own.
+            error_message = re.sub(r'\bfruit_batch_%s::' % index, '', error_message)
+            _batched_compilation_errors[(source_codes[index], ignore_deprecation_warnings)] = (
+                CompilationFailedException(e.command, error_message),
+                dependencies)
+
+def _check_compilation_error(check_error_fun, e):
+    error_message_head = _cap_to_lines(e.error_message, 40)
+    # The "In file included from" context is removed, since it's only emitted for the first error in each header (see
+    # prepare_compile_error_batch()).
+    error_message_lines = [line for line in e.error_message.splitlines() if not _is_include_context_line(line)]
+    error_message = '\n'.join(error_message_lines)
     # Different compilers output a different number of spaces when pretty-printing types.
     # When using libc++, sometimes std::foo identifiers are reported as std::__1::foo.
     normalized_error_message = error_message.replace(' ', '').replace('std::__1::', 'std::')
     normalized_error_message_lines = normalized_error_message.splitlines()
-    error_message_head = _cap_to_lines(error_message, 40)
 
     check_error_fun(e, error_message_lines, error_message_head, normalized_error_message_lines)
 
-    try_remove_temporary_file(source_file_name)
+def expect_compile_error_helper(
+        check_error_fun,
+        setup_source_code,
+        source_code,
+        test_params={},
+        ignore_deprecation_warnings=False,
+        stop_on_error_line_factory=None):
+    """
+    :param stop_on_error_line_factory: Optional. If specified, this is called to create a function that is then called
+           on each line of the compiler's diagnostics as soon as they're available. When that function returns True,
+           the compiler is stopped and only the diagnostics up to that line are passed to check_error_fun.
+    """
+    source_code = _construct_final_source_code(setup_source_code, source_code, test_params)
+    if _record_call('expect_compile_error', source_code, ignore_deprecation_warnings):
+        return
+
+    if (source_code, ignore_deprecation_warnings) in _batched_compilation_errors:
+        batched_e, dependencies = _batched_compilation_errors[(source_code, ignore_deprecation_warnings)]
+        try:
+            _check_compilation_error(check_error_fun, batched_e)
+            _add_dependencies(dependencies)
+            return
+        except Exception:
+            # The diagnostics might have been affected by the other tests in the batch. We'll compile this test on its
+            # own below, and only the result of that will be reported.
+            pass
+
+    args = []
+    if ignore_deprecation_warnings:
+        args += compiler.get_disable_deprecation_warning_flags()
+
+    e = None
+    temporary_files = []
+    if compilation_cache:
+        cache_key = _compute_cache_key(
+            'compilation_error_streaming' if stop_on_error_line_factory else 'compilation_error',
+            source_code,
+            args)
+        e = compilation_cache.get_compilation_error(cache_key)
+        if e is not None:
+            _add_dependencies(compilation_cache.get_dependencies(cache_key))
+
+    if e is None:
+        source, temporary_files = _create_source(source_code)
+        try:
+            with recording_dependencies() as dependencies:
+                compiler.compile_discarding_output(
+                    source=source,
+                    include_dirs=fruit_tests_include_dirs,
+                    args=args,
+                    stop_on_error_line=stop_on_error_line_factory() if stop_on_error_line_factory else None)
+            raise Exception('The test should have failed to compile, but it compiled successfully')
+        except CompilationFailedException as e1:
+            e = e1
+        if compilation_cache:
+            compilation_cache.put_dependencies(cache_key, dependencies)
+            compilation_cache.put_compilation_error(cache_key, e)
+
+    _check_compilation_error(check_error_fun, e)
+
+    for file_name in temporary_files:
+        try_remove_temporary_file(file_name)
 
 def expect_generic_compile_error(expected_error_regex, setup_source_code, source_code, test_params={}):
     """
@@ -264,6 +1722,35 @@ def expect_generic_compile_error(expected_error_regex, setup_source_code, source
     expect_compile_error_helper(check_error, setup_source_code, source_code, test_params)
 
 
+# 6 is just a constant that works for both g++ (<=4.8.3) and clang++ (<=3.5.0). It might need to be changed.
+# The "In file included from" lines are not counted (see _check_compilation_error()).
+_MAX_FRUIT_ERROR_LINE_NUMBER = 6
+
+class _FruitErrorDiagnosticsScanner:
+    """
+    Scans the compiler diagnostics line by line (as the compiler emits them) and decides when the compiler can be
+    stopped, because the lines that expect_compile_error() checks have already been emitted.
+    """
+    def __init__(self):
+        self.num_lines = 0
+        self.found_fruit_error = False
+        self.found_static_assert = False
+
+    def __call__(self, line):
+        if _is_include_context_line(line):
+            return False
+        self.num_lines += 1
+        normalized_line = line.replace(' ', '').replace('std::__1::', 'std::')
+        if re.search('fruit::impl::(.*Error<.*>)', normalized_line):
+            self.found_fruit_error = True
+        if re.search(fruit_error_message_extraction_regex, line):
+            self.found_static_assert = True
+        if self.found_fruit_error and self.found_static_assert:
+            return True
+        # If we got here the test will fail (since the two lines above weren't found early enough). We still wait for
+        # enough lines for the failure message to show the beginning of the diagnostics.
+        return self.num_lines > _MAX_FRUIT_ERROR_LINE_NUMBER + 1 and self.num_lines >= 40
+
 def expect_compile_error(
         expected_fruit_error_regex,
         expected_fruit_error_desc_regex,
@@ -393,15 +1880,16 @@ def expect_compile_error(
                 actual_static_assert_error = actual_static_assert_error,
                 error_message = error_message_head)))
 
-        # 6 is just a constant that works for both g++ (<=4.8.3) and clang++ (<=3.5.0). It might need to be changed.
-        if actual_fruit_error_line_number > 6 or actual_static_assert_error_line_number > 6:
+        if (actual_fruit_error_line_number > _MAX_FRUIT_ERROR_LINE_NUMBER
+                or actual_static_assert_error_line_number > _MAX_FRUIT_ERROR_LINE_NUMBER):
             raise Exception(textwrap.dedent('''\
                 The compilation failed with the expected message, but the error message contained too many lines before the relevant ones.
-                The error type was reported on line {actual_fruit_error_line_number} of the message (should be <=6).
-                The static assert was reported on line {actual_static_assert_error_line_number} of the message (should be <=6).
+                The error type was reported on line {actual_fruit_error_line_number} of the message (should be <={max_line_number}).
+                The static assert was reported on line {actual_static_assert_error_line_number} of the message (should be <={max_line_number}).
                 Error message:
                 {error_message}
                 '''.format(
+                max_line_number = _MAX_FRUIT_ERROR_LINE_NUMBER,
                 actual_fruit_error_line_number = actual_fruit_error_line_number,
                 actual_static_assert_error_line_number = actual_static_assert_error_line_number,
                 error_message = error_message_head)))
@@ -411,7 +1899,8 @@ def expect_compile_error(
                 raise Exception(
                     'The compilation failed with the expected message, but the error message contained some metaprogramming types in the output (besides Error). Error message:\n%s' + error_message_head)
 
-    expect_compile_error_helper(check_error, setup_source_code, source_code, test_params, ignore_deprecation_warnings)
+    expect_compile_error_helper(check_error, setup_source_code, source_code, test_params, ignore_deprecation_warnings,
+                                stop_on_error_line_factory=_FruitErrorDiagnosticsScanner)
 
 
 def expect_runtime_error(
@@ -438,22 +1927,13 @@ def expect_runtime_error(
 
     expected_error_regex = _replace_using_test_params(expected_error_regex, test_params)
     source_code = _construct_final_source_code(setup_source_code, source_code, test_params)
+    if _record_call('expect_runtime_error', source_code, ignore_deprecation_warnings):
+        return
 
-    source_file_name = _create_temporary_file(source_code, file_name_suffix='.cpp')
-    executable_suffix = {'posix': '', 'nt': '.exe'}[os.name]
-    output_file_name = _create_temporary_file('', executable_suffix)
-
-    args = fruit_tests_linker_flags
-    if ignore_deprecation_warnings:
-        args += compiler.get_disable_deprecation_warning_flags()
-    compiler.compile_and_link(
-        source=source_file_name,
-        include_dirs=fruit_tests_include_dirs,
-        output_file_name=output_file_name,
-        args=args)
+    executable, temporary_files, run_fun = _compile_and_link_for_backend(source_code, ignore_deprecation_warnings)
 
     try:
-        run_command(output_file_name)
+        run_fun(executable, phase='run')
         raise Exception('The test should have failed at runtime, but it ran successfully')
     except CommandFailedException as e1:
         e = e1
@@ -474,10 +1954,36 @@ def expect_runtime_error(
             '''.format(expected_error_regex = expected_error_regex, stderr = stderr_head)))
 
     # Note that we don't delete the temporary files if the test failed. This is intentional, keeping them around helps debugging the failure.
-    try_remove_temporary_file(source_file_name)
-    try_remove_temporary_file(output_file_name)
+    for file_name in temporary_files:
+        try_remove_temporary_file(file_name)
 
 
+def _construct_success_source_code(setup_source_code, source_code, test_params):
+    source_code = _construct_final_source_code(setup_source_code, source_code, test_params)
+    if 'main(' not in source_code:
+        source_code += textwrap.dedent('''
+            int main() {
+            }
+            ''')
+    return source_code
+
+def prepare_test_params_batch(setup_source_code, source_code, test_params_list, ignore_deprecation_warnings=False):
+    """
+    Builds a single executable containing all the variants of a test that's expected to compile and run successfully,
+    one for each of the given test_params dicts (each variant in its own namespace, with a dispatcher main()).
+    Subsequent expect_success() calls for any of these variants then only run that executable, passing the index of the
+    variant. Variants that can't be batched (or that break the batch compilation) are compiled separately as usual.
+
+    The parameters are the same as for expect_success(), except that this takes a list of test_params dicts.
+    """
+    prepare_success_batch([
+        _RecordedCall(
+            'expect_success',
+            _construct_success_source_code(setup_source_code, source_code, test_params),
+            ignore_deprecation_warnings)
+        for test_params in test_params_list
+    ])
+
 def expect_success(setup_source_code, source_code, test_params={}, ignore_deprecation_warnings=False):
     """
     Tests that the given source compiles and runs successfully.
@@ -489,36 +1995,28 @@ def expect_success(setup_source_code, source_code, test_params={}, ignore_deprec
     :param test_params: A dict containing the definition of some identifiers. Each identifier in
            source_code will be replaced (textually) with its definition (if a definition was provided).
     """
-    source_code = _construct_final_source_code(setup_source_code, source_code, test_params)
-
-    if 'main(' not in source_code:
-        source_code += textwrap.dedent('''
-            int main() {
-            }
-            ''')
-
-    source_file_name = _create_temporary_file(source_code, file_name_suffix='.cpp')
-    executable_suffix = {'posix': '', 'nt': '.exe'}[os.name]
-    output_file_name = _create_temporary_file('', executable_suffix)
-
-    args = fruit_tests_linker_flags
-    if ignore_deprecation_warnings:
-        args += compiler.get_disable_deprecation_warning_flags()
-    compiler.compile_and_link(
-        source=source_file_name,
-        include_dirs=fruit_tests_include_dirs,
-        output_file_name=output_file_name,
-        args=args)
+    source_code = _construct_success_source_code(setup_source_code, source_code, test_params)
+    if _record_call('expect_success', source_code, ignore_deprecation_warnings):
+        return
+
+    if (source_code, ignore_deprecation_warnings) in _batched_executables:
+        executable, batch_index, dependencies = _batched_executables[(source_code, ignore_deprecation_warnings)]
+        _add_dependencies(dependencies)
+        executable_args = [str(batch_index)]
+        temporary_files = []
+        run_fun = run_command
+    else:
+        executable, temporary_files, run_fun = _compile_and_link_for_backend(source_code, ignore_deprecation_warnings)
+        executable_args = []
 
-    if RUN_TESTS_UNDER_VALGRIND.lower() in ('false', 'off', 'no', '0', ''):
-        run_command(output_file_name)
+    if _should_run_under_valgrind(source_code):
+        _run_under_valgrind(executable, executable_args)
     else:
-        args = VALGRIND_FLAGS.split() + [output_file_name]
-        run_command('valgrind', args)
+        run_fun(executable, executable_args, phase='run')
 
     # Note that we don't delete the temporary files if the test failed. This is intentional, keeping them around helps debugging the failure.
-    try_remove_temporary_file(source_file_name)
-    try_remove_temporary_file(output_file_name)
+    for file_name in temporary_files:
+        try_remove_temporary_file(file_name)
 
 
 # Note: this is not the main function of this file, it's meant to be used as main function from test_*.py files.